@@ -0,0 +1,157 @@
+"""
+Authentication hot path: token, cookie and M2M authentication classes and the middleware,
+with valid, expired, wrong audience and malformed tokens signed by a generated RS256 key
+
+    python -m benchmarks.bench_authentication [--save | --compare] [--filter cookie]
+
+"(verify)" benchmarks clear the token caches before each call, the others measure cache hits.
+"""
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.harness import run, setup_django
+
+setup_django()
+
+import jwt  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from django.http import HttpRequest  # noqa: E402
+
+from kl_authentication.authentication import KairnialCookieAuthentication, \
+    KairnialTokenAuthentication, TokenAthentication  # noqa: E402
+from kl_authentication.keys import KeyRing, set_key_ring  # noqa: E402
+from kl_authentication.middlewares import KairnialAuthMiddleware  # noqa: E402
+from kl_authentication.revocation import RevocationList, jti_revocation_id, token_fingerprints, \
+    write_revocation_file  # noqa: E402
+
+CLIENT_ID = 'benchmark-client'
+APP_USER_ID = '7d1c1f8e-3f6a-4e0e-8a57-2f0f3c6a9b42'
+
+
+def generate_keys():
+    """
+    :return: private and public PEM keys
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode()
+    public_key = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    return private_key, public_key
+
+
+PRIVATE_KEY, PUBLIC_KEY = generate_keys()
+set_key_ring(KeyRing(default_key=PUBLIC_KEY))
+
+
+def make_token(audience: str = CLIENT_ID, expires_in: int = 3600) -> str:
+    return jwt.encode({
+        'sub': '0b5e7d0c-7a3e-4b7a-9f38-5b3e0c1f9d11',
+        'email': 'jane.doe@example.com',
+        'name': 'Doe',
+        'aud': audience,
+        'exp': int(time.time()) + expires_in,
+    }, PRIVATE_KEY, algorithm='RS256')
+
+
+TOKENS = {
+    'valid': make_token(),
+    'expired': make_token(expires_in=-60),
+    'wrong audience': make_token(audience='other-client'),
+    'malformed': 'not-a.jwt',
+}
+
+
+def make_request(authorization: str = None, cookie: str = None, app_user_id: str = None) -> HttpRequest:
+    request = HttpRequest()
+    request.method = 'GET'
+    if authorization:
+        request.META['HTTP_AUTHORIZATION'] = authorization
+    if cookie:
+        request.COOKIES['access_token'] = cookie
+    if app_user_id:
+        request.META['HTTP_X_APP_USER_ID'] = app_user_id
+    request.client_id = CLIENT_ID
+    return request
+
+
+def clear_caches():
+    TokenAthentication.token_cache.clear()
+    TokenAthentication.negative_cache.clear()
+
+
+def header_authentication(token: str, cold: bool = False):
+    authentication = KairnialTokenAuthentication()
+    authorization = f'Bearer {token}'
+
+    def bench():
+        if cold:
+            clear_caches()
+        return authentication.authenticate(make_request(authorization=authorization))
+
+    return bench
+
+
+def cookie_authentication(token: str, cold: bool = False):
+    authentication = KairnialCookieAuthentication()
+
+    def bench():
+        if cold:
+            clear_caches()
+        return authentication.authenticate(make_request(cookie=token))
+
+    return bench
+
+
+def m2m_authentication():
+    authentication = KairnialTokenAuthentication()
+    authorization = f"Bearer {TOKENS['valid']}"
+
+    def bench():
+        return authentication.authenticate(make_request(authorization=authorization, app_user_id=APP_USER_ID))
+
+    return bench
+
+
+def middleware(authorization: str = None):
+    kl_middleware = KairnialAuthMiddleware(lambda request: request)
+
+    def bench():
+        return kl_middleware(make_request(authorization=authorization))
+
+    return bench
+
+
+def revocation_check(revoked: int = 100000):
+    path = os.path.join(tempfile.mkdtemp(), 'revocations')
+    write_revocation_file(path, (jti_revocation_id(f'revoked-{i}') for i in range(revoked)))
+    revocation_list = RevocationList(path, reload_interval=0)
+    fingerprints = token_fingerprints(TOKENS['valid'], {'jti': 'not-revoked'})
+
+    def bench():
+        return revocation_list.is_revoked(fingerprints)
+
+    return bench
+
+
+BENCHMARKS = {
+    'request construction': make_request,
+    'middleware anonymous': middleware(),
+    'middleware header': middleware(f"Bearer {TOKENS['valid']}"),
+    'm2m X-App-User-Id': m2m_authentication(),
+    'cookie valid': cookie_authentication(TOKENS['valid']),
+    'cookie valid (verify)': cookie_authentication(TOKENS['valid'], cold=True),
+    'revocation check': revocation_check(),
+}
+for token_name, benchmark_token in TOKENS.items():
+    BENCHMARKS[f'header {token_name}'] = header_authentication(benchmark_token)
+    BENCHMARKS[f'header {token_name} (verify)'] = header_authentication(benchmark_token, cold=True)
+
+
+if __name__ == '__main__':
+    # rejected tokens are logged, keep the output readable
+    logging.disable(logging.CRITICAL)
+    run(BENCHMARKS, 'bench_authentication')
@@ -0,0 +1,44 @@
+"""
+Compare the lightweight principal with the user model instance built per authenticated request
+
+    python -m benchmarks.bench_principal [--save | --compare]
+"""
+from benchmarks.harness import run, setup_django
+
+setup_django()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+
+from kl_authentication.principal import KairnialUser  # noqa: E402
+
+CLAIMS = {
+    'sub': '0b5e7d0c-7a3e-4b7a-9f38-5b3e0c1f9d11',
+    'email': ' jane.doe@example.com ',
+    'name': 'Doe',
+}
+
+
+def build_model_user():
+    user = get_user_model()(
+        first_name='',
+        last_name=CLAIMS.get('name') or '',
+        email=CLAIMS.get('email').strip()
+    )
+    user.uuid = CLAIMS.get('sub')
+    return user
+
+
+def build_principal():
+    return KairnialUser(
+        uuid=CLAIMS.get('sub'),
+        first_name='',
+        last_name=CLAIMS.get('name') or '',
+        email=CLAIMS.get('email').strip()
+    )
+
+
+if __name__ == '__main__':
+    run({
+        'user model instance': build_model_user,
+        'KairnialUser': build_principal,
+    }, 'bench_principal')
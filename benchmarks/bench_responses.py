@@ -0,0 +1,27 @@
+"""
+Token response building: DRF serializers and renderer against the fast path projection
+
+    python -m benchmarks.bench_responses [--save | --compare]
+"""
+from benchmarks.harness import run, setup_django
+
+setup_django()
+
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from kl_authentication.responses import project, render_json  # noqa: E402
+from kl_authentication.serializers import AuthResponseSerializer, AuthServiceErrorSerializer  # noqa: E402
+from kl_authentication.testing import StubAuthServer  # noqa: E402
+
+AUTH_RESPONSE = StubAuthServer().response
+ERROR = {'service_status': 401, 'service_message': 'Authentication failed with code 401'}
+RENDERER = JSONRenderer()
+
+
+if __name__ == '__main__':
+    run({
+        'token serializer + renderer': lambda: RENDERER.render(AuthResponseSerializer(AUTH_RESPONSE).data),
+        'token projection + render_json': lambda: render_json(project(AuthResponseSerializer, AUTH_RESPONSE)),
+        'error serializer': lambda: AuthServiceErrorSerializer(ERROR).data,
+        'error projection': lambda: project(AuthServiceErrorSerializer, ERROR),
+    }, 'bench_responses')
@@ -0,0 +1,61 @@
+"""
+Cold start cost of kl_authentication: import time and resident memory measured in fresh
+interpreters, for the modules a worker typically loads
+
+    python -m benchmarks.bench_startup [--runs 10]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+SCENARIOS = {
+    'django.setup()': '',
+    'kl_authentication': 'import kl_authentication',
+    'authentication classes': 'import kl_authentication.authentication',
+    'middleware': 'import kl_authentication.middlewares',
+    'services': 'import kl_authentication.services',
+    'views': 'import kl_authentication.views',
+}
+
+PROBE = '''
+import json, os, resource, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+start = time.perf_counter()
+import django
+django.setup()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'import_ms': elapsed * 1000,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+    'drf_spectacular': 'drf_spectacular' in sys.modules,
+    'requests': 'requests' in sys.modules,
+}}))
+'''
+
+
+def probe(statement: str) -> dict:
+    output = subprocess.run([sys.executable, '-c', PROBE.format(statement=statement)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    print(f"{'scenario':28} {'import ms':>10} {'max RSS MB':>11} {'modules':>8}  loaded")
+    for name, statement in SCENARIOS.items():
+        results = [probe(statement) for _ in range(args.runs)]
+        loaded = [module for module in ('drf_spectacular', 'requests') if results[-1][module]]
+        print(f"{name:28} {statistics.median(r['import_ms'] for r in results):10.1f} "
+              f"{statistics.median(r['maxrss_kb'] for r in results) / 1024:11.1f} "
+              f"{results[-1]['modules']:8}  {', '.join(loaded)}")
+
+
+if __name__ == '__main__':
+    main()
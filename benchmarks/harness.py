@@ -0,0 +1,149 @@
+"""
+Benchmark helpers
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+
+def setup_django(settings_module: str = 'benchmarks.settings'):
+    """
+    Configure Django before importing kl_authentication modules
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def measure(fn, iterations: int = 10000, warmup: int = 100) -> dict:
+    """
+    Time fn and count the memory it allocates
+    :param fn: Callable without arguments
+    :param iterations: Number of timed calls
+    :param warmup: Number of untimed calls
+    :return: ops/sec, latency percentiles (µs) and allocations per call
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    clock = time.perf_counter
+    for _ in range(iterations):
+        start = clock()
+        fn()
+        timings.append(clock() - start)
+    timings.sort()
+
+    # peak traced memory of each call, results are kept alive so that they are counted
+    alloc_iterations = min(iterations, 1000)
+    results = []
+    allocated = 0
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(alloc_iterations):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        results.append(fn())
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    del results
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1e6
+
+    return {
+        'ops_per_sec': len(timings) / sum(timings),
+        'mean_us': statistics.fmean(timings) * 1e6,
+        'p50_us': percentile(0.50),
+        'p90_us': percentile(0.90),
+        'p99_us': percentile(0.99),
+        'alloc_bytes_per_call': allocated / alloc_iterations,
+        'alloc_blocks_per_call': blocks / alloc_iterations,
+    }
+
+
+def print_results(results: dict):
+    """
+    Print results as a table
+    """
+    print(f"{'benchmark':40} {'ops/s':>12} {'p50 µs':>9} {'p99 µs':>9} {'B/call':>9} {'blocks':>7}")
+    for name, result in results.items():
+        print(f"{name:40} {result['ops_per_sec']:12.0f} {result['p50_us']:9.2f} {result['p99_us']:9.2f} "
+              f"{result['alloc_bytes_per_call']:9.1f} {result['alloc_blocks_per_call']:7.2f}")
+
+
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+def save_baseline(path: str, results: dict):
+    """
+    Store results as the reference for later comparisons
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """
+    Print results next to the baseline
+    :param results: measure() results by benchmark name
+    :param baseline: Stored results
+    :param tolerance: Allowed relative increase of p50 latency and allocated bytes
+    :return: names of the regressed benchmarks
+    """
+    regressions = []
+    print(f"{'benchmark':40} {'p50 µs':>9} {'base':>9} {'ratio':>6} {'B/call':>9} {'base':>9} {'ratio':>6}")
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print(f"{name:40} {result['p50_us']:9.2f} {'-':>9}")
+            continue
+        ratios = []
+        for key in ('p50_us', 'alloc_bytes_per_call'):
+            ratios.append(result[key] / reference[key] if reference[key] else 1)
+        regressed = any(ratio > 1 + tolerance for ratio in ratios)
+        if regressed:
+            regressions.append(name)
+        print(f"{name:40} {result['p50_us']:9.2f} {reference['p50_us']:9.2f} {ratios[0]:6.2f} "
+              f"{result['alloc_bytes_per_call']:9.1f} {reference['alloc_bytes_per_call']:9.1f} {ratios[1]:6.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def run(benchmarks: dict, name: str, argv=None):
+    """
+    Command line entry point: measure benchmarks, then print, save or compare to the baseline
+    :param benchmarks: Callables by benchmark name
+    :param name: Baseline file name
+    :param argv: Command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--filter', default='', help="Run benchmarks whose name contains this text")
+    parser.add_argument('--baseline', default=os.path.join(BASELINES_DIR, f'{name}.json'))
+    parser.add_argument('--save', action='store_true', help="Store results as the baseline")
+    parser.add_argument('--compare', action='store_true', help="Compare results to the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    if args.compare and not args.save and not os.path.exists(args.baseline):
+        parser.error(f"no baseline at {args.baseline}, record one first with --save")
+
+    results = {
+        bench_name: measure(fn, iterations=args.iterations)
+        for bench_name, fn in benchmarks.items() if args.filter in bench_name
+    }
+    if args.save:
+        save_baseline(args.baseline, results)
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, tolerance=args.tolerance):
+            sys.exit(1)
+    else:
+        print_results(results)
@@ -0,0 +1,20 @@
+"""
+Minimal Django settings used by the benchmarks
+"""
+SECRET_KEY = 'benchmark'
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'rest_framework',
+    'kl_authentication',
+]
+DATABASES = {}
+USE_TZ = True
+KAIRNIAL_AUTH_DOMAIN = 'localhost'
+KAIRNIAL_AUTH_PUBLIC_KEY = None
+KAIRNIAL_AUTH_SERVER = 'http://127.0.0.1:8000'
+KAIRNIAL_AUTHENTICATION_SCOPES = ['openid', 'profile', 'email']
+CLIENT_ID_VARIABLE = 'client_id'
+REST_FRAMEWORK = {
+    'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+}
@@ -1,4 +1,10 @@
-from .openapi import TokenScheme
-
 TEXT_CONTENT_TYPE = 'application/text'
 JSON_CONTENT_TYPE = 'application/json'
+
+
+def __getattr__(name):
+    # the OpenAPI extensions (and drf_spectacular) are only imported when needed
+    if name in ('TokenScheme', 'HeaderOrCookieTokenScheme'):
+        from . import openapi
+        return getattr(openapi, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'kl_authentication'
+
+    def ready(self):
+        from .metrics import REGISTRY
+        from .scopes import SCOPES
+
+        REGISTRY.configure_from_settings()
+        SCOPES.mask(getattr(settings, 'KAIRNIAL_AUTHENTICATION_SCOPES', ()), register=True)
+        if getattr(settings, 'KAIRNIAL_AUTH_OPENAPI_EAGER', False):
+            # registers the OpenAPI authentication extensions at startup instead of with the views
+            from . import openapi  # noqa: F401
+        config = getattr(settings, 'KAIRNIAL_AUTH_LOGGING', None)
+        if config:
+            from .logutils import install_log_pipeline
+            self.log_pipeline = install_log_pipeline(config)
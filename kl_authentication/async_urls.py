@@ -0,0 +1,17 @@
+from django.urls import path
+
+from .metrics import REGISTRY
+from .views import AsyncClientlessPasswordAuthenticationView, \
+    AsyncClientlessAPIKeyAuthenticationView, \
+    AsyncClientlessRefreshTokenAuthenticationView, MetricsView
+
+# Same routes as urls.py, served by async views when running under ASGI
+urlpatterns = [
+    path('password', AsyncClientlessPasswordAuthenticationView.as_view()),
+    path('key', AsyncClientlessAPIKeyAuthenticationView.as_view()),
+    path('renew', AsyncClientlessRefreshTokenAuthenticationView.as_view()),
+]
+
+if REGISTRY.enabled:
+    # KAIRNIAL_AUTH_METRICS is applied by AuthenticationConfig.ready(), before URLs are loaded
+    urlpatterns.append(path('metrics', MetricsView.as_view()))
@@ -3,60 +3,296 @@
 from __future__ import unicode_literals
 
 import logging
+import time
 
 import jwt
-import urllib
 from django.conf import settings
-from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
-KAIRNIAL_AUTH_DOMAIN = settings.KAIRNIAL_AUTH_DOMAIN
-KAIRNIAL_AUTH_PUBLIC_KEY = settings.KAIRNIAL_AUTH_PUBLIC_KEY
+from .cache import SharedTokenCache, TTLCache, token_digest
+from .clients import get_client_registry
+from .conf import LazySetting, setting
+from .credentials import SOURCE_COOKIE, SOURCE_HEADER, Credentials, get_credentials
+from .keys import get_key_ring
+from .logutils import AggregatingLogger
+from .metrics import AUTH_FAILURES, TOKEN_CACHE, TOKEN_VERIFY_SECONDS
+from .precheck import precheck_token
+from .principal import KairnialUser, build_token_user, build_user
+from .revocation import TokenRevokedError, get_revocation_list, token_fingerprints
+from .scopes import SCOPES
+from .timing import TIMING_VERIFY, timed
+
 ALGORITHMS = ["RS256"]
+SETTING_DEFAULTS = {
+    'KAIRNIAL_AUTH_TOKEN_CACHE': {},
+    'KAIRNIAL_AUTH_NEGATIVE_CACHE': {},
+    'KAIRNIAL_AUTH_MAX_TOKEN_LENGTH': 8192,
+    'KAIRNIAL_AUTH_FAILURE_LOG_INTERVAL': 60,
+    'KAIRNIAL_AUTH_PUBLIC_KEY': None,
+}
+
+logger = logging.getLogger('authentication')
+
+
+def _setting(name: str):
+    return setting(name, SETTING_DEFAULTS[name])
+
+
+def __getattr__(name):
+    # settings are resolved on access, keys are loaded by the key ring
+    if name == 'KAIRNIAL_AUTH_DOMAIN':
+        return settings.KAIRNIAL_AUTH_DOMAIN
+    if name in SETTING_DEFAULTS:
+        return _setting(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class TokenAthentication(JWTAuthentication):
     """
     Token based authentication using the JSON Web Token standard.
+
+    Successful verifications are kept in a process wide LRU cache, keyed by a digest
+    of the token and its audience, until the token expires. An optional second tier
+    (KAIRNIAL_AUTH_SHARED_TOKEN_CACHE) shares verified claims between workers.
+    Tokens are pre-checked before signature verification and recent failures are
+    remembered for a short time, failures are logged once per interval and reason.
+    Revoked tokens (KAIRNIAL_AUTH_REVOCATION) are rejected, including cached ones.
+    The scope claim is parsed into a bitmask cached with the user and set in request.auth_scopes.
+    Issuer, audiences, keys, leeway and algorithms can be set per client (KAIRNIAL_AUTH_CLIENTS).
     """
+    token_cache = LazySetting(lambda: TTLCache(max_size=_setting('KAIRNIAL_AUTH_TOKEN_CACHE').get('MAX_SIZE', 1024)))
+    token_cache_max_ttl = LazySetting(lambda: _setting('KAIRNIAL_AUTH_TOKEN_CACHE').get('MAX_TTL'))
+    shared_token_cache = LazySetting(SharedTokenCache.from_settings)
+    negative_cache = LazySetting(
+        lambda: TTLCache(max_size=_setting('KAIRNIAL_AUTH_NEGATIVE_CACHE').get('MAX_SIZE', 4096)))
+    negative_cache_ttl = LazySetting(lambda: _setting('KAIRNIAL_AUTH_NEGATIVE_CACHE').get('TTL', 30))
+    max_token_length = LazySetting(lambda: _setting('KAIRNIAL_AUTH_MAX_TOKEN_LENGTH'))
+    failure_log = LazySetting(
+        lambda: AggregatingLogger('authentication', interval=_setting('KAIRNIAL_AUTH_FAILURE_LOG_INTERVAL')))
 
     def _get_m2m_user(self, request):
         """
         Get User from header
         """
-        user_id = request.META.get('HTTP_X_APP_USER_ID')
+        user_id = get_credentials(request).app_user_id
         if not user_id:
             return None
-        user = get_user_model()(
+        return build_user(
+            uuid=user_id,
             first_name='M2M',
             last_name='User',
             email='none@thinkproject.com'
         )
-        user.uuid = user_id
-        return user
 
     def _get_token_user(self, request, token):
         """
         Get user from token information
         """
-        payload = jwt.decode(
-            token,
-            KAIRNIAL_AUTH_PUBLIC_KEY,
-            algorithms=ALGORITHMS,
-            audience=request.client_id
-        )
-        uuid = payload.get('sub')
-        first_name = ''
-        last_name = payload.get('name') or ''
-        email = payload.get('email').strip()
-        user = get_user_model()(
-            first_name=first_name,
-            last_name=last_name,
-            email=email
-        )
-        user.uuid = uuid
+        audience = request.client_id
+        cache_key = self._cache_key(token, audience)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            user, payload, _, scopes = cached
+            request.auth_scopes = scopes
+            # mutable principals (user model instances) are built for each request
+            return user if user is not None else self._build_token_user(payload)
+        payload = self.get_verified_claims(token=token, audience=audience, cache_key=cache_key)
+        user = self._build_token_user(payload)
+        request.auth_scopes = self._set_cached(cache_key, token, payload, user)
         return user
 
+    def get_token_claims(self, token: str, audience: str) -> dict:
+        """
+        Verified token claims, from the local cache shared with the authentication classes
+        then as get_verified_claims
+        :param token: Encoded JWT
+        :param audience: Expected audience (client_id)
+        :return: decoded claims
+        :raise jwt.PyJWTError: invalid token
+        """
+        cache_key = self._cache_key(token, audience)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached[1]
+        payload = self.get_verified_claims(token=token, audience=audience, cache_key=cache_key)
+        self._set_cached(cache_key, token, payload)
+        return payload
+
+    def _get_cached(self, cache_key: str):
+        """
+        Local cache entry (user, claims, fingerprints, scopes) of a verified token
+        :param cache_key: Token digest
+        :return: None on miss
+        :raise TokenRevokedError: the token was revoked since it was cached
+        """
+        cached = self.token_cache.get(cache_key)
+        if cached is None:
+            TOKEN_CACHE.inc(tier='local', result='miss')
+            return None
+        TOKEN_CACHE.inc(tier='local', result='hit')
+        self._check_revocation(cached[2])
+        return cached
+
+    def _set_cached(self, cache_key: str, token: str, payload: dict, user=None) -> int:
+        """
+        Store a verified token in the local cache
+        :param cache_key: Token digest
+        :param token: Encoded JWT
+        :param payload: Decoded token claims
+        :param user: Principal built from the claims, only shared if immutable
+        :return: scopes bitmask
+        """
+        scopes = SCOPES.parse(payload.get('scope'))
+        expires_at = self._cache_expiration(payload)
+        if expires_at is not None:
+            shared_user = user if isinstance(user, KairnialUser) else None
+            self.token_cache.set(cache_key, (shared_user, payload, token_fingerprints(token, payload), scopes),
+                                 expires_at=expires_at)
+        return scopes
+
+    def get_verified_claims(self, token: str, audience: str, cache_key: str = None) -> dict:
+        """
+        Verified token claims, from the negative and shared caches when possible
+        :param token: Encoded JWT
+        :param audience: Expected audience (client_id)
+        :param cache_key: Token digest, computed when not given
+        :return: decoded claims
+        :raise jwt.PyJWTError: invalid token
+        """
+        cache_key = cache_key or self._cache_key(token, audience)
+        failure = self.negative_cache.get(cache_key)
+        if failure is not None:
+            TOKEN_CACHE.inc(tier='negative', result='hit')
+            error_class, message = failure
+            raise error_class(message)
+        payload = self._get_shared_payload(cache_key)
+        if payload is not None:
+            self._check_revocation(token_fingerprints(token, payload))
+            return payload
+        try:
+            with TOKEN_VERIFY_SECONDS.time(), timed(TIMING_VERIFY):
+                payload = self._verify_token(token=token, audience=audience)
+        except jwt.InvalidKeyError:
+            # the key ring may be reloading, do not remember the failure
+            raise
+        except jwt.PyJWTError as e:
+            if self.negative_cache_ttl:
+                self.negative_cache.set(cache_key, (type(e), str(e)),
+                                        expires_at=time.time() + self.negative_cache_ttl)
+            raise
+        expires_at = self._cache_expiration(payload)
+        if expires_at is not None and self.shared_token_cache is not None:
+            self.shared_token_cache.set(cache_key, payload, expires_at=expires_at)
+        self._check_revocation(token_fingerprints(token, payload))
+        return payload
+
+    @staticmethod
+    def _check_revocation(fingerprints: tuple):
+        """
+        :param fingerprints: token_fingerprints of a verified token
+        :raise TokenRevokedError: the token or its jti is revoked
+        """
+        revocation_list = get_revocation_list()
+        if revocation_list is not None and revocation_list.is_revoked(fingerprints):
+            raise TokenRevokedError("Token has been revoked")
+
+    @staticmethod
+    def _cache_key(token: str, audience: str) -> str:
+        """
+        Digest of the token, its audience and the client registry version
+        """
+        client_registry = get_client_registry()
+        if client_registry is None:
+            return token_digest(token, audience)
+        return token_digest(token, audience, client_registry.version)
+
+    def _get_shared_payload(self, cache_key: str):
+        """
+        Claims verified by another worker
+        :param cache_key: Token digest
+        :return: None on miss or if the shared cache is disabled
+        """
+        if self.shared_token_cache is None:
+            return None
+        payload = self.shared_token_cache.get(cache_key)
+        if payload is not None and payload.get('exp', 0) <= time.time():
+            payload = None
+        TOKEN_CACHE.inc(tier='shared', result='miss' if payload is None else 'hit')
+        return payload
+
+    def _verify_token(self, token: str, audience: str) -> dict:
+        """
+        Pre-check then verify token signature and claims
+        :param token: Encoded JWT
+        :param audience: Expected audience (client_id), selects the client verification options
+        :return: decoded claims
+        """
+        client_registry = get_client_registry()
+        client = client_registry.get(audience) if client_registry is not None else None
+        if client is None:
+            header, _ = precheck_token(token, ALGORITHMS, max_length=self.max_token_length)
+            return self._decode(token, header.get('kid'), algorithms=ALGORITHMS, audience=audience)
+        header, _ = precheck_token(token, client.algorithms, max_length=self.max_token_length, leeway=client.leeway)
+        client.check_key_id(header.get('kid'))
+        # a client restricted to some keys is never verified with the default key
+        return self._decode(token, header.get('kid'), fallback=client.key_ids is None, **client.decode_options)
+
+    @staticmethod
+    def _decode(token: str, kid: str, fallback: bool = True, **options) -> dict:
+        """
+        Verify token with the key ring key of kid
+        :param token: Encoded JWT
+        :param kid: Token header kid
+        :param fallback: Use the default key when the key ring has no key for kid
+        :param options: jwt.decode options
+        :return: decoded claims
+        :raise jwt.InvalidKeyError: signature check failed with the default key used for an unknown kid,
+            the key ring may not have loaded the new key yet so the failure must not be remembered
+        """
+        key_ring = get_key_ring()
+        try:
+            return jwt.decode(token, key_ring.get_key_by_id(kid, fallback=fallback), **options)
+        except jwt.InvalidSignatureError:
+            if kid is not None and kid not in key_ring:
+                raise jwt.InvalidKeyError(f"No public key found for kid {kid}")
+            raise
+
+    def _cache_expiration(self, payload: dict):
+        """
+        Timestamp until which a verified token can be served from cache
+        :param payload: Decoded token claims
+        :return: None if the token must not be cached
+        """
+        expires_at = payload.get('exp')
+        if self.token_cache_max_ttl is not None:
+            max_expiration = time.time() + self.token_cache_max_ttl
+            expires_at = max_expiration if expires_at is None else min(expires_at, max_expiration)
+        return expires_at
+
+    @staticmethod
+    def failure_reason(error: Exception) -> str:
+        """
+        Reason reported for a rejected token, as in the failure logs and metrics
+        :param error: Verification exception
+        :return: expired, claims, client_id, revoked or invalid
+        """
+        if isinstance(error, jwt.ExpiredSignatureError):
+            return 'expired'
+        if isinstance(error, (jwt.InvalidIssuerError, jwt.InvalidAudienceError)):
+            return 'claims'
+        if isinstance(error, AttributeError):
+            return 'client_id'
+        if isinstance(error, TokenRevokedError):
+            return 'revoked'
+        return 'invalid'
+
+    @staticmethod
+    def _build_token_user(payload: dict):
+        """
+        Build user from decoded token claims
+        """
+        return build_token_user(payload)
+
     def _get_user(self, request, token):
         """
         Get user information from token or request
@@ -64,7 +300,6 @@ class TokenAthentication(JWTAuthentication):
         :param token:
         :return:
         """
-        logger = logging.getLogger('authentication')
         user = self._get_m2m_user(request=request)
         if user:
             request.user = user
@@ -74,16 +309,24 @@ class TokenAthentication(JWTAuthentication):
             request.user = user
             return user, token
         except jwt.ExpiredSignatureError:
-            logger.error("Token expired")
+            AUTH_FAILURES.inc(reason='expired')
+            self.failure_log.log('expired', "Token expired")
             return None
         except (jwt.InvalidIssuerError, jwt.InvalidAudienceError):
-            logger.error("incorrect claims, please check the audience and issuer")
+            AUTH_FAILURES.inc(reason='claims')
+            self.failure_log.log('claims', "incorrect claims, please check the audience and issuer")
             return None
         except AttributeError:
-            logger.error("Unable to get client_id")
+            AUTH_FAILURES.inc(reason='client_id')
+            self.failure_log.log('client_id', "Unable to get client_id")
+            return None
+        except TokenRevokedError:
+            AUTH_FAILURES.inc(reason='revoked')
+            self.failure_log.log('revoked', "Token revoked")
             return None
         except Exception as e:
-            logger.error(f"Unable to parse authentication {str(e)}")
+            AUTH_FAILURES.inc(reason='invalid')
+            self.failure_log.log('invalid', "Unable to parse authentication %s", e)
             return None
 
 
@@ -99,16 +342,14 @@ class KairnialTokenAuthentication(TokenAthentication):
         Returns a two-tuple of `User` and token if a valid signature has been
         supplied using JWT-based authentication, otherwise, returns `None`.
         """
-        logger = logging.getLogger('authentication')
-        try:
-            token = request.META.get('HTTP_AUTHORIZATION').split()[1]
-            if token is None:
-                logger.error('Authorization header not found')
+        credentials = get_credentials(request)
+        if credentials.source != SOURCE_HEADER:
+            # the access_token cookie took precedence when credentials were parsed
+            credentials = Credentials.from_header(request, app_user_id=credentials.app_user_id)
+            if credentials is None:
+                logger.debug('Authorization header not found')
                 return None
-        except (AttributeError, IndexError):
-            logger.error('Malformed authentication header')
-            return None
-        return self._get_user(request=request, token=token)
+        return self._get_user(request=request, token=credentials.token)
 
 
 class KairnialCookieAuthentication(TokenAthentication):
@@ -121,17 +362,34 @@ class KairnialCookieAuthentication(TokenAthentication):
         Returns a two-tuple of `User` and token if a valid signature has been
         supplied using JWT-based authentication, otherwise, returns `None`.
         """
-        logger = logging.getLogger('authentication')
-        try:
-            cookie = request.COOKIES.get('access_token')
-            if cookie is None:
-                logger.error('access_token cookie not found')
-                return None
-            token = urllib.parse.unquote(cookie).strip('"')
-            if token is None:
-                logger.error('access_token cookie not found')
+        credentials = get_credentials(request)
+        if credentials.source != SOURCE_COOKIE:
+            # the Authorization header took precedence when credentials were parsed
+            credentials = Credentials.from_cookie(request, app_user_id=credentials.app_user_id)
+            if credentials is None:
+                logger.debug('access_token cookie not found')
                 return None
-        except (AttributeError, IndexError):
-            logger.error('Malformed access_token cookie')
+        return self._get_user(request=request, token=credentials.token)
+
+
+class KairnialHeaderOrCookieAuthentication(TokenAthentication):
+    """
+    Clients authenticate either with the "Authorization" header or with the access_token cookie.
+    The credential source is chosen once, by KAIRNIAL_AUTH_CREDENTIAL_SOURCES priority
+    (header first by default), and the token is verified once.
+    The source used is reported in request.auth_source.
+    """
+
+    def authenticate(self, request):
+        """
+        Returns a two-tuple of `User` and token if a valid signature has been
+        supplied using JWT-based authentication, otherwise, returns `None`.
+        """
+        credentials = get_credentials(request)
+        if not credentials:
+            logger.debug('No token found in header nor cookie')
             return None
-        return self._get_user(request=request, token=token)
\ No newline at end of file
+        result = self._get_user(request=request, token=credentials.token)
+        if result is not None:
+            request.auth_source = credentials.source
+        return result
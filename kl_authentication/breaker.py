@@ -0,0 +1,202 @@
+"""
+Circuit breaker around the Kairnial auth server
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import record_circuit_transition
+
+logger = logging.getLogger('services')
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    Call rejected without reaching the endpoint
+    """
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"Circuit open for {endpoint}")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class _Circuit:
+    __slots__ = ('state', 'failures', 'opened_at', 'probing')
+
+    def __init__(self):
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+
+class CircuitBreaker:
+    """
+    Per endpoint circuit breaker, endpoints are any string: the auth server services use
+    one per grant type (KairnialAuthentication.circuit_endpoint)
+
+    An endpoint failing failure_threshold times in a row is opened: calls are rejected
+    with CircuitOpenError during cooldown seconds. Then a single probe call is let
+    through (half open), closing the circuit on success or opening it again on failure.
+
+    Listeners are called with (endpoint, old_state, new_state) on every transition,
+    transitions are recorded in the kl_auth_circuit_transitions metric by default.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._circuits = {}
+        self._lock = threading.Lock()
+        self.transitions = {}
+        self.rejections = 0
+        self.listeners = [record_circuit_transition]
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build circuit breaker from the KAIRNIAL_AUTH_CIRCUIT_BREAKER setting
+        :return: None if the circuit breaker is not configured
+        """
+        config = getattr(settings, 'KAIRNIAL_AUTH_CIRCUIT_BREAKER', None)
+        if not config:
+            return None
+        return cls(failure_threshold=config.get('FAILURE_THRESHOLD', 5), cooldown=config.get('COOLDOWN', 30))
+
+    def _circuit(self, endpoint: str) -> _Circuit:
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = self._circuits.setdefault(endpoint, _Circuit())
+        return circuit
+
+    def _transition(self, endpoint: str, circuit: _Circuit, state: str):
+        """
+        Change circuit state, called with the lock held, listeners are called after release
+        """
+        old_state = circuit.state
+        circuit.state = state
+        key = (endpoint, old_state, state)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        return key
+
+    def _notify(self, transition):
+        if transition is None:
+            return
+        endpoint, old_state, new_state = transition
+        logger.warning("Circuit for %s %s -> %s", endpoint, old_state, new_state,
+                       extra={'fields': {'endpoint': endpoint, 'circuit_state': new_state}})
+        for listener in self.listeners:
+            listener(endpoint, old_state, new_state)
+
+    def before_call(self, endpoint: str):
+        """
+        Check that a call to endpoint is allowed
+        :param endpoint: Endpoint URL
+        :raise CircuitOpenError: if the circuit is open or already probed
+        """
+        transition = None
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == STATE_CLOSED:
+                return
+            remaining = circuit.opened_at + self.cooldown - self._clock()
+            if circuit.state == STATE_OPEN and remaining <= 0:
+                transition = self._transition(endpoint, circuit, STATE_HALF_OPEN)
+            if circuit.state != STATE_HALF_OPEN or circuit.probing:
+                self.rejections += 1
+                raise CircuitOpenError(endpoint, retry_after=max(remaining, 1))
+            circuit.probing = True
+        self._notify(transition)
+
+    def record_success(self, endpoint: str):
+        """
+        Endpoint answered, close its circuit
+        :param endpoint: Endpoint URL
+        """
+        transition = None
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            circuit.failures = 0
+            circuit.probing = False
+            if circuit.state != STATE_CLOSED:
+                transition = self._transition(endpoint, circuit, STATE_CLOSED)
+        self._notify(transition)
+
+    def record_failure(self, endpoint: str):
+        """
+        Endpoint unreachable or failing, open its circuit after failure_threshold failures
+        or when the half open probe failed
+        :param endpoint: Endpoint URL
+        """
+        transition = None
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            circuit.failures += 1
+            circuit.probing = False
+            if circuit.state == STATE_HALF_OPEN or \
+                    (circuit.state == STATE_CLOSED and circuit.failures >= self.failure_threshold):
+                circuit.opened_at = self._clock()
+                transition = self._transition(endpoint, circuit, STATE_OPEN)
+        self._notify(transition)
+
+    def release(self, endpoint: str):
+        """
+        Call interrupted without outcome (cancelled...), let another probe through
+        :param endpoint: Endpoint URL
+        """
+        with self._lock:
+            self._circuit(endpoint).probing = False
+
+    def state(self, endpoint: str) -> str:
+        circuit = self._circuits.get(endpoint)
+        return circuit.state if circuit is not None else STATE_CLOSED
+
+    def stats(self) -> dict:
+        """
+        Circuit states and transition counters
+        :return:
+        """
+        return {
+            'states': {endpoint: circuit.state for endpoint, circuit in self._circuits.items()},
+            'transitions': dict(self.transitions),
+            'rejections': self.rejections,
+        }
+
+
+_circuit_breaker = None
+_circuit_breaker_loaded = False
+_circuit_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """
+    Process wide circuit breaker, None when KAIRNIAL_AUTH_CIRCUIT_BREAKER is not set
+    :return:
+    """
+    global _circuit_breaker, _circuit_breaker_loaded
+    if not _circuit_breaker_loaded:
+        with _circuit_breaker_lock:
+            if not _circuit_breaker_loaded:
+                _circuit_breaker = CircuitBreaker.from_settings()
+                _circuit_breaker_loaded = True
+    return _circuit_breaker
+
+
+def set_circuit_breaker(circuit_breaker: CircuitBreaker = None):
+    """
+    Replace the process wide circuit breaker, None rebuilds it from settings on next use
+    :param circuit_breaker:
+    :return:
+    """
+    global _circuit_breaker, _circuit_breaker_loaded
+    with _circuit_breaker_lock:
+        _circuit_breaker = circuit_breaker
+        _circuit_breaker_loaded = circuit_breaker is not None
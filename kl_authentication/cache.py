@@ -0,0 +1,193 @@
+"""
+Caches used by the authentication classes
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def token_digest(token: str, *parts) -> str:
+    """
+    Compute a digest of a token and its qualifiers (audience, ...)
+    so that raw tokens are never used as cache keys
+    :param token: Encoded JWT
+    :param parts: Additional values the cached result depends on
+    :return: hexadecimal digest
+    """
+    digest = hashlib.sha256(token.encode('utf-8'))
+    for part in parts:
+        digest.update(b'\x00')
+        digest.update(str(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache with a size limit and a per entry expiration timestamp
+    """
+
+    def __init__(self, max_size: int = 1024, clock=time.time):
+        self.max_size = max_size
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, key, default=None):
+        """
+        Get a live entry and mark it as recently used
+        :param key: Cache key
+        :param default: Value returned on miss
+        :return:
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= self._clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at: float = None):
+        """
+        Store an entry, evicting the least recently used ones above max_size
+        :param key: Cache key
+        :param value: Value to cache
+        :param expires_at: Absolute timestamp after which the entry is dropped
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """
+        Cache counters
+        :return:
+        """
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class SharedTokenCache:
+    """
+    Verified token claims stored in a Django cache, so that a token verified by one
+    worker is not verified again by the others.
+
+    Only the decoded claims dict is stored, keeping (un)pickling cheap. Any cache error
+    disables the tier for retry_after seconds, callers then verify tokens locally.
+    """
+    key_prefix = 'kl_auth:token:'
+
+    def __init__(self, cache_alias: str = 'default', retry_after: float = 30):
+        self.cache_alias = cache_alias
+        self.retry_after = retry_after
+        self._disabled_until = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build shared cache from the KAIRNIAL_AUTH_SHARED_TOKEN_CACHE setting
+        :return: None if the shared cache is not configured
+        """
+        config = getattr(settings, 'KAIRNIAL_AUTH_SHARED_TOKEN_CACHE', None)
+        if not config:
+            return None
+        return cls(cache_alias=config.get('CACHE_ALIAS', 'default'), retry_after=config.get('RETRY_AFTER', 30))
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self._disabled_until
+
+    def _failed(self, error: Exception):
+        self.errors += 1
+        self._disabled_until = time.monotonic() + self.retry_after
+        logging.getLogger('authentication').warning("Shared token cache unavailable for %ss: %s",
+                                                    self.retry_after, error)
+
+    def get(self, key: str):
+        """
+        Get verified claims
+        :param key: Token digest
+        :return: claims dict, None on miss or when the cache is unavailable
+        """
+        if not self.available:
+            return None
+        try:
+            claims = caches[self.cache_alias].get(self.key_prefix + key)
+        except Exception as e:
+            self._failed(e)
+            return None
+        if claims is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return claims
+
+    def set(self, key: str, claims: dict, expires_at: float):
+        """
+        Store verified claims until the token expires
+        :param key: Token digest
+        :param claims: Decoded token payload
+        :param expires_at: Absolute expiration timestamp
+        :return:
+        """
+        timeout = expires_at - time.time()
+        if timeout <= 0 or not self.available:
+            return
+        try:
+            caches[self.cache_alias].set(self.key_prefix + key, claims, timeout=timeout)
+        except Exception as e:
+            self._failed(e)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'available': self.available,
+        }
@@ -0,0 +1,201 @@
+"""
+Per client token verification settings
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import jwt
+from django.conf import settings
+
+logger = logging.getLogger('authentication')
+
+DEFAULT_ALGORITHMS = ('RS256',)
+
+
+class ClientOptions:
+    """
+    Verification options of a client_id, precomputed as jwt.decode arguments
+    """
+    __slots__ = ('client_id', 'issuer', 'audiences', 'key_ids', 'leeway', 'algorithms', 'decode_options')
+
+    def __init__(self, client_id: str, issuer: str = None, audiences=None, key_ids=None,
+                 leeway: float = 0, algorithms=DEFAULT_ALGORITHMS):
+        """
+        :param client_id: Kairnial client ID
+        :param issuer: Required iss claim, not checked when None
+        :param audiences: Accepted aud claims, the client_id by default
+        :param key_ids: Key ring kids allowed to sign the client tokens, any key when None
+        :param leeway: Seconds of tolerance on exp
+        :param algorithms: Allowed signature algorithms
+        """
+        self.client_id = client_id
+        self.issuer = issuer
+        self.audiences = list(audiences) if audiences else [client_id]
+        self.key_ids = frozenset(key_ids) if key_ids is not None else None
+        self.leeway = leeway
+        self.algorithms = list(algorithms)
+        self.decode_options = {
+            'algorithms': self.algorithms,
+            'audience': self.audiences,
+            'issuer': issuer,
+            'leeway': leeway,
+        }
+
+    @classmethod
+    def from_config(cls, client_id: str, config: dict):
+        return cls(
+            client_id=client_id,
+            issuer=config.get('ISSUER'),
+            audiences=config.get('AUDIENCES'),
+            key_ids=config.get('KEY_IDS'),
+            leeway=config.get('LEEWAY', 0),
+            algorithms=config.get('ALGORITHMS', DEFAULT_ALGORITHMS),
+        )
+
+    def check_key_id(self, kid: str):
+        """
+        :param kid: Token header kid
+        :raise jwt.InvalidTokenError: the key is not allowed for this client
+        """
+        if self.key_ids is not None and kid not in self.key_ids:
+            raise jwt.InvalidTokenError(f"Key {kid} is not allowed for client {self.client_id}")
+
+
+class ClientRegistry:
+    """
+    Client verification options indexed by client_id, from settings and an optional JSON file
+    ({"<client_id>": {"ISSUER": ..., "AUDIENCES": [...], ...}}) overriding them.
+
+    The file is reloaded by a background thread when its modification time changes,
+    request threads only read the current index. Unknown client ids are verified with
+    the default options (audience = client_id) unless strict is set.
+    """
+
+    def __init__(self, clients: dict = None, file: str = None, strict: bool = False, reload_interval: float = 30):
+        self.clients = clients or {}
+        self.file = file
+        self.strict = strict
+        self.reload_interval = reload_interval
+        self._index = {}
+        self._file_clients = {}
+        self._file_mtime = None
+        self.version = ''
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._build()
+        if file:
+            self.reload()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build registry from the KAIRNIAL_AUTH_CLIENTS setting
+        :return: None if the registry is not configured
+        """
+        config = getattr(settings, 'KAIRNIAL_AUTH_CLIENTS', None)
+        if not config:
+            return None
+        return cls(
+            clients=config.get('CLIENTS'),
+            file=config.get('FILE'),
+            strict=config.get('STRICT', False),
+            reload_interval=config.get('RELOAD_INTERVAL', 30),
+        )
+
+    def _build(self):
+        clients = dict(self.clients)
+        clients.update(self._file_clients)
+        index = {client_id: ClientOptions.from_config(client_id, config) for client_id, config in clients.items()}
+        # cached verifications are keyed by the version, a new configuration verifies tokens again
+        self.version = hashlib.sha256(json.dumps(clients, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        self._index = index
+
+    def reload(self) -> bool:
+        """
+        Reload the clients file if it changed
+        :return: True if the index was updated
+        """
+        with self._lock:
+            try:
+                mtime = os.stat(self.file).st_mtime_ns
+                if mtime == self._file_mtime:
+                    return False
+                with open(self.file, 'r') as fp:
+                    file_clients = json.load(fp)
+                if not isinstance(file_clients, dict):
+                    raise ValueError(f"{self.file} must hold an object indexed by client_id")
+                self._file_clients = file_clients
+                self._build()
+                self._file_mtime = mtime
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.error("Unable to load clients: %s", e)
+                return False
+            return True
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, client_id):
+        return client_id in self._index
+
+    def get(self, client_id: str):
+        """
+        :param client_id: Kairnial client ID
+        :return: ClientOptions, None for unknown clients
+        :raise jwt.InvalidAudienceError: unknown client of a strict registry
+        """
+        if self.file and self._pid != os.getpid():
+            self._ensure_thread()
+        options = self._index.get(client_id)
+        if options is None and self.strict:
+            raise jwt.InvalidAudienceError(f"Unknown client {client_id}")
+        return options
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._thread = threading.Thread(target=self._run, name='kl-clients', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.reload_interval)
+            self.reload()
+
+
+_client_registry = None
+_client_registry_loaded = False
+_client_registry_lock = threading.Lock()
+
+
+def get_client_registry():
+    """
+    Process wide client registry, None when KAIRNIAL_AUTH_CLIENTS is not set
+    :return:
+    """
+    global _client_registry, _client_registry_loaded
+    if not _client_registry_loaded:
+        with _client_registry_lock:
+            if not _client_registry_loaded:
+                _client_registry = ClientRegistry.from_settings()
+                _client_registry_loaded = True
+    return _client_registry
+
+
+def set_client_registry(client_registry: ClientRegistry = None):
+    """
+    Replace the process wide client registry, None rebuilds it from settings on next use
+    :param client_registry:
+    :return:
+    """
+    global _client_registry, _client_registry_loaded
+    with _client_registry_lock:
+        _client_registry = client_registry
+        _client_registry_loaded = client_registry is not None
@@ -0,0 +1,56 @@
+"""
+Settings resolved on first use instead of when modules are imported
+"""
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+_MISSING = object()
+_values = {}
+
+
+def setting(name: str, default=None):
+    """
+    Value of a setting, read once then cached until it is changed (override_settings)
+    :param name: Setting name
+    :param default: Value of a missing setting
+    :return:
+    """
+    value = _values.get(name, _MISSING)
+    if value is _MISSING:
+        value = _values[name] = getattr(settings, name, default)
+    return value
+
+
+def _setting_changed(setting, **kwargs):
+    _values.pop(setting, None)
+
+
+setting_changed.connect(_setting_changed)
+
+
+class LazySetting:
+    """
+    Class attribute built from settings on first access, then stored on the class defining it
+        token_cache = LazySetting(lambda: TTLCache(max_size=setting('KAIRNIAL_AUTH_TOKEN_CACHE', {}).get(...)))
+    Subclasses share the value, assigning the attribute replaces it as usual.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.owner = None
+        self.name = None
+        self._lock = threading.Lock()
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        with self._lock:
+            value = self.owner.__dict__.get(self.name)
+            if value is self:
+                value = self.factory()
+                setattr(self.owner, self.name, value)
+        return value
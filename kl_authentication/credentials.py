@@ -0,0 +1,98 @@
+"""
+Credentials carried by a request
+"""
+import urllib.parse
+
+from .conf import setting
+
+SOURCE_HEADER = 'header'
+SOURCE_COOKIE = 'cookie'
+DEFAULT_SOURCES = (SOURCE_HEADER, SOURCE_COOKIE)
+ACCESS_TOKEN_COOKIE = 'access_token'
+REQUEST_ATTRIBUTE = 'kl_credentials'
+
+
+class Credentials:
+    """
+    Token found on a request, with the header scheme, where it came from
+    and the M2M application user id
+    """
+    __slots__ = ('scheme', 'token', 'source', 'app_user_id')
+
+    def __init__(self, token: str = None, source: str = None, scheme: str = None, app_user_id: str = None):
+        self.token = token
+        self.source = source
+        self.scheme = scheme
+        self.app_user_id = app_user_id
+
+    def __bool__(self):
+        return self.token is not None
+
+    def __repr__(self):
+        return f"<Credentials: {self.source}>"
+
+    @classmethod
+    def from_header(cls, request, app_user_id: str = None):
+        """
+        Read token from the Authorization header, `<scheme> <token>`
+        :return: None if the header is missing or malformed
+        """
+        parts = request.META.get('HTTP_AUTHORIZATION', '').split()
+        if len(parts) < 2:
+            return None
+        return cls(token=parts[1], source=SOURCE_HEADER, scheme=parts[0], app_user_id=app_user_id)
+
+    @classmethod
+    def from_cookie(cls, request, app_user_id: str = None):
+        """
+        Read url encoded token from the access_token cookie
+        :return: None if the cookie is missing or empty
+        """
+        cookie = request.COOKIES.get(ACCESS_TOKEN_COOKIE)
+        if not cookie:
+            return None
+        token = urllib.parse.unquote(cookie).strip('"')
+        if not token:
+            return None
+        return cls(token=token, source=SOURCE_COOKIE, app_user_id=app_user_id)
+
+
+CREDENTIAL_READERS = {
+    SOURCE_HEADER: Credentials.from_header,
+    SOURCE_COOKIE: Credentials.from_cookie,
+}
+
+
+def credential_sources():
+    """
+    Credential sources by priority, KAIRNIAL_AUTH_CREDENTIAL_SOURCES or header first
+    """
+    return setting('KAIRNIAL_AUTH_CREDENTIAL_SOURCES', DEFAULT_SOURCES)
+
+
+def parse_credentials(request, sources=None) -> Credentials:
+    """
+    Parse request credentials, trying sources in order
+    :param request: Django or DRF request
+    :param sources: Credential sources by priority, KAIRNIAL_AUTH_CREDENTIAL_SOURCES by default
+    :return: Credentials, without token for anonymous requests
+    """
+    app_user_id = request.META.get('HTTP_X_APP_USER_ID')
+    for source in (sources if sources is not None else credential_sources()):
+        credentials = CREDENTIAL_READERS[source](request, app_user_id=app_user_id)
+        if credentials is not None:
+            return credentials
+    return Credentials(app_user_id=app_user_id)
+
+
+def get_credentials(request) -> Credentials:
+    """
+    Credentials attached by KairnialAuthMiddleware, parsed here when the middleware is not installed
+    :param request: Django or DRF request
+    :return:
+    """
+    credentials = getattr(request, REQUEST_ATTRIBUTE, None)
+    if credentials is None:
+        credentials = parse_credentials(request)
+        setattr(request, REQUEST_ATTRIBUTE, credentials)
+    return credentials
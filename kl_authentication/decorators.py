@@ -1,17 +1,41 @@
+import asyncio
 import functools
+import math
 
 from rest_framework import status
-from rest_framework.response import Response
 
 from . import JSON_CONTENT_TYPE
+from .responses import api_response, json_response
 from .services import KairnialAuthServiceError
 
 
+def _error_headers(error: KairnialAuthServiceError) -> dict:
+    """
+    Retry-After header when the circuit breaker rejected the call
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        return {}
+    return {'Retry-After': str(math.ceil(retry_after))}
+
+
 def handle_auth_ws_error(f):
     """
       Handle WS errors
+      Coroutine functions (async views, without DRF renderers) get a JsonResponse
     """
 
+    if asyncio.iscoroutinefunction(f):
+        @functools.wraps(f)
+        async def async_wrapper(request, *args, **kwargs):
+            try:
+                return await f(request, *args, **kwargs)
+            except (KairnialAuthServiceError) as e:
+                return json_response(e.error, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                     headers=_error_headers(e))
+
+        return async_wrapper
+
     @functools.wraps(f)
     def wrapper(request, *args, **kwargs):
         """
@@ -20,7 +44,7 @@ def handle_auth_ws_error(f):
         try:
             return f(request, *args, **kwargs)
         except (KairnialAuthServiceError) as e:
-            return Response(e.error, content_type=JSON_CONTENT_TYPE,
-                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            return api_response(e.error, content_type=JSON_CONTENT_TYPE,
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE, headers=_error_headers(e))
 
     return wrapper
@@ -0,0 +1,212 @@
+"""
+Cache of tokens issued by the Kairnial auth server
+"""
+import copy
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .cache import TTLCache
+
+logger = logging.getLogger('services')
+
+
+class LocalGrantCacheBackend:
+    """
+    In-process backend
+    """
+
+    def __init__(self, max_size: int = 256):
+        self._cache = TTLCache(max_size=max_size)
+
+    def get(self, key: str):
+        return self._cache.get(key)
+
+    def set(self, key: str, value, timeout: float):
+        self._cache.set(key, value, expires_at=time.time() + timeout)
+
+    def delete(self, key: str):
+        self._cache.delete(key)
+
+
+class DjangoGrantCacheBackend:
+    """
+    Backend storing entries in a Django cache, shared between workers
+
+    Any cache error disables the backend for retry_after seconds, grants are then
+    requested from the auth server.
+    """
+    key_prefix = 'kl_auth:grant:'
+
+    def __init__(self, cache_alias: str = 'default', retry_after: float = 30):
+        self.cache_alias = cache_alias
+        self.retry_after = retry_after
+        self._disabled_until = 0
+        self.errors = 0
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self._disabled_until
+
+    def _failed(self, error: Exception):
+        self.errors += 1
+        self._disabled_until = time.monotonic() + self.retry_after
+        logger.warning("Grant cache unavailable for %ss: %s", self.retry_after, error)
+
+    def get(self, key: str):
+        if not self.available:
+            return None
+        try:
+            return self.cache.get(self.key_prefix + key)
+        except Exception as e:
+            self._failed(e)
+            return None
+
+    def set(self, key: str, value, timeout: float):
+        if not self.available:
+            return
+        try:
+            self.cache.set(self.key_prefix + key, value, timeout=timeout)
+        except Exception as e:
+            self._failed(e)
+
+    def delete(self, key: str):
+        try:
+            self.cache.delete(self.key_prefix + key)
+        except Exception as e:
+            self._failed(e)
+
+
+GRANT_CACHE_BACKENDS = {
+    'local': LocalGrantCacheBackend,
+    'django': DjangoGrantCacheBackend,
+}
+
+
+class GrantCache:
+    """
+    Auth server responses kept until `expires_in` minus a safety margin
+
+    Entries are keyed by an HMAC (keyed with SECRET_KEY) of the grant credentials,
+    secrets are never stored nor used as plain text keys.
+    """
+
+    def __init__(self, backend, margin: float = 60):
+        self.backend = backend
+        self.margin = margin
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build grant cache from the KAIRNIAL_AUTH_GRANT_CACHE setting
+        :return: None if the cache is not configured
+        """
+        config = dict(getattr(settings, 'KAIRNIAL_AUTH_GRANT_CACHE', None) or {})
+        if not config:
+            return None
+        backend_class = GRANT_CACHE_BACKENDS[config.pop('BACKEND', 'local')]
+        margin = config.pop('MARGIN', 60)
+        return cls(backend=backend_class(**{k.lower(): v for k, v in config.items()}), margin=margin)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """
+        Derive cache key from grant credentials
+        :param parts: client_id, api_key, api_secret, scopes...
+        :return:
+        """
+        message = '\x00'.join(str(part) for part in parts).encode('utf-8')
+        return hmac.new(settings.SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+    def get(self, key: str):
+        """
+        Get a cached response with `expires_in` adjusted to the remaining lifetime
+        :param key: Cache key
+        :return: None on miss
+        """
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        response, expires_at = entry
+        remaining = int(expires_at - time.time())
+        if remaining <= self.margin:
+            return None
+        response = copy.deepcopy(response)
+        response['expires_in'] = remaining
+        return response
+
+    def set(self, key: str, response: dict):
+        """
+        Cache a response for its lifetime minus the safety margin
+        :param key: Cache key
+        :param response: Auth server response
+        :return:
+        """
+        try:
+            expires_in = int(response.get('expires_in'))
+        except (TypeError, ValueError):
+            return
+        timeout = expires_in - self.margin
+        if timeout <= 0:
+            return
+        self.backend.set(key, (copy.deepcopy(response), time.time() + expires_in), timeout=timeout)
+
+    def delete(self, key: str):
+        self.backend.delete(key)
+
+    async def aget(self, key: str):
+        """
+        get() from async code, remote backends are queried from a worker thread
+        """
+        if isinstance(self.backend, LocalGrantCacheBackend):
+            return self.get(key)
+        return await sync_to_async(self.get, thread_sensitive=False)(key)
+
+    async def aset(self, key: str, response: dict):
+        """
+        set() from async code, remote backends are updated from a worker thread
+        """
+        if isinstance(self.backend, LocalGrantCacheBackend):
+            return self.set(key, response)
+        return await sync_to_async(self.set, thread_sensitive=False)(key, response)
+
+
+_grant_cache = None
+_grant_cache_loaded = False
+_grant_cache_lock = threading.Lock()
+
+
+def get_grant_cache():
+    """
+    Process wide grant cache, None when KAIRNIAL_AUTH_GRANT_CACHE is not set
+    :return:
+    """
+    global _grant_cache, _grant_cache_loaded
+    if not _grant_cache_loaded:
+        with _grant_cache_lock:
+            if not _grant_cache_loaded:
+                _grant_cache = GrantCache.from_settings()
+                _grant_cache_loaded = True
+    return _grant_cache
+
+
+def set_grant_cache(grant_cache: GrantCache = None):
+    """
+    Replace the process wide grant cache, None rebuilds it from settings on next use
+    :param grant_cache:
+    :return:
+    """
+    global _grant_cache, _grant_cache_loaded
+    with _grant_cache_lock:
+        _grant_cache = grant_cache
+        _grant_cache_loaded = grant_cache is not None
@@ -0,0 +1,110 @@
+"""
+Batch token verification
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .authentication import TokenAthentication
+from .conf import setting
+
+
+def introspection_settings() -> dict:
+    """
+    KAIRNIAL_AUTH_INTROSPECTION setting
+    """
+    return setting('KAIRNIAL_AUTH_INTROSPECTION', {})
+
+
+class TokenIntrospector:
+    """
+    Verify batches of (token, audience) pairs with the TokenAthentication logic and caches
+
+    Identical pairs of a batch are verified once, verifications run in a thread pool
+    shared by all batches so that concurrent requests cannot exceed max_workers threads.
+    """
+
+    def __init__(self, authentication: TokenAthentication = None, max_workers: int = 4):
+        self.authentication = authentication or TokenAthentication()
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='kl-introspection')
+        return self._executor
+
+    def introspect_token(self, token: str, audience: str) -> dict:
+        """
+        Verify a token
+        :param token: Encoded JWT
+        :param audience: Expected audience (client_id)
+        :return: active flag, rejection reason and claims of active tokens
+        """
+        try:
+            claims = self.authentication.get_token_claims(token=token, audience=audience)
+        except Exception as e:
+            return {'active': False, 'reason': self.authentication.failure_reason(e), 'claims': None}
+        return {'active': True, 'reason': None, 'claims': claims}
+
+    def introspect(self, items):
+        """
+        Verify a batch
+        :param items: (token, audience) pairs
+        :return: iterator of results in the order of items
+        """
+        items = list(items)
+        if len(items) == 1:
+            yield self.introspect_token(*items[0])
+            return
+        futures = {}
+        for item in items:
+            if item not in futures:
+                futures[item] = self.executor.submit(self.introspect_token, *item)
+        try:
+            for item in items:
+                yield futures[item].result()
+        finally:
+            # client went away while streaming
+            for future in futures.values():
+                future.cancel()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+_introspector = None
+_introspector_lock = threading.Lock()
+
+
+def get_introspector() -> TokenIntrospector:
+    """
+    Process wide introspector, built from the KAIRNIAL_AUTH_INTROSPECTION setting on first use
+    :return:
+    """
+    global _introspector
+    if _introspector is None:
+        with _introspector_lock:
+            if _introspector is None:
+                _introspector = TokenIntrospector(max_workers=introspection_settings().get('MAX_WORKERS', 4))
+    return _introspector
+
+
+def set_introspector(introspector: TokenIntrospector = None):
+    """
+    Replace the process wide introspector, None rebuilds it on next use
+    :param introspector:
+    :return:
+    """
+    global _introspector
+    with _introspector_lock:
+        if _introspector is not None and _introspector is not introspector:
+            _introspector.shutdown()
+        _introspector = introspector
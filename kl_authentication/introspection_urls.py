@@ -0,0 +1,8 @@
+from django.urls import path
+
+from .views import TokenIntrospectionView
+
+# Token introspection, only served when included next to urls.py or async_urls.py
+urlpatterns = [
+    path('introspect', TokenIntrospectionView.as_view()),
+]
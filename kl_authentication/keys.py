@@ -0,0 +1,251 @@
+"""
+Public keys used to verify access tokens
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import jwt
+from django.conf import settings
+from jwt.algorithms import RSAAlgorithm
+
+logger = logging.getLogger('authentication')
+
+
+class KeyRing:
+    """
+    Parsed public keys indexed by key id (kid)
+
+    Static PEM keys are parsed once. Keys published as a JWKS, either in a local file or
+    at an URL, are reloaded by a background thread: the file when its modification time
+    changes, the URL with conditional requests (ETag / Last-Modified).
+    Request threads only read the current index and never wait for a reload: the JWKS
+    file is read when the ring is built, the URL is first fetched by the background thread.
+    """
+
+    def __init__(self, default_key: str = None, keys: dict = None, jwks_file: str = None,
+                 jwks_url: str = None, refresh_interval: float = 300, min_refresh_interval: float = 30,
+                 timeout: float = 5):
+        """
+        :param default_key: PEM public key used for tokens without (or with an unknown) kid
+        :param keys: PEM public keys indexed by kid
+        :param jwks_file: Path of a JWKS document
+        :param jwks_url: URL of a JWKS document
+        :param refresh_interval: Seconds between two background reloads
+        :param min_refresh_interval: Minimum seconds between two reloads triggered by an unknown kid
+        :param timeout: JWKS URL fetch timeout
+        """
+        self.jwks_file = jwks_file
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._static_keys = {kid: self.parse_pem(pem) for kid, pem in (keys or {}).items()}
+        self._default_key = self.parse_pem(default_key) if default_key else None
+        self._jwks_keys = {}
+        self._index = dict(self._static_keys)
+        self._file_mtime = None
+        self._etag = None
+        self._last_modified = None
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        if self.jwks_file:
+            self._refresh(fetch_url=False)
+        if self.jwks_url:
+            self._ensure_thread()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build key ring from KAIRNIAL_AUTH_PUBLIC_KEY and KAIRNIAL_AUTH_KEY_RING settings
+        :return:
+        """
+        config = getattr(settings, 'KAIRNIAL_AUTH_KEY_RING', {})
+        return cls(
+            default_key=getattr(settings, 'KAIRNIAL_AUTH_PUBLIC_KEY', None),
+            keys=config.get('KEYS'),
+            jwks_file=config.get('JWKS_FILE'),
+            jwks_url=config.get('JWKS_URL'),
+            refresh_interval=config.get('REFRESH_INTERVAL', 300),
+            min_refresh_interval=config.get('MIN_REFRESH_INTERVAL', 30),
+            timeout=config.get('TIMEOUT', 5),
+        )
+
+    @staticmethod
+    def parse_pem(pem):
+        """
+        Parse a PEM encoded RSA public key
+        :param pem: PEM string or bytes
+        :return: public key object
+        """
+        return RSAAlgorithm(RSAAlgorithm.SHA256).prepare_key(pem)
+
+    @property
+    def has_remote_keys(self) -> bool:
+        return bool(self.jwks_file or self.jwks_url)
+
+    @property
+    def key_ids(self):
+        return list(self._index.keys())
+
+    def __contains__(self, kid):
+        return kid in self._index
+
+    def get_key(self, token: str):
+        """
+        Select the verification key from the token header
+        :param token: Encoded JWT
+        :return: public key object
+        """
+        kid = jwt.get_unverified_header(token).get('kid')
+        return self.get_key_by_id(kid)
+
+    def get_key_by_id(self, kid: str = None, fallback: bool = True):
+        """
+        Get a key from its identifier, falling back to the default key
+        :param kid: Key identifier
+        :param fallback: Use the default key for a missing or unknown kid
+        :return: public key object
+        :raise jwt.InvalidKeyError: no key found
+        """
+        if self.has_remote_keys:
+            self._ensure_thread()
+        if kid is not None:
+            key = self._index.get(kid)
+            if key is not None:
+                return key
+            if self.has_remote_keys:
+                self.request_refresh()
+        if self._default_key is None or not fallback:
+            raise jwt.InvalidKeyError(f"No public key found for kid {kid}")
+        return self._default_key
+
+    def request_refresh(self):
+        """
+        Ask the background thread for an early reload, at most once per min_refresh_interval
+        """
+        if time.monotonic() - self._last_refresh >= self.min_refresh_interval:
+            self._wakeup.set()
+
+    def refresh(self):
+        """
+        Reload keys from the JWKS file and URL if they changed
+        :return: True if the index was updated
+        """
+        return self._refresh(fetch_url=True)
+
+    def _refresh(self, fetch_url: bool) -> bool:
+        with self._lock:
+            self._last_refresh = time.monotonic()
+            changed = False
+            try:
+                if self.jwks_file:
+                    changed |= self._refresh_file()
+                if self.jwks_url and fetch_url:
+                    changed |= self._refresh_url()
+            except (OSError, ValueError) as e:  # requests exceptions are OSError
+                logger.error("Unable to reload public keys: %s", e)
+            if changed:
+                index = dict(self._jwks_keys)
+                index.update(self._static_keys)
+                self._index = index
+            return changed
+
+    def _refresh_file(self) -> bool:
+        mtime = os.stat(self.jwks_file).st_mtime
+        if mtime == self._file_mtime:
+            return False
+        with open(self.jwks_file, 'r') as fp:
+            self._jwks_keys = self.parse_jwks(json.load(fp))
+        self._file_mtime = mtime
+        return True
+
+    def _refresh_url(self) -> bool:
+        import requests
+
+        headers = {}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+        response = requests.get(self.jwks_url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        self._jwks_keys = self.parse_jwks(response.json())
+        self._etag = response.headers.get('ETag')
+        self._last_modified = response.headers.get('Last-Modified')
+        return True
+
+    @staticmethod
+    def parse_jwks(jwks: dict) -> dict:
+        """
+        Parse JWKS document into key objects indexed by kid
+        :param jwks: JWKS document
+        :return:
+        """
+        if not isinstance(jwks, dict) or not isinstance(jwks.get('keys', []), list):
+            raise ValueError("Invalid JWKS document")
+        keys = {}
+        for jwk in jwks.get('keys', []):
+            try:
+                parsed = jwt.PyJWK(jwk)
+            except (jwt.PyJWTError, AttributeError, KeyError, TypeError, ValueError) as e:
+                logger.warning("Ignoring invalid JWK %s: %s", jwk.get('kid') if isinstance(jwk, dict) else None, e)
+                continue
+            if parsed.key_id:
+                keys[parsed.key_id] = parsed.key
+        return keys
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._thread = threading.Thread(target=self._run, name='kl-key-ring', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                # a malformed document must not stop the reloads
+                logger.exception("Unable to reload public keys")
+            self._wakeup.wait(self.refresh_interval)
+            self._wakeup.clear()
+
+
+_key_ring = None
+_key_ring_lock = threading.Lock()
+
+
+def get_key_ring() -> KeyRing:
+    """
+    Process wide key ring, built from settings on first use
+    :return:
+    """
+    global _key_ring
+    if _key_ring is None:
+        with _key_ring_lock:
+            if _key_ring is None:
+                _key_ring = KeyRing.from_settings()
+    return _key_ring
+
+
+def set_key_ring(key_ring: KeyRing = None):
+    """
+    Replace the process wide key ring, None rebuilds it from settings on next use
+    :param key_ring:
+    :return:
+    """
+    global _key_ring
+    with _key_ring_lock:
+        _key_ring = key_ring
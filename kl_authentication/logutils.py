@@ -0,0 +1,286 @@
+"""
+Logging helpers
+
+With KAIRNIAL_AUTH_LOGGING, the authentication and services loggers write through a
+bounded queue: request threads only enqueue records, formatting, redaction and output
+happen in a background thread, and records are dropped rather than waited for when
+the queue is full.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from collections.abc import Mapping
+
+REDACTED = '[redacted]'
+SENSITIVE_FIELDS = frozenset({
+    'access_token', 'api_key', 'api_secret', 'authorization', 'client_secret', 'cookie',
+    'id_token', 'password', 'refresh_token', 'token',
+})
+_BEARER = re.compile(r'(?i)(bearer\s+)[\w\-.~+/]+=*')
+
+
+def _secret_pattern(fields):
+    # "field": "value", 'field': 'value' and field=value forms
+    names = '|'.join(re.escape(field) for field in sorted(fields))
+    return re.compile(rf"""(?i)(["']?\b(?:{names})["']?\s*[:=]\s*["']?(?:bearer\s+)?)[^"'&\s,}}]+""")
+
+
+_SECRET = _secret_pattern(SENSITIVE_FIELDS)
+
+
+def redact(value, fields=SENSITIVE_FIELDS, pattern=_SECRET):
+    """
+    Copy of value with the values of sensitive fields replaced, in mappings and lists
+    or in JSON, repr and form encoded text
+    :param value: Log argument
+    :param fields: Lower case names of the sensitive fields
+    :param pattern: Regular expression matching fields and values in text
+    :return:
+    """
+    if isinstance(value, Mapping):
+        return {key: REDACTED if str(key).lower() in fields else redact(item, fields, pattern)
+                for key, item in value.items()}
+    if type(value) in (list, tuple, set):
+        return type(value)(redact(item, fields, pattern) for item in value)
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode('utf-8', 'replace')
+    if isinstance(value, str):
+        return _BEARER.sub(rf'\g<1>{REDACTED}', pattern.sub(rf'\g<1>{REDACTED}', value))
+    return value
+
+
+class Redacted:
+    """
+    Log argument redacted only when the message is formatted
+        logger.debug("Grant request %s", Redacted(payload))
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(redact(self.value))
+
+    __repr__ = __str__
+
+
+class AggregatingLogger:
+    """
+    Log a message at most once per interval and per reason, with the number
+    of occurrences since the previous report
+    """
+
+    def __init__(self, name: str, interval: float = 60, level: int = logging.ERROR):
+        self.logger = logging.getLogger(name)
+        self.interval = interval
+        self.level = level
+        self._counts = {}
+        self._last_report = {}
+        self._lock = threading.Lock()
+
+    def log(self, reason: str, message: str, *args):
+        """
+        Count an occurrence of reason, and log message if the last report is older than interval
+        :param reason: Aggregation key
+        :param message: Message to log, formatted with args only when it is reported
+        :param args: Message arguments
+        :return:
+        """
+        if self.interval <= 0:
+            self.logger.log(self.level, message, *args)
+            return
+        now = time.monotonic()
+        with self._lock:
+            count = self._counts.get(reason, 0) + 1
+            last_report = self._last_report.get(reason)
+            if last_report is not None and now - last_report < self.interval:
+                self._counts[reason] = count
+                return
+            self._counts[reason] = 0
+            self._last_report[reason] = now
+        extra = {'fields': {'reason': reason, 'occurrences': count}}
+        if count > 1:
+            self.logger.log(self.level, message + " (%d occurrences in the last %ds)", *args, count, self.interval,
+                            extra=extra)
+        else:
+            self.logger.log(self.level, message, *args, extra=extra)
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Format records as JSON lines, with the fields passed in extra={'fields': {...}}
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue records without formatting them and without ever blocking:
+    records are dropped and counted when the queue is full
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RedactingQueueListener(logging.handlers.QueueListener):
+    """
+    Queue listener redacting message arguments and fields before passing records to its handlers
+    """
+
+    def __init__(self, log_queue, *handlers, fields=SENSITIVE_FIELDS):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.fields = fields
+        self.pattern = _secret_pattern(fields)
+
+    def prepare(self, record):
+        record.msg = redact(record.msg, self.fields, self.pattern)
+        if isinstance(record.args, Mapping):
+            record.args = redact(record.args, self.fields, self.pattern)
+        elif record.args:
+            record.args = tuple(redact(arg, self.fields, self.pattern) for arg in record.args)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.fields = redact(fields, self.fields, self.pattern)
+        return record
+
+    def enqueue_sentinel(self):
+        # the queue may be full, wait for the listener to make room
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """
+    Move the handlers of the given loggers behind a QueueLogHandler and a RedactingQueueListener.
+    The listener writes to the handlers records reached before, including the ancestors ones (usually
+    the root logger handlers), a stderr handler, JSON formatted when structured is set, is only added
+    when there are none.
+    """
+
+    def __init__(self, logger_names=('authentication', 'services'), queue_size: int = 10000,
+                 structured: bool = True, redact_fields=()):
+        self.loggers = [logging.getLogger(name) for name in logger_names]
+        self.queue_size = queue_size
+        self.structured = structured
+        self.fields = SENSITIVE_FIELDS | {field.lower() for field in redact_fields}
+        self.handler = None
+        self.listener = None
+        self._targets = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, config: dict):
+        """
+        Build pipeline from the KAIRNIAL_AUTH_LOGGING setting
+        """
+        return cls(
+            logger_names=config.get('LOGGERS', ('authentication', 'services')),
+            queue_size=config.get('QUEUE_SIZE', 10000),
+            structured=config.get('STRUCTURED', True),
+            redact_fields=config.get('REDACT_FIELDS', ()),
+        )
+
+    def install(self):
+        """
+        Replace the logger handlers and start the listener thread
+        :return: self
+        """
+        targets = []
+        for logger in self.loggers:
+            targets.extend(handler for handler in self.effective_handlers(logger) if handler not in targets)
+        if not targets:
+            handler = logging.StreamHandler()
+            if self.structured:
+                handler.setFormatter(StructuredFormatter())
+            targets.append(handler)
+        self._targets = targets
+        self.handler = QueueLogHandler(queue.Queue(self.queue_size))
+        self.handler.addFilter(self._ensure_listener)
+        for logger in self.loggers:
+            logger.handlers = [self.handler]
+            logger.propagate = False
+        self._start()
+        atexit.register(self.stop)
+        return self
+
+    @staticmethod
+    def effective_handlers(logger: logging.Logger) -> list:
+        """
+        Handlers a record of logger is passed to, as walked by Logger.callHandlers
+        :param logger:
+        :return: handlers of the logger and of its ancestors up to the first one not propagating
+        """
+        handlers = []
+        while logger is not None:
+            handlers.extend(handler for handler in logger.handlers if handler not in handlers)
+            if not logger.propagate:
+                break
+            logger = logger.parent
+        return handlers
+
+    def _start(self):
+        self._pid = os.getpid()
+        self.listener = RedactingQueueListener(self.handler.queue, *self._targets, fields=self.fields)
+        self.listener.start()
+
+    def _ensure_listener(self, record) -> bool:
+        # the listener thread does not survive a fork, start one in the child
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.handler.queue = queue.Queue(self.queue_size)
+                    self._start()
+        return True
+
+    @property
+    def dropped(self) -> int:
+        return self.handler.dropped if self.handler is not None else 0
+
+    def stop(self):
+        """
+        Flush queued records and stop the listener thread
+        """
+        with self._lock:
+            if self.listener is not None and self.listener._thread is not None and self._pid == os.getpid():
+                self.listener.stop()
+
+
+def install_log_pipeline(config: dict):
+    """
+    Install the logging pipeline described by the KAIRNIAL_AUTH_LOGGING setting
+    :param config: Setting value
+    :return: LogPipeline
+    """
+    return LogPipeline.from_settings(config).install()
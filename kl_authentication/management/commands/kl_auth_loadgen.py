@@ -0,0 +1,147 @@
+"""
+Load generator for the token views
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncRequestFactory, RequestFactory, override_settings
+
+from ...testing import StubAuthServer
+from ...transport import set_transport
+from ...views import AsyncClientlessAPIKeyAuthenticationView, AsyncClientlessPasswordAuthenticationView, \
+    AsyncClientlessRefreshTokenAuthenticationView, ClientlessAPIKeyAuthenticationView, \
+    ClientlessPasswordAuthenticationView, ClientlessRefreshTokenAuthenticationView
+
+ENDPOINTS = {
+    'password': (ClientlessPasswordAuthenticationView, AsyncClientlessPasswordAuthenticationView,
+                 lambda i: {'email': f'user{i}@example.com', 'password': 'password'}),
+    'key': (ClientlessAPIKeyAuthenticationView, AsyncClientlessAPIKeyAuthenticationView,
+            lambda i: {'api_key': f'key{i}', 'api_secret': 'secret'}),
+    'renew': (ClientlessRefreshTokenAuthenticationView, AsyncClientlessRefreshTokenAuthenticationView,
+              lambda i: {'refresh_token': f'refresh{i}'}),
+}
+
+
+class Command(BaseCommand):
+    help = "Drive the password, key or renew token views concurrently against a stub auth server " \
+           "and report throughput, latency distribution and errors"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', choices=sorted(ENDPOINTS), default='password')
+        parser.add_argument('--requests', type=int, default=1000, help="Total number of requests")
+        parser.add_argument('--concurrency', type=int, default=10, help="Number of workers")
+        parser.add_argument('--mode', choices=('thread', 'async'), default='thread',
+                            help="Thread workers calling the sync views or asyncio tasks awaiting the async views")
+        parser.add_argument('--server', help="Auth server URL, an in-process stub is started by default")
+        parser.add_argument('--latency', type=float, default=0, help="Stub response delay in seconds")
+        parser.add_argument('--error-rate', type=float, default=0, help="Fraction of stub responses failing")
+        parser.add_argument('--client-id', default='loadgen')
+        parser.add_argument('--unique-credentials', action='store_true',
+                            help="Send different credentials in each request, defeating grant caches and coalescing")
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency must be at least 1")
+        if options['requests'] < 0:
+            raise CommandError("--requests must not be negative")
+        stub = None
+        server = options['server']
+        if server is None:
+            stub = StubAuthServer(latency=options['latency'], error_rate=options['error_rate'],
+                                  record_requests=False).start()
+            server = stub.url
+        try:
+            with override_settings(KAIRNIAL_AUTH_SERVER=server):
+                set_transport(None)
+                if options['mode'] == 'async':
+                    results, duration = asyncio.run(self.run_async(options))
+                else:
+                    results, duration = self.run_threads(options)
+        finally:
+            set_transport(None)
+            if stub is not None:
+                stub.stop()
+        self.report(results, duration)
+
+    @staticmethod
+    def make_body(options, index: int) -> str:
+        body = ENDPOINTS[options['endpoint']][2]
+        return json.dumps(body(index if options['unique_credentials'] else 0))
+
+    def run_threads(self, options):
+        """
+        :return: list of (status, seconds), total duration
+        """
+        view = ENDPOINTS[options['endpoint']][0].as_view()
+        factory = RequestFactory()
+        counter = itertools.count()
+        lock = threading.Lock()
+        results = []
+
+        def worker():
+            while True:
+                with lock:
+                    index = next(counter)
+                if index >= options['requests']:
+                    return
+                request = factory.post('/', data=self.make_body(options, index), content_type='application/json')
+                start = time.perf_counter()
+                try:
+                    status = view(request, client_id=options['client_id']).status_code
+                except Exception as e:
+                    status = type(e).__name__
+                results.append((status, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            for _ in range(options['concurrency']):
+                executor.submit(worker)
+        return results, time.perf_counter() - start
+
+    async def run_async(self, options):
+        """
+        :return: list of (status, seconds), total duration
+        """
+        view = ENDPOINTS[options['endpoint']][1].as_view()
+        factory = AsyncRequestFactory()
+        counter = itertools.count()
+        results = []
+
+        async def worker():
+            for index in counter:
+                if index >= options['requests']:
+                    return
+                request = factory.post('/', data=self.make_body(options, index), content_type='application/json')
+                start = time.perf_counter()
+                try:
+                    status = (await view(request, client_id=options['client_id'])).status_code
+                except Exception as e:
+                    status = type(e).__name__
+                results.append((status, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(options['concurrency'])))
+        return results, time.perf_counter() - start
+
+    def report(self, results: list, duration: float):
+        if not results:
+            self.stdout.write("No request sent")
+            return
+        latencies = sorted(latency for _, latency in results)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write(f"requests    {len(results)} in {duration:.2f}s")
+        self.stdout.write(f"throughput  {len(results) / duration:.1f} req/s")
+        self.stdout.write(f"latency ms  mean {sum(latencies) / len(latencies) * 1000:.2f}  "
+                          f"p50 {percentile(0.5):.2f}  p90 {percentile(0.9):.2f}  "
+                          f"p99 {percentile(0.99):.2f}  max {latencies[-1] * 1000:.2f}")
+        for status, count in sorted(Counter(str(status) for status, _ in results).items()):
+            self.stdout.write(f"status {status:12} {count}")
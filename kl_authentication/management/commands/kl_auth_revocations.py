@@ -0,0 +1,41 @@
+"""
+Build the revoked tokens file
+"""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...revocation import jti_revocation_id, token_revocation_id, write_revocation_file
+
+
+def read_lines(path: str):
+    with open(path, 'r') as fp:
+        return [line.strip() for line in fp if line.strip() and not line.startswith('#')]
+
+
+class Command(BaseCommand):
+    help = "Write the revoked tokens file read by KAIRNIAL_AUTH_REVOCATION from token ids (jti) " \
+           "and encoded tokens, replacing the previous file atomically"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Revocation file, KAIRNIAL_AUTH_REVOCATION['FILE']")
+        parser.add_argument('--jti', action='append', default=[], help="Revoked token id")
+        parser.add_argument('--jti-file', action='append', default=[], help="File with one revoked token id per line")
+        parser.add_argument('--token', action='append', default=[], help="Revoked encoded token")
+        parser.add_argument('--token-file', action='append', default=[],
+                            help="File with one revoked encoded token per line")
+        parser.add_argument('--bits-per-entry', type=int, default=16,
+                            help="Bloom filter size, more bits mean fewer digest lookups")
+
+    def handle(self, *args, **options):
+        if options['bits_per_entry'] < 1:
+            raise CommandError("--bits-per-entry must be positive")
+        try:
+            jtis = options['jti'] + [jti for path in options['jti_file'] for jti in read_lines(path)]
+            tokens = options['token'] + [token for path in options['token_file'] for token in read_lines(path)]
+        except OSError as e:
+            raise CommandError(str(e))
+        revocation_ids = [jti_revocation_id(jti) for jti in jtis] + [token_revocation_id(token) for token in tokens]
+        count = write_revocation_file(options['output'], revocation_ids, bits_per_entry=options['bits_per_entry'])
+        self.stdout.write(f"Wrote {count} revoked entries to {options['output']} "
+                          f"({os.path.getsize(options['output'])} bytes)")
@@ -0,0 +1,251 @@
+"""
+Counters and latency histograms, exported in the Prometheus text format
+
+Metrics are recorded only when KAIRNIAL_AUTH_METRICS['ENABLED'] is set, otherwise
+every call returns immediately. The setting is applied by AuthenticationConfig.ready().
+"""
+import abc
+import contextlib
+import threading
+import time
+
+from .conf import setting
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def metrics_settings() -> dict:
+    """
+    KAIRNIAL_AUTH_METRICS setting
+    """
+    return setting('KAIRNIAL_AUTH_METRICS', {})
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labelnames, values, extra: str = '') -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metric(abc.ABC):
+    """
+    Base metric, values are stored per label values tuple
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(), enabled: bool = False):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.enabled = enabled
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    @abc.abstractmethod
+    def samples(self):
+        """
+        :return: list of (suffix, label string, value)
+        """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Monotonic counter
+    """
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('_total', _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (seconds) in cumulative buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), enabled: bool = False,
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames=labelnames, enabled=enabled)
+        self.set_buckets(buckets)
+
+    def set_buckets(self, buckets):
+        """
+        Replace the bucket bounds, observed values are dropped
+        """
+        with self._lock:
+            self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+            self._values.clear()
+
+    def observe(self, value: float, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+
+    @contextlib.contextmanager
+    def _timer(self, labels: dict):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def time(self, **labels):
+        """
+        Context manager observing the duration of its block
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timer(labels)
+
+    def count(self, **labels) -> int:
+        counts = self._values.get(self._key(labels))
+        return sum(counts[0]) if counts is not None else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = sorted((key, (list(counts[0]), counts[1])) for key, counts in self._values.items())
+        for key, (buckets, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, buckets):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                samples.append(('_bucket', _format_labels(self.labelnames, key, le), cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Set of metrics rendered together
+    """
+
+    def __init__(self, enabled: bool = False, buckets=DEFAULT_BUCKETS):
+        self._enabled = enabled
+        self.buckets = buckets
+        self._metrics = {}
+        self._default_buckets = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled: bool):
+        self._enabled = enabled
+        for metric in self._metrics.values():
+            metric.enabled = enabled
+
+    def _register(self, metric: Metric) -> Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames=labelnames, enabled=self._enabled))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=None) -> Histogram:
+        if buckets is None:
+            self._default_buckets.add(name)
+        return self._register(Histogram(name, documentation, labelnames=labelnames, enabled=self._enabled,
+                                        buckets=buckets or self.buckets))
+
+    def configure(self, enabled: bool = False, buckets=DEFAULT_BUCKETS):
+        """
+        Enable or disable the metrics and set the buckets of histograms created without their own
+        """
+        if tuple(buckets) != tuple(self.buckets):
+            self.buckets = buckets
+            for name in self._default_buckets:
+                self._metrics[name].set_buckets(buckets)
+        self.enabled = enabled
+
+    def configure_from_settings(self):
+        """
+        Apply the KAIRNIAL_AUTH_METRICS setting
+        """
+        config = metrics_settings()
+        self.configure(enabled=config.get('ENABLED', False), buckets=config.get('BUCKETS', DEFAULT_BUCKETS))
+
+    def clear(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format
+        :return:
+        """
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+TOKEN_VERIFY_SECONDS = REGISTRY.histogram(
+    'kl_auth_token_verify_seconds', "JWT pre-check, signature and claims verification time")
+TOKEN_CACHE = REGISTRY.counter(
+    'kl_auth_token_cache', "Token cache lookups", labelnames=('tier', 'result'))
+AUTH_FAILURES = REGISTRY.counter(
+    'kl_auth_failures', "Rejected tokens by reason", labelnames=('reason',))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'kl_auth_upstream_seconds', "Auth server call duration by grant", labelnames=('grant',))
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    'kl_auth_upstream_responses', "Auth server responses by grant and status", labelnames=('grant', 'status'))
+CIRCUIT_TRANSITIONS = REGISTRY.counter(
+    'kl_auth_circuit_transitions', "Circuit breaker state transitions",
+    labelnames=('endpoint', 'from_state', 'to_state'))
+
+
+def record_circuit_transition(endpoint: str, old_state: str, new_state: str):
+    """
+    Circuit breaker listener
+    """
+    CIRCUIT_TRANSITIONS.inc(endpoint=endpoint, from_state=old_state, to_state=new_state)
@@ -1,18 +1,45 @@
 """
 Kairnial authentication middleware
 """
+import asyncio
 import logging
 
+from django.conf import settings
 from django.contrib.auth import authenticate
 
+from .credentials import REQUEST_ATTRIBUTE, SOURCE_HEADER, parse_credentials
+from .timing import TIMING_PARSE, SamplingProfiler, add_server_timing, start_timings, stop_timings, timed
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+logger = logging.getLogger('authentication')
+
 
 class KairnialAuthMiddleware(object):
     """
     Check the jwt token passed by the request
+    Runs natively in both WSGI (sync) and ASGI (async) middleware chains
+
+    With KAIRNIAL_AUTH_SERVER_TIMING, responses get a Server-Timing header with the time
+    spent parsing credentials, verifying the token and calling the auth server.
+    With KAIRNIAL_AUTH_PROFILE, one request with credentials out of SAMPLE_RATE is profiled.
     """
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.server_timing = getattr(settings, 'KAIRNIAL_AUTH_SERVER_TIMING', False)
+        self.profiler = SamplingProfiler.from_settings()
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
 
     @staticmethod
     def jwt_get_username_from_payload_handler(payload):
@@ -21,18 +48,50 @@ class KairnialAuthMiddleware(object):
         return username
 
     def __call__(self, request):
-        # GET TOKEN
-        logger = logging.getLogger('authentication')
+        if self.is_async:
+            return self.__acall__(request)
+        timings_token = start_timings() if self.server_timing else None
         try:
-            logger.debug("adding token and user attributes to request")
-            request.token = request.META.get('HTTP_AUTHORIZATION').split()[1]
-            request.user_id = request.META.get('HTTP_X_APP_USER_ID')
-        except (AttributeError, IndexError) as e:
-            logger.warning(str(e))
-            pass
-        response = self.get_response(request)
+            with timed(TIMING_PARSE):
+                self.add_credentials(request)
+            if self._sample(request):
+                response = self.profiler.profile(self.get_response, request)
+            else:
+                response = self.get_response(request)
+        finally:
+            timings = stop_timings(timings_token) if timings_token is not None else None
+        if timings:
+            add_server_timing(response, timings)
         return response
 
+    async def __acall__(self, request):
+        timings_token = start_timings() if self.server_timing else None
+        try:
+            with timed(TIMING_PARSE):
+                self.add_credentials(request)
+            if self._sample(request):
+                response = await self.profiler.aprofile(self.get_response, request)
+            else:
+                response = await self.get_response(request)
+        finally:
+            timings = stop_timings(timings_token) if timings_token is not None else None
+        if timings:
+            add_server_timing(response, timings)
+        return response
+
+    def _sample(self, request) -> bool:
+        return self.profiler is not None and bool(getattr(request, REQUEST_ATTRIBUTE)) and self.profiler.sample()
+
+    @staticmethod
+    def add_credentials(request):
+        # GET TOKEN
+        credentials = parse_credentials(request)
+        setattr(request, REQUEST_ATTRIBUTE, credentials)
+        if credentials.source == SOURCE_HEADER:
+            logger.debug("adding token and user attributes to request")
+            request.token = credentials.token
+            request.user_id = credentials.app_user_id
+
     @staticmethod
     def process_view(request, view_func, view_args, view_kwargs):
         client_id = view_kwargs.get('client_id', None)
@@ -1,7 +1,13 @@
 """
 OpenAPI extensions
+
+drf_spectacular registers the extensions when this module is imported, which happens when
+the kl_authentication views are loaded, when one of the preprocessing hooks below is
+configured, or at startup with KAIRNIAL_AUTH_OPENAPI_EAGER.
 """
 from django.conf import settings
+
+from .credentials import ACCESS_TOKEN_COOKIE, SOURCE_COOKIE, credential_sources
 from drf_spectacular.extensions import OpenApiAuthenticationExtension
 from drf_spectacular.plumbing import build_bearer_security_scheme_object
 
@@ -19,6 +25,28 @@ class TokenScheme(OpenApiAuthenticationExtension):
         )
 
 
+class HeaderOrCookieTokenScheme(TokenScheme):
+    """
+    Token passed either in the Authorization header or in the access_token cookie
+    """
+    target_class = 'kl_authentication.authentication.KairnialHeaderOrCookieAuthentication'
+    name = [TokenScheme.name, 'Cookie token authentication']
+
+    def get_security_requirement(self, auto_schema):
+        # alternatives (OR), by credential source priority
+        requirements = [{self.name[0]: []}, {self.name[1]: []}]
+        sources = credential_sources()
+        if sources and sources[0] == SOURCE_COOKIE:
+            requirements.reverse()
+        return requirements
+
+    def get_security_definition(self, auto_schema):
+        return [
+            super().get_security_definition(auto_schema),
+            {'type': 'apiKey', 'in': 'cookie', 'name': ACCESS_TOKEN_COOKIE},
+        ]
+
+
 def preprocess_exclude_clientless_routes(endpoints, **kwargs):
     """
         preprocessing hook that filters out {format} suffixed paths, in case
@@ -30,3 +58,11 @@ def preprocess_exclude_clientless_routes(endpoints, **kwargs):
         for path, path_regex, method, callback in endpoints
         if client_id_path in path
     ]
+
+
+def preprocess_register_extensions(endpoints, **kwargs):
+    """
+        preprocessing hook registering the authentication extensions (when importing this module)
+        before the schema is generated, endpoints are left untouched.
+    """
+    return endpoints
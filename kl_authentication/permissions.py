@@ -0,0 +1,43 @@
+"""
+Scope based permission classes
+"""
+from rest_framework.permissions import BasePermission
+
+from .scopes import SCOPES
+
+
+def HasScopes(*scopes):  # noqa: N802
+    """
+    Permission class granting access to tokens holding all the scopes
+        permission_classes = [HasScopes('documents:read', 'documents:write')]
+    :param scopes: Required scope names
+    :return: BasePermission subclass
+    """
+    required = SCOPES.mask(scopes, register=True)
+
+    class ScopesPermission(BasePermission):
+        message = f"Token scopes must include {' '.join(scopes)}"
+
+        def has_permission(self, request, view):
+            return getattr(request, 'auth_scopes', 0) & required == required
+
+    ScopesPermission.__name__ = ScopesPermission.__qualname__ = f"HasScopes({', '.join(scopes)})"
+    return ScopesPermission
+
+
+def HasAnyScope(*scopes):  # noqa: N802
+    """
+    Permission class granting access to tokens holding at least one of the scopes
+    :param scopes: Accepted scope names
+    :return: BasePermission subclass
+    """
+    accepted = SCOPES.mask(scopes, register=True)
+
+    class AnyScopePermission(BasePermission):
+        message = f"Token scopes must include one of {' '.join(scopes)}"
+
+        def has_permission(self, request, view):
+            return getattr(request, 'auth_scopes', 0) & accepted != 0
+
+    AnyScopePermission.__name__ = AnyScopePermission.__qualname__ = f"HasAnyScope({', '.join(scopes)})"
+    return AnyScopePermission
@@ -0,0 +1,44 @@
+"""
+Cheap token checks run before signature verification
+"""
+import base64
+import binascii
+import json
+import time
+
+import jwt
+
+
+def _decode_segment(segment: str):
+    try:
+        return json.loads(base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4)))
+    except (ValueError, binascii.Error):
+        raise jwt.DecodeError("Invalid token segment encoding")
+
+
+def precheck_token(token: str, algorithms, max_length: int = 8192, leeway: float = 0):
+    """
+    Reject tokens that cannot be valid without verifying their signature:
+    oversized, wrong number of segments, algorithm not allowed or already expired.
+    Claims are not verified, they must not be trusted.
+    :param token: Encoded JWT
+    :param algorithms: Allowed header `alg` values
+    :param max_length: Maximum token size
+    :param leeway: Seconds of tolerance on exp
+    :return: unverified (header, payload)
+    """
+    if len(token) > max_length:
+        raise jwt.DecodeError("Token too large")
+    segments = token.split('.')
+    if len(segments) != 3:
+        raise jwt.DecodeError("Not enough segments")
+    header = _decode_segment(segments[0])
+    if not isinstance(header, dict) or header.get('alg') not in algorithms:
+        raise jwt.InvalidAlgorithmError("The specified alg value is not allowed")
+    payload = _decode_segment(segments[1])
+    if not isinstance(payload, dict):
+        raise jwt.DecodeError("Invalid payload")
+    exp = payload.get('exp')
+    if isinstance(exp, (int, float)) and exp <= time.time() - leeway:
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return header, payload
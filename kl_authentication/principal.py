@@ -0,0 +1,157 @@
+"""
+Authenticated principal
+"""
+from django.contrib.auth import get_user_model
+
+from .conf import setting
+
+PRINCIPAL_LIGHTWEIGHT = 'lightweight'
+PRINCIPAL_MODEL = 'model'
+
+
+class KairnialUser:
+    """
+    Immutable user built from token claims, exposing the attributes
+    DRF and permission classes expect from request.user
+    """
+    __slots__ = ('uuid', 'email', 'first_name', 'last_name')
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+    is_staff = False
+    is_superuser = False
+
+    def __init__(self, uuid: str = None, email: str = '', first_name: str = '', last_name: str = ''):
+        object.__setattr__(self, 'uuid', uuid)
+        object.__setattr__(self, 'email', email)
+        object.__setattr__(self, 'first_name', first_name)
+        object.__setattr__(self, 'last_name', last_name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return type(self), (self.uuid, self.email, self.first_name, self.last_name)
+
+    def __eq__(self, other):
+        return isinstance(other, KairnialUser) and self.uuid == other.uuid
+
+    def __hash__(self):
+        return hash(self.uuid)
+
+    def __str__(self):
+        return self.email or ''
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self.uuid}>"
+
+    @property
+    def pk(self):
+        return self.uuid
+
+    @property
+    def id(self):
+        return self.uuid
+
+    @property
+    def username(self):
+        return self.email
+
+    @property
+    def full_name(self):
+        return self.get_full_name()
+
+    def get_username(self):
+        return self.email
+
+    def get_full_name(self):
+        return f"{self.first_name} {self.last_name}".strip()
+
+    def get_short_name(self):
+        return self.first_name
+
+    def has_perm(self, perm, obj=None):
+        return False
+
+    def has_perms(self, perm_list, obj=None):
+        return False
+
+    def has_module_perms(self, module):
+        return False
+
+
+class LazyKairnialUser(KairnialUser):
+    """
+    KairnialUser keeping the decoded claims and materializing its fields
+    on first attribute access
+    """
+    __slots__ = ('_claims',)
+
+    def __init__(self, claims: dict):
+        object.__setattr__(self, '_claims', claims)
+
+    def __getattr__(self, name):
+        # only called while the field slots are still unset
+        if name not in KairnialUser.__slots__:
+            raise AttributeError(name)
+        self._materialize()
+        return object.__getattribute__(self, name)
+
+    def __reduce__(self):
+        return type(self), (self._claims,)
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self._claims.get('sub')}>"
+
+    @property
+    def claims(self) -> dict:
+        return self._claims
+
+    def _materialize(self):
+        claims = self._claims
+        object.__setattr__(self, 'uuid', claims.get('sub'))
+        object.__setattr__(self, 'email', (claims.get('email') or '').strip())
+        object.__setattr__(self, 'first_name', '')
+        object.__setattr__(self, 'last_name', claims.get('name') or '')
+
+
+def build_user(uuid: str, email: str = '', first_name: str = '', last_name: str = ''):
+    """
+    Build the principal set on request.user
+    KAIRNIAL_AUTH_PRINCIPAL = 'model' builds an unsaved instance of the user model instead
+    :param uuid: User unique identifier
+    :param email: User email
+    :param first_name: User first name
+    :param last_name: User last name
+    :return:
+    """
+    if setting('KAIRNIAL_AUTH_PRINCIPAL', PRINCIPAL_LIGHTWEIGHT) != PRINCIPAL_MODEL:
+        return KairnialUser(uuid=uuid, email=email, first_name=first_name, last_name=last_name)
+    user = get_user_model()(
+        first_name=first_name,
+        last_name=last_name,
+        email=email
+    )
+    user.uuid = uuid
+    return user
+
+
+def build_token_user(claims: dict):
+    """
+    Build the principal from verified token claims
+    With KAIRNIAL_AUTH_LAZY_USER, fields are only extracted from the claims when accessed
+    :param claims: Decoded token payload
+    :return:
+    """
+    lightweight = setting('KAIRNIAL_AUTH_PRINCIPAL', PRINCIPAL_LIGHTWEIGHT) != PRINCIPAL_MODEL
+    if lightweight and setting('KAIRNIAL_AUTH_LAZY_USER', False):
+        return LazyKairnialUser(claims)
+    return build_user(
+        uuid=claims.get('sub'),
+        first_name='',
+        last_name=claims.get('name') or '',
+        email=(claims.get('email') or '').strip()
+    )
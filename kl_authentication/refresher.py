@@ -0,0 +1,305 @@
+"""
+Background renewal of tokens issued by the Kairnial auth server
+"""
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import token_digest
+
+logger = logging.getLogger('services')
+
+GRANT_SECRETS = 'api_key'
+GRANT_REFRESH = 'refresh_token'
+
+
+class ManagedToken:
+    """
+    Token kept valid by a TokenRefresher
+    """
+
+    def __init__(self, refresher, key: str, client_id: str, grant: str, credentials: dict):
+        self.refresher = refresher
+        self.key = key
+        self.client_id = client_id
+        self.grant = grant
+        self.credentials = credentials
+        self.response = None
+        self.expires_at = 0
+        self.due = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at <= time.time()
+
+    def get(self) -> dict:
+        """
+        Current auth server response, renewed synchronously only if it has expired
+        :return:
+        """
+        self.last_used = time.time()
+        if self.response is None or self.expired:
+            self.refresher.renew(self, expired_only=True)
+        return self.response
+
+    @property
+    def access_token(self) -> str:
+        return self.get().get('access_token')
+
+
+class TokenRefresher:
+    """
+    Renew registered tokens lead_time seconds before they expire, minus a random
+    delay of up to jitter seconds so that workers holding the same token do not
+    renew it at once. Tokens lasting less than twice lead_time are renewed at half life.
+
+    Renewals run in a background thread, request threads only wait when a token has
+    expired. With a shared grant cache, API key grants renewed by one worker are picked
+    up by the others instead of being renewed again. Failed renewals are retried every
+    retry_interval seconds, tokens unused for idle_timeout seconds are dropped instead of
+    renewed. Responses without a positive expires_in are assumed to last default_lifetime seconds.
+
+    Grants returned by the key endpoints are only registered with register_grants, other
+    tokens are registered explicitly (register_secrets, register_refresh).
+    """
+
+    def __init__(self, lead_time: float = 300, jitter: float = 60, retry_interval: float = 30,
+                 idle_timeout: float = 3600, max_tokens: int = 1000, register_grants: bool = False,
+                 default_lifetime: float = 300):
+        self.lead_time = lead_time
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self.default_lifetime = default_lifetime
+        self.idle_timeout = idle_timeout
+        self.max_tokens = max_tokens
+        self.register_grants = register_grants
+        self._tokens = {}
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self.renewals = 0
+        self.failures = 0
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build refresher from the KAIRNIAL_AUTH_REFRESHER setting
+        :return: None if the refresher is not configured
+        """
+        config = getattr(settings, 'KAIRNIAL_AUTH_REFRESHER', None)
+        if not config:
+            return None
+        return cls(
+            lead_time=config.get('LEAD_TIME', 300),
+            jitter=config.get('JITTER', 60),
+            retry_interval=config.get('RETRY_INTERVAL', 30),
+            idle_timeout=config.get('IDLE_TIMEOUT', 3600),
+            max_tokens=config.get('MAX_TOKENS', 1000),
+            register_grants=config.get('REGISTER_GRANTS', False),
+            default_lifetime=config.get('DEFAULT_LIFETIME', 300),
+        )
+
+    def register_secrets(self, client_id: str, api_key: str, api_secret: str, response: dict = None,
+                         key: str = None) -> ManagedToken:
+        """
+        Keep the token of an API key / secret grant valid
+        :param client_id: Kairnial client ID
+        :param api_key: User API key
+        :param api_secret: User API secret
+        :param response: Auth server response already obtained, fetched when None
+        :param key: Registration key, a digest of the credentials by default
+        :return:
+        """
+        key = key or token_digest(api_secret, GRANT_SECRETS, client_id, api_key)
+        credentials = {'api_key': api_key, 'api_secret': api_secret}
+        return self._register(key, client_id, GRANT_SECRETS, credentials, response)
+
+    def register_refresh(self, client_id: str, refresh_token: str, provider_uuid: str = None,
+                         response: dict = None) -> ManagedToken:
+        """
+        Keep a user token valid with its refresh token, rotated refresh tokens are followed
+        :param client_id: Kairnial client ID
+        :param refresh_token: Refresh token
+        :param provider_uuid: Authentication provider identifier
+        :param response: Auth server response already obtained, fetched when None
+        :return:
+        """
+        key = token_digest(refresh_token, GRANT_REFRESH, client_id, provider_uuid)
+        credentials = {'refresh_token': refresh_token, 'provider_uuid': provider_uuid}
+        return self._register(key, client_id, GRANT_REFRESH, credentials, response)
+
+    def _register(self, key: str, client_id: str, grant: str, credentials: dict, response: dict = None):
+        with self._condition:
+            token = self._tokens.get(key)
+            if token is None:
+                if len(self._tokens) >= self.max_tokens:
+                    logger.warning("Token refresher holds %d tokens, not registering more", self.max_tokens)
+                    return ManagedToken(self, key, client_id, grant, credentials)
+                token = self._tokens[key] = ManagedToken(self, key, client_id, grant, credentials)
+        token.last_used = time.time()
+        if response is not None:
+            self._update(token, response)
+        elif token.response is None:
+            self.renew(token)
+        self._ensure_thread()
+        return token
+
+    def unregister(self, key: str):
+        with self._condition:
+            self._tokens.pop(key, None)
+
+    def touch(self, key: str):
+        """
+        Mark a registered token as used
+        :param key: Registration key
+        """
+        token = self._tokens.get(key)
+        if token is not None:
+            token.last_used = time.time()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def _next_renewal(self, expires_in: float) -> float:
+        lead_time = min(self.lead_time, expires_in / 2)
+        jitter = min(self.jitter, expires_in / 4)
+        return time.time() + max(expires_in - lead_time - random.uniform(0, jitter), 1)
+
+    def _schedule_renewal(self, token: ManagedToken, due: float):
+        with self._condition:
+            token.due = due
+            heapq.heappush(self._schedule, (due, next(self._sequence), token.key))
+            self._condition.notify()
+
+    def _update(self, token: ManagedToken, response: dict):
+        try:
+            expires_in = float(response.get('expires_in'))
+        except (TypeError, ValueError):
+            expires_in = 0
+        if expires_in <= 0:
+            # otherwise the token would be renewed synchronously on every use
+            expires_in = self.default_lifetime
+        if token.grant == GRANT_REFRESH and response.get('refresh_token'):
+            token.credentials['refresh_token'] = response['refresh_token']
+        token.response = response
+        token.expires_at = time.time() + expires_in
+        self._schedule_renewal(token, self._next_renewal(expires_in))
+
+    def renew(self, token: ManagedToken, expired_only: bool = False):
+        """
+        Renew token now, concurrent callers wait for a single renewal
+        :param token: Managed token
+        :param expired_only: Do nothing if another caller renewed it meanwhile
+        :return:
+        """
+        from .services import KairnialAuthentication
+
+        with token.lock:
+            if expired_only and token.response is not None and not token.expired:
+                return
+            ka = KairnialAuthentication(client_id=token.client_id)
+            try:
+                if token.grant == GRANT_SECRETS:
+                    # a grant outliving ours was renewed by another worker, through the grant cache
+                    response = ka.secrets_authentication(refresh=True, min_lifetime=token.expires_at - time.time(),
+                                                         **token.credentials)
+                else:
+                    response = ka.refresh_authentication(**token.credentials)
+            except Exception as e:
+                self.failures += 1
+                logger.warning("Token renewal failed: %s", e, extra={'fields': {'grant': token.grant}})
+                self._schedule_renewal(token, time.time() + self.retry_interval * random.uniform(1, 1.5))
+                raise
+            self.renewals += 1
+            self._update(token, response)
+
+    def run_pending(self):
+        """
+        Renew tokens that are due, drop idle ones
+        :return: seconds until the next renewal, None if nothing is scheduled
+        """
+        while True:
+            with self._condition:
+                if not self._schedule:
+                    return None
+                due, _, key = self._schedule[0]
+                now = time.time()
+                if due > now:
+                    return due - now
+                heapq.heappop(self._schedule)
+                token = self._tokens.get(key)
+                if token is None or token.due != due:
+                    continue
+                if now - token.last_used > self.idle_timeout:
+                    del self._tokens[key]
+                    continue
+            try:
+                self.renew(token)
+            except Exception:
+                pass
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._condition:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._thread = threading.Thread(target=self._run, name='kl-token-refresher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self.run_pending()
+            with self._condition:
+                delay = self._schedule[0][0] - time.time() if self._schedule else None
+                if delay is None or delay > 0:
+                    self._condition.wait(delay)
+
+    def stats(self) -> dict:
+        return {
+            'tokens': len(self._tokens),
+            'renewals': self.renewals,
+            'failures': self.failures,
+        }
+
+
+_refresher = None
+_refresher_loaded = False
+_refresher_lock = threading.Lock()
+
+
+def get_refresher():
+    """
+    Process wide token refresher, None when KAIRNIAL_AUTH_REFRESHER is not set
+    :return:
+    """
+    global _refresher, _refresher_loaded
+    if not _refresher_loaded:
+        with _refresher_lock:
+            if not _refresher_loaded:
+                _refresher = TokenRefresher.from_settings()
+                _refresher_loaded = True
+    return _refresher
+
+
+def set_refresher(refresher: TokenRefresher = None):
+    """
+    Replace the process wide token refresher, None rebuilds it from settings on next use
+    :param refresher:
+    :return:
+    """
+    global _refresher, _refresher_loaded
+    with _refresher_lock:
+        _refresher = refresher
+        _refresher_loaded = refresher is not None
@@ -0,0 +1,140 @@
+"""
+Fast path for the token and error responses
+
+With KAIRNIAL_AUTH_FAST_RESPONSES, payloads are projected from the trusted auth server
+dicts with field plans precomputed from the serializers, instead of running DRF field
+by field serialization, and encoded with orjson when it is installed. The output is
+the same, the serializers still describe the OpenAPI schema.
+"""
+import json
+from collections.abc import Mapping
+
+from django.http import HttpResponse, JsonResponse
+from rest_framework import fields, serializers
+from rest_framework.response import Response
+
+from . import JSON_CONTENT_TYPE
+from .conf import setting
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# to_representation of these fields is str() / int() of the value
+_CONVERTERS = {
+    fields.CharField: str,
+    fields.EmailField: str,
+    fields.IntegerField: int,
+}
+
+_plans = {}
+
+
+class _FieldPlan:
+    __slots__ = ('name', 'key', 'field', 'convert', 'nested', 'many')
+
+    def __init__(self, field):
+        self.name = field.field_name
+        self.field = field
+        # dotted or '*' sources go through DRF attribute resolution
+        self.key = field.source if len(field.source_attrs) == 1 else None
+        self.many = isinstance(field, serializers.ListSerializer)
+        self.nested = None
+        if self.many and isinstance(field.child, serializers.Serializer):
+            self.nested = _compile(field.child)
+        elif isinstance(field, serializers.Serializer):
+            self.nested = _compile(field)
+        self.convert = _CONVERTERS.get(type(field))
+        if self.convert is None and isinstance(field, fields.UUIDField) and field.uuid_format == 'hex_verbose':
+            self.convert = str
+        if self.convert is None:
+            self.convert = field.to_representation
+
+
+def _compile(serializer) -> list:
+    return [_FieldPlan(field) for field in serializer._readable_fields]
+
+
+def _plan(serializer_class) -> list:
+    plan = _plans.get(serializer_class)
+    if plan is None:
+        plan = _plans[serializer_class] = _compile(serializer_class())
+    return plan
+
+
+def _project(plan: list, instance) -> dict:
+    ret = {}
+    for field_plan in plan:
+        if field_plan.key is not None and isinstance(instance, Mapping) and field_plan.key in instance:
+            value = instance[field_plan.key]
+        else:
+            try:
+                value = field_plan.field.get_attribute(instance)
+            except fields.SkipField:
+                continue
+        if value is None:
+            ret[field_plan.name] = None
+        elif field_plan.nested is None:
+            ret[field_plan.name] = field_plan.convert(value)
+        elif field_plan.many:
+            ret[field_plan.name] = [_project(field_plan.nested, item) for item in value]
+        else:
+            ret[field_plan.name] = _project(field_plan.nested, value)
+    return ret
+
+
+def project(serializer_class, instance) -> dict:
+    """
+    Same output as serializer_class(instance).data, from a precomputed field plan
+    :param serializer_class: Serializer describing the payload
+    :param instance: Dict (or object) to serialize
+    :return:
+    """
+    return _project(_plan(serializer_class), instance)
+
+
+def serialize(serializer_class, instance) -> dict:
+    """
+    Serialize instance with the fast path when enabled
+    """
+    if setting('KAIRNIAL_AUTH_FAST_RESPONSES', False):
+        return project(serializer_class, instance)
+    return serializer_class(instance).data
+
+
+def render_json(data) -> bytes:
+    """
+    Encode data as compact JSON, with orjson when installed
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+class FastJsonResponse(HttpResponse):
+    """
+    JSON response encoded without DRF renderers
+    """
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', JSON_CONTENT_TYPE)
+        super().__init__(content=render_json(data), **kwargs)
+
+
+def api_response(data, status: int = 200, content_type: str = None, headers: dict = None):
+    """
+    Response of DRF views, bypassing content negotiation and renderers when the fast path is enabled
+    """
+    if setting('KAIRNIAL_AUTH_FAST_RESPONSES', False):
+        return FastJsonResponse(data, status=status, headers=headers)
+    return Response(data, content_type=content_type, status=status, headers=headers)
+
+
+def json_response(data, status: int = 200, headers: dict = None):
+    """
+    Response of plain Django (async) views
+    """
+    if setting('KAIRNIAL_AUTH_FAST_RESPONSES', False):
+        return FastJsonResponse(data, status=status, headers=headers)
+    return JsonResponse(data, status=status, headers=headers)
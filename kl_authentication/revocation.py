@@ -0,0 +1,262 @@
+"""
+Revoked tokens
+
+Revoked token ids (jti) and tokens are stored in a file holding a Bloom filter and the
+sorted digests of the revoked entries. Workers map the file read only, so they share its
+pages, and check the filter first: a negative answer is final, a positive one is confirmed
+by a binary search of the digests.
+
+File layout (little endian):
+    header      magic, version, hashes per entry, filter words, entries
+    filter      64 bits words, all the bits of an entry are set in a single word
+    digests     sorted 16 bytes digests of the entries
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+import jwt
+from django.conf import settings
+
+logger = logging.getLogger('authentication')
+
+MAGIC = b'KLRV'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQ8x')
+BLOOM_HASHES = 8
+DIGEST_SIZE = 16
+
+
+class TokenRevokedError(jwt.InvalidTokenError):
+    pass
+
+
+def fingerprint(revocation_id: str) -> tuple:
+    """
+    Digest of a revoked entry with its filter word and bit mask, computed once per token
+    :param revocation_id: jti_revocation_id or token_revocation_id
+    :return: (digest, word selector, mask)
+    """
+    digest = hashlib.blake2b(revocation_id.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+    bits = int.from_bytes(digest[8:], 'little')
+    mask = 0
+    for _ in range(BLOOM_HASHES):
+        mask |= 1 << (bits & 63)
+        bits >>= 6
+    return digest, int.from_bytes(digest[:8], 'little'), mask
+
+
+def jti_revocation_id(jti) -> str:
+    return f'jti:{jti}'
+
+
+def token_revocation_id(token: str) -> str:
+    return f'token:{token}'
+
+
+def token_fingerprints(token: str, payload: dict) -> tuple:
+    """
+    Fingerprints a token can be revoked by: the token itself and its jti claim
+    :param token: Encoded JWT
+    :param payload: Decoded claims
+    :return:
+    """
+    jti = payload.get('jti')
+    if jti is None:
+        return fingerprint(token_revocation_id(token)),
+    return fingerprint(token_revocation_id(token)), fingerprint(jti_revocation_id(jti))
+
+
+def write_revocation_file(path: str, revocation_ids, bits_per_entry: int = 16) -> int:
+    """
+    Write a revocation file, atomically replacing the previous one
+    :param path: Destination
+    :param revocation_ids: jti_revocation_id or token_revocation_id values
+    :param bits_per_entry: Filter size, 16 bits give about 0.5% false positives
+    :return: number of entries
+    """
+    fingerprints = sorted({fingerprint(revocation_id) for revocation_id in revocation_ids})
+    words = array('Q', [0]) * max(1, -(-len(fingerprints) * bits_per_entry // 64))
+    for _, selector, mask in fingerprints:
+        words[selector % len(words)] |= mask
+    if sys.byteorder != 'little':
+        words.byteswap()
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.revocations-', delete=False) as fp:
+        try:
+            fp.write(HEADER.pack(MAGIC, VERSION, BLOOM_HASHES, len(words), len(fingerprints)))
+            fp.write(words.tobytes())
+            fp.write(b''.join(digest for digest, _, _ in fingerprints))
+            fp.flush()
+            os.fsync(fp.fileno())
+        except BaseException:
+            os.unlink(fp.name)
+            raise
+    # readers keep mapping the previous inode until they reload
+    os.chmod(fp.name, 0o644)
+    os.replace(fp.name, path)
+    return len(fingerprints)
+
+
+class _RevocationFile:
+    """
+    Read only mapping of a revocation file
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size:
+            raise ValueError(f"{path} is not a revocation file")
+        magic, version, hashes, self.words, self.count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION or hashes != BLOOM_HASHES:
+            raise ValueError(f"{path} is not a version {VERSION} revocation file")
+        self.digests_offset = HEADER.size + self.words * 8
+        if self.words < 1 or len(self._mmap) != self.digests_offset + self.count * DIGEST_SIZE:
+            raise ValueError(f"{path} is truncated")
+        if sys.byteorder == 'little':
+            # indexing the mapped words directly avoids a slice and int conversion per check
+            self._filter = memoryview(self._mmap)[HEADER.size:self.digests_offset].cast('Q')
+        else:
+            self._filter = array('Q', self._mmap[HEADER.size:self.digests_offset])
+            self._filter.byteswap()
+
+    def might_contain(self, fp: tuple) -> bool:
+        mask = fp[2]
+        return self._filter[fp[1] % self.words] & mask == mask
+
+    def contains(self, digest: bytes) -> bool:
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = self.digests_offset + middle * DIGEST_SIZE
+            value = self._mmap[start:start + DIGEST_SIZE]
+            if value == digest:
+                return True
+            if value < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+
+class RevocationList:
+    """
+    Revoked tokens loaded from a file written by the kl_auth_revocations command
+
+    A background thread reloads the file every reload_interval seconds when its inode,
+    size or modification time changed. Request threads only read the current mapping.
+    If the file cannot be loaded the error is logged and the previous list is kept.
+    """
+
+    def __init__(self, path: str, reload_interval: float = 5):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._file = None
+        self._stat = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.reload()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build revocation list from the KAIRNIAL_AUTH_REVOCATION setting
+        :return: None if revocation is not configured
+        """
+        config = getattr(settings, 'KAIRNIAL_AUTH_REVOCATION', None)
+        if not config:
+            return None
+        return cls(path=config['FILE'], reload_interval=config.get('RELOAD_INTERVAL', 5))
+
+    def __len__(self):
+        revocation_file = self._file
+        return revocation_file.count if revocation_file is not None else 0
+
+    def reload(self) -> bool:
+        """
+        Map the file again if it changed
+        :return: True if the list was updated
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+                key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                if key == self._stat:
+                    return False
+                self._file = _RevocationFile(self.path)
+                self._stat = key
+            except (OSError, ValueError) as e:
+                logger.error("Unable to load revoked tokens: %s", e)
+                return False
+            logger.info("Loaded %d revoked tokens from %s", self._file.count, self.path)
+            return True
+
+    def is_revoked(self, fingerprints: tuple) -> bool:
+        """
+        :param fingerprints: token_fingerprints of a token
+        :return: True if the token or its jti is revoked
+        """
+        if self._pid != os.getpid() and self.reload_interval:
+            self._ensure_thread()
+        revocation_file = self._file
+        if revocation_file is None:
+            return False
+        for fp in fingerprints:
+            if revocation_file.might_contain(fp) and revocation_file.contains(fp[0]):
+                return True
+        return False
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._pid = pid
+                self._thread = threading.Thread(target=self._run, name='kl-revocations', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.reload_interval)
+            self.reload()
+
+
+_revocation_list = None
+_revocation_list_loaded = False
+_revocation_list_lock = threading.Lock()
+
+
+def get_revocation_list():
+    """
+    Process wide revocation list, None when KAIRNIAL_AUTH_REVOCATION is not set
+    :return:
+    """
+    global _revocation_list, _revocation_list_loaded
+    if not _revocation_list_loaded:
+        with _revocation_list_lock:
+            if not _revocation_list_loaded:
+                _revocation_list = RevocationList.from_settings()
+                _revocation_list_loaded = True
+    return _revocation_list
+
+
+def set_revocation_list(revocation_list: RevocationList = None):
+    """
+    Replace the process wide revocation list, None rebuilds it from settings on next use
+    :param revocation_list:
+    :return:
+    """
+    global _revocation_list, _revocation_list_loaded
+    with _revocation_list_lock:
+        _revocation_list = revocation_list
+        _revocation_list_loaded = revocation_list is not None
@@ -0,0 +1,88 @@
+"""
+Token scopes as bitmasks
+"""
+import logging
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+class ScopeRegistry:
+    """
+    Assign a bit to each scope name, so that a set of scopes is an int and checking
+    required scopes is one bitwise operation.
+
+    Scopes get their bit when first registered, by the settings, a permission class or
+    a verified token, so masks computed earlier stay valid. Masks of scope claims are
+    interned: a claim value seen before is not parsed again.
+    """
+
+    def __init__(self, scopes=(), max_scopes: int = 1024, max_interned: int = 4096):
+        self.max_scopes = max_scopes
+        self.max_interned = max_interned
+        self._bits = {}
+        self._masks = {}
+        self._lock = threading.Lock()
+        self.mask(scopes, register=True)
+
+    def __len__(self):
+        return len(self._bits)
+
+    def bit(self, scope: str, register: bool = False) -> int:
+        """
+        :param scope: Scope name
+        :param register: Raise instead of ignoring the scope when the registry is full
+        :return: bit of the scope, 0 if it cannot be registered
+        """
+        bit = self._bits.get(scope)
+        if bit is not None:
+            return bit
+        with self._lock:
+            bit = self._bits.get(scope)
+            if bit is None:
+                if len(self._bits) >= self.max_scopes:
+                    if register:
+                        raise ImproperlyConfigured(f"More than {self.max_scopes} scopes registered")
+                    logging.getLogger('authentication').warning("Scope registry full, ignoring scope %s", scope)
+                    return 0
+                bit = self._bits[scope] = 1 << len(self._bits)
+        return bit
+
+    def mask(self, scopes, register: bool = False) -> int:
+        """
+        :param scopes: Scope names
+        :param register: Raise when a scope cannot be registered, required scopes must be
+        :return: bitmask of the scopes
+        """
+        mask = 0
+        for scope in scopes:
+            mask |= self.bit(scope, register=register)
+        return mask
+
+    def parse(self, claim) -> int:
+        """
+        Bitmask of a token scope claim
+        :param claim: Space separated string or list of scope names
+        :return: 0 for a missing claim
+        """
+        if not claim:
+            return 0
+        key = claim if isinstance(claim, str) else tuple(claim)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = self.mask(claim.split() if isinstance(claim, str) else claim)
+            if len(self._masks) >= self.max_interned:
+                self._masks.clear()
+            self._masks[key] = mask
+        return mask
+
+    def names(self, mask: int) -> list:
+        """
+        :param mask: Bitmask
+        :return: scope names set in mask
+        """
+        return [scope for scope, bit in self._bits.items() if mask & bit]
+
+
+# KAIRNIAL_AUTHENTICATION_SCOPES are registered by AuthenticationConfig.ready()
+SCOPES = ScopeRegistry()
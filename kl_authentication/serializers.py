@@ -83,3 +83,40 @@ class AuthResponseSerializer(serializers.Serializer):
     )
     expires_in = serializers.IntegerField(label=_("Number of seconds before token exipiration"))
     scope = serializers.CharField(label=_("Functions accessible using this token"))
+
+
+class TokenIntrospectionItemSerializer(serializers.Serializer):
+    token = serializers.CharField(label=_("Token"), help_text=_("Encoded JWT to verify"))
+    audience = serializers.CharField(
+        label=_("Audience"), required=False,
+        help_text=_("Client ID the token was issued for, the client ID of the URL by default")
+    )
+
+
+class TokenIntrospectionSerializer(serializers.Serializer):
+    """
+    Batch of tokens to verify
+    """
+    tokens = TokenIntrospectionItemSerializer(many=True, label=_("Tokens"))
+
+    def validate_tokens(self, value):
+        max_batch = self.context.get('max_batch')
+        if max_batch and len(value) > max_batch:
+            raise serializers.ValidationError(_(f"At most {max_batch} tokens per batch"))
+        return value
+
+
+class TokenIntrospectionResultSerializer(serializers.Serializer):
+    active = serializers.BooleanField(label=_("Token is valid"))
+    reason = serializers.CharField(
+        label=_("Rejection reason"), allow_null=True,
+        help_text=_("expired, claims or invalid, null for active tokens")
+    )
+    claims = serializers.DictField(label=_("Token claims"), allow_null=True)
+
+
+class TokenIntrospectionResponseSerializer(serializers.Serializer):
+    """
+    Verification results, in the order of the submitted tokens
+    """
+    results = TokenIntrospectionResultSerializer(many=True)
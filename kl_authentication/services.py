@@ -3,18 +3,31 @@ Kairnial auth services
 """
 import json
 import logging
+import time
 
-import requests
 from django.conf import settings
-from django.contrib.auth.models import User
 from django.utils.translation import gettext as _
 
 from . import JSON_CONTENT_TYPE
+from .breaker import CircuitOpenError, get_circuit_breaker
+from .cache import TTLCache, token_digest
+from .conf import LazySetting, setting
+from .grants import get_grant_cache
+from .logutils import Redacted
+from .metrics import UPSTREAM_RESPONSES, UPSTREAM_SECONDS
+from .principal import build_user
+from .refresher import get_refresher
+from .responses import serialize
 from .serializers import AuthServiceErrorSerializer
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .timing import TIMING_UPSTREAM, timed
+from .transport import Transport, TransportError, get_transport
 
 PASSWORD_LOGIN_PATH = '/api/oauth2/login'
 API_AUTHENT_PATH = '/api/oauth2/client_credentials/{clientID}'
 
+logger = logging.getLogger('services')
+
 
 class KairnialAuthServiceError(Exception):
     _message = _("Error fetching data from Kairnial WebServices")
@@ -26,16 +39,26 @@ class KairnialAuthServiceError(Exception):
 
     @property
     def error(self):
-        return AuthServiceErrorSerializer({
+        return serialize(AuthServiceErrorSerializer, {
             'service_status': self._status,
             'service_message': self._message
-        }).data
+        })
 
     @property
     def status(self):
         return self._status
 
 
+class KairnialAuthServiceUnavailable(KairnialAuthServiceError):
+    """
+    Auth server call rejected by the circuit breaker
+    """
+
+    def __init__(self, message, retry_after: float):
+        super().__init__(message=message, status=503)
+        self.retry_after = retry_after
+
+
 class KairnialAuthentication:
     """
     Kairnial aauthentication class
@@ -44,9 +67,16 @@ class KairnialAuthentication:
     token = None
     user = None
     client_id = None
+    transport = None
+    refresh_flight = SingleFlight()
+    arefresh_flight = AsyncSingleFlight()
+    refresh_results = LazySetting(
+        lambda: TTLCache(max_size=setting('KAIRNIAL_AUTH_REFRESH_COALESCING', {}).get('MAX_SIZE', 1024)))
+    refresh_result_ttl = LazySetting(lambda: setting('KAIRNIAL_AUTH_REFRESH_COALESCING', {}).get('RESULT_TTL', 0))
 
-    def __init__(self, client_id: str):
+    def __init__(self, client_id: str, transport: Transport = None):
         self.client_id = client_id
+        self.transport = transport or get_transport()
 
     def password_authentication(self, username: str, password: str) -> dict:
         """
@@ -55,113 +85,327 @@ class KairnialAuthentication:
         :param password: User password
         :return:
         """
-        payload = {
-            'client_id': self.client_id,
-            'scope': " ".join(settings.KAIRNIAL_AUTHENTICATION_SCOPES),
-            'grant_type': 'password',
-            'password': password,
-            'username': username,
-        }
-        headers = {'Content-type': 'application/x-www-form-urlencoded'}
-        response = requests.post(
-            settings.KAIRNIAL_AUTH_SERVER + PASSWORD_LOGIN_PATH,
-            headers=headers,
-            data=payload
-        )
-        if response.status_code != 200:
-            raise KairnialAuthServiceError(
-                message=_(f"Authentication failed with code {response.status_code}: {response.content}"),
-                status=response.status_code
-            )
+        return self._request_token(payload=self._password_payload(username, password), form_encoded=True)
 
-        try:
-            resp = response.json()
-            self._extract_token(resp)
-            self._extract_token_type(resp)
-            self._extract_user(resp)
-            return resp
-        except json.JSONDecodeError:
-            raise KairnialAuthServiceError(
-                message="Invalid response from server",
-                status=400
-            )
+    async def apassword_authentication(self, username: str, password: str) -> dict:
+        """
+        Async version of password_authentication
+        """
+        return await self._arequest_token(payload=self._password_payload(username, password), form_encoded=True)
 
-    def secrets_authentication(self, api_key: str, api_secret: str) -> dict:
+    def secrets_authentication(self, api_key: str, api_secret: str, refresh: bool = False,
+                               min_lifetime: float = None) -> dict:
         """
-        Get auth token from auth server
+        Get auth token from auth server, or from the grant cache when configured
+        Cached grants are registered with the token refresher when REGISTER_GRANTS is set
         :param api_key: User API Key
         :param api_secret: User API Secret
+        :param refresh: Bypass the grant cache lookup and store the new token
+        :param min_lifetime: With refresh, return instead a cached grant lasting more than
+            min_lifetime seconds, renewed meanwhile by another worker
         :return:
         """
-        logger = logging.getLogger('services')
-        payload = {
-            'grant_type': 'api_key',
-            'scope': " ".join(settings.KAIRNIAL_AUTHENTICATION_SCOPES),
-            'client_id': self.client_id,
-            'api_key': api_key,
-            'api_secret': api_secret
+        payload = self._secrets_payload(api_key, api_secret)
+        grant_cache = get_grant_cache()
+        if grant_cache is None:
+            return self._request_token(payload=payload)
+        cache_key = grant_cache.make_key(self.client_id, api_key, api_secret, payload['scope'])
+        resp = None
+        if not refresh or min_lifetime is not None:
+            resp = self._usable_grant(grant_cache.get(cache_key), refresh, min_lifetime)
+        if resp is not None:
+            self._extract_response(resp)
+            if not refresh:
+                self._touch_refresher(cache_key)
+            return resp
+        resp = self._request_token(payload=payload)
+        grant_cache.set(cache_key, resp)
+        if not refresh:
+            self._register_refresher(cache_key, api_key, api_secret, resp)
+        return resp
 
-        }
-        logger.debug(settings.KAIRNIAL_AUTH_SERVER + PASSWORD_LOGIN_PATH)
-        logger.debug(payload)
-        headers = {
-            'Content-Type': JSON_CONTENT_TYPE,
-        }
-        logger.debug(headers)
-        response = requests.post(
-            settings.KAIRNIAL_AUTH_SERVER + PASSWORD_LOGIN_PATH,
-            headers=headers,
-            data=json.dumps(payload)
-        )
-        logger.debug(response.status_code)
-        logger.debug(response.content)
-        if response.status_code != 200:
-            raise KairnialAuthServiceError(
-                message=_(f"Authentication failed with code {response.status_code}: {response.content}"),
-                status=response.status_code
-            )
+    async def asecrets_authentication(self, api_key: str, api_secret: str, refresh: bool = False,
+                                      min_lifetime: float = None) -> dict:
+        """
+        Async version of secrets_authentication
+        """
+        payload = self._secrets_payload(api_key, api_secret)
+        grant_cache = get_grant_cache()
+        if grant_cache is None:
+            return await self._arequest_token(payload=payload)
+        cache_key = grant_cache.make_key(self.client_id, api_key, api_secret, payload['scope'])
+        resp = None
+        if not refresh or min_lifetime is not None:
+            resp = self._usable_grant(await grant_cache.aget(cache_key), refresh, min_lifetime)
+        if resp is not None:
+            self._extract_response(resp)
+            if not refresh:
+                self._touch_refresher(cache_key)
+            return resp
+        resp = await self._arequest_token(payload=payload)
+        await grant_cache.aset(cache_key, resp)
+        if not refresh:
+            self._register_refresher(cache_key, api_key, api_secret, resp)
+        return resp
 
-        try:
-            resp = response.json()
-            logger.debug(resp)
-            self._extract_token(resp)
-            self._extract_token_type(resp)
-            self._extract_user(resp)
+    @staticmethod
+    def _usable_grant(resp, refresh: bool, min_lifetime: float = None):
+        """
+        :param resp: Grant cache entry
+        :param refresh: Renewal, only a grant outliving min_lifetime is used
+        :param min_lifetime: Seconds
+        :return: None if a new grant must be requested
+        """
+        if resp is None or not refresh:
             return resp
-        except json.JSONDecodeError:
-            raise KairnialAuthServiceError(
-                message="Invalid response from server",
-                status=400
-            )
+        return resp if resp.get('expires_in', 0) > min_lifetime else None
+
+    @staticmethod
+    def _touch_refresher(cache_key: str):
+        refresher = get_refresher()
+        if refresher is not None:
+            refresher.touch(cache_key)
+
+    def _register_refresher(self, cache_key: str, api_key: str, api_secret: str, resp: dict):
+        """
+        Renew the cached grant in the background before it expires, when REGISTER_GRANTS is set
+        """
+        refresher = get_refresher()
+        if refresher is not None and refresher.register_grants:
+            refresher.register_secrets(self.client_id, api_key, api_secret, response=resp, key=cache_key)
 
     def refresh_authentication(self, refresh_token: str, provider_uuid: str) -> dict:
         """
         Get auth token from auth server
+        Concurrent identical refresh requests share a single upstream call, and its result
+        is reused for RESULT_TTL seconds when configured
         :param refresh_token: Refresh token
         :param provider_uuid: Authentication provider identifier
         :return:
         """
-        logger = logging.getLogger('services')
-        payload = {
+        payload = self._refresh_payload(refresh_token, provider_uuid)
+        key = token_digest(refresh_token, self.client_id, provider_uuid, payload['scope'])
+        resp = self.refresh_results.get(key) if self.refresh_result_ttl else None
+        if resp is None:
+            resp = self.refresh_flight.do(key, self._fetch_refresh, key, payload)
+        self._extract_response(resp)
+        return resp
+
+    async def arefresh_authentication(self, refresh_token: str, provider_uuid: str) -> dict:
+        """
+        Async version of refresh_authentication, coalescing concurrent tasks of the event loop
+        """
+        payload = self._refresh_payload(refresh_token, provider_uuid)
+        key = token_digest(refresh_token, self.client_id, provider_uuid, payload['scope'])
+        resp = self.refresh_results.get(key) if self.refresh_result_ttl else None
+        if resp is None:
+            resp = await self.arefresh_flight.do(key, self._afetch_refresh, key, payload)
+        self._extract_response(resp)
+        return resp
+
+    def _password_payload(self, username: str, password: str) -> dict:
+        return {
+            'client_id': self.client_id,
+            'scope': " ".join(settings.KAIRNIAL_AUTHENTICATION_SCOPES),
+            'grant_type': 'password',
+            'password': password,
+            'username': username,
+        }
+
+    def _secrets_payload(self, api_key: str, api_secret: str) -> dict:
+        return {
+            'grant_type': 'api_key',
+            'scope': " ".join(settings.KAIRNIAL_AUTHENTICATION_SCOPES),
+            'client_id': self.client_id,
+            'api_key': api_key,
+            'api_secret': api_secret
+
+        }
+
+    def _refresh_payload(self, refresh_token: str, provider_uuid: str) -> dict:
+        return {
             'grant_type': 'refresh_token',
             'scope': " ".join(settings.KAIRNIAL_AUTHENTICATION_SCOPES),
             'client_id': self.client_id,
             'provider_uuid': provider_uuid,
             'refresh_token': refresh_token
         }
-        logger.debug(settings.KAIRNIAL_AUTH_SERVER + PASSWORD_LOGIN_PATH)
-        logger.debug(payload)
+
+    def _fetch_refresh(self, key: str, payload: dict) -> dict:
+        """
+        Refresh grant upstream call, shared by coalesced callers
+        :param key: Refresh request digest
+        :param payload: Grant parameters
+        :return: auth server response
+        """
+        resp = self._post_grant(payload=payload)
+        if self.refresh_result_ttl:
+            self.refresh_results.set(key, resp, expires_at=time.time() + self.refresh_result_ttl)
+        return resp
+
+    async def _afetch_refresh(self, key: str, payload: dict) -> dict:
+        """
+        Async version of _fetch_refresh
+        """
+        resp = await self._apost_grant(payload=payload)
+        if self.refresh_result_ttl:
+            self.refresh_results.set(key, resp, expires_at=time.time() + self.refresh_result_ttl)
+        return resp
+
+    def _request_token(self, payload: dict, form_encoded: bool = False) -> dict:
+        """
+        Get token from the auth server and extract it
+        :param payload: Grant parameters
+        :param form_encoded: Send payload as a form instead of JSON
+        :return: auth server response
+        """
+        resp = self._post_grant(payload=payload, form_encoded=form_encoded)
+        self._extract_response(resp)
+        return resp
+
+    async def _arequest_token(self, payload: dict, form_encoded: bool = False) -> dict:
+        """
+        Async version of _request_token
+        """
+        resp = await self._apost_grant(payload=payload, form_encoded=form_encoded)
+        self._extract_response(resp)
+        return resp
+
+    def _post_grant(self, payload: dict, form_encoded: bool = False) -> dict:
+        """
+        Send grant request to the auth server through the transport
+        :param payload: Grant parameters
+        :param form_encoded: Send payload as a form instead of JSON
+        :return: auth server response
+        """
+        url, headers, data = self._prepare_grant(payload=payload, form_encoded=form_encoded)
+        grant = payload.get('grant_type')
+        endpoint = self.circuit_endpoint(url, grant)
+        breaker = self._check_circuit(endpoint, grant)
+        try:
+            with UPSTREAM_SECONDS.time(grant=grant), timed(TIMING_UPSTREAM):
+                response = self.transport.post(url, headers=headers, data=data, retry_status=self._replayable(grant))
+        except TransportError as e:
+            UPSTREAM_RESPONSES.inc(grant=grant, status='unreachable')
+            self._record_call(breaker, endpoint, None)
+            raise self._unreachable_error(e)
+        except BaseException:
+            if breaker is not None:
+                breaker.release(endpoint)
+            raise
+        UPSTREAM_RESPONSES.inc(grant=grant, status=response.status_code)
+        self._record_call(breaker, endpoint, response.status_code)
+        return self._parse_grant_response(response)
+
+    async def _apost_grant(self, payload: dict, form_encoded: bool = False) -> dict:
+        """
+        Async version of _post_grant
+        """
+        url, headers, data = self._prepare_grant(payload=payload, form_encoded=form_encoded)
+        grant = payload.get('grant_type')
+        endpoint = self.circuit_endpoint(url, grant)
+        breaker = self._check_circuit(endpoint, grant)
+        try:
+            with UPSTREAM_SECONDS.time(grant=grant), timed(TIMING_UPSTREAM):
+                response = await self.transport.apost(url, headers=headers, data=data,
+                                                      retry_status=self._replayable(grant))
+        except TransportError as e:
+            UPSTREAM_RESPONSES.inc(grant=grant, status='unreachable')
+            self._record_call(breaker, endpoint, None)
+            raise self._unreachable_error(e)
+        except BaseException:
+            if breaker is not None:
+                breaker.release(endpoint)
+            raise
+        UPSTREAM_RESPONSES.inc(grant=grant, status=response.status_code)
+        self._record_call(breaker, endpoint, response.status_code)
+        return self._parse_grant_response(response)
+
+    @staticmethod
+    def _replayable(grant: str) -> bool:
+        # the auth server rotates refresh tokens, replaying a processed refresh grant fails or
+        # triggers reuse detection
+        return grant != 'refresh_token'
+
+    @staticmethod
+    def _prepare_grant(payload: dict, form_encoded: bool = False):
+        """
+        Build grant request
+        :param payload: Grant parameters
+        :param form_encoded: Send payload as a form instead of JSON
+        :return: url, headers, body
+        """
+        url = settings.KAIRNIAL_AUTH_SERVER + PASSWORD_LOGIN_PATH
+        if form_encoded:
+            headers = {'Content-type': 'application/x-www-form-urlencoded'}
+            return url, headers, payload
         headers = {
             'Content-Type': JSON_CONTENT_TYPE,
         }
-        logger.debug(headers)
-        response = requests.post(
-            settings.KAIRNIAL_AUTH_SERVER + PASSWORD_LOGIN_PATH,
-            headers=headers,
-            data=json.dumps(payload)
+        logger.debug("Grant request to %s: %s", url, Redacted(payload))
+        return url, headers, json.dumps(payload)
+
+    @staticmethod
+    def circuit_endpoint(url: str, grant: str) -> str:
+        """
+        Circuit breaker endpoint of a grant: all grants are posted to the same URL,
+        a failing grant type must not open the circuit of the others
+        :param url: Endpoint URL
+        :param grant: Grant type
+        :return:
+        """
+        return f'{url} {grant}'
+
+    @staticmethod
+    def _check_circuit(endpoint: str, grant: str):
+        """
+        Fail fast when the circuit of the endpoint is open
+        :param endpoint: circuit_endpoint of the call
+        :param grant: Grant type, for metrics
+        :return: circuit breaker, None if disabled
+        """
+        breaker = get_circuit_breaker()
+        if breaker is not None:
+            try:
+                breaker.before_call(endpoint)
+            except CircuitOpenError as e:
+                UPSTREAM_RESPONSES.inc(grant=grant, status='rejected')
+                raise KairnialAuthServiceUnavailable(
+                    message=_("Authentication server unavailable, retry later"),
+                    retry_after=e.retry_after
+                )
+        return breaker
+
+    @staticmethod
+    def _record_call(breaker, endpoint: str, status_code: int = None):
+        """
+        Report call outcome to the circuit breaker, unreachable server and 5xx are failures
+        :param breaker: Circuit breaker, None if disabled
+        :param endpoint: circuit_endpoint of the call
+        :param status_code: Response status, None if no response was received
+        """
+        if breaker is None:
+            return
+        if status_code is None or status_code >= 500:
+            breaker.record_failure(endpoint)
+        else:
+            breaker.record_success(endpoint)
+
+    @staticmethod
+    def _unreachable_error(error: TransportError):
+        return KairnialAuthServiceError(
+            message=_(f"Authentication server unreachable: {str(error)}"),
+            status=503
         )
-        logger.debug(response.status_code)
-        logger.debug(response.content)
+
+    @staticmethod
+    def _parse_grant_response(response) -> dict:
+        """
+        Check auth server response and decode it
+        :param response: TransportResponse
+        :return: auth server response
+        """
+        logger.debug("Grant response %s: %s", response.status_code, Redacted(response.content))
         if response.status_code != 200:
             raise KairnialAuthServiceError(
                 message=_(f"Authentication failed with code {response.status_code}: {response.content}"),
@@ -169,18 +413,23 @@ class KairnialAuthentication:
             )
 
         try:
-            resp = response.json()
-            logger.debug(resp)
-            self._extract_token(resp)
-            self._extract_token_type(resp)
-            self._extract_user(resp)
-            return resp
+            return response.json()
         except json.JSONDecodeError:
             raise KairnialAuthServiceError(
                 message="Invalid response from server",
                 status=400
             )
 
+    def _extract_response(self, response: dict):
+        """
+        extract token, token type and user from authentication response
+        :param response:
+        :return:
+        """
+        self._extract_token(response)
+        self._extract_token_type(response)
+        self._extract_user(response)
+
     def _extract_token_type(self, response: dict):
         """
         extract token from authentication response
@@ -206,10 +455,10 @@ class KairnialAuthentication:
         :return:
         """
         resp_user = response.get('user', {})
-        user = User()
-        user.first_name = resp_user.get('first_name')
-        user.last_name = resp_user.get('last_name')
-        user.email = resp_user.get('email')
-        user.uuid = resp_user.get('uuid')
-        self.user = user
+        self.user = build_user(
+            uuid=resp_user.get('uuid'),
+            first_name=resp_user.get('first_name'),
+            last_name=resp_user.get('last_name'),
+            email=resp_user.get('email')
+        )
         return self.user
@@ -0,0 +1,95 @@
+"""
+Coalescing of concurrent identical calls
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Run a single execution per key at a time, concurrent callers with the same key
+    wait for it and share its result or its exception
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) unless a call with the same key is in flight
+        :param key: Call identifier
+        :param fn: Callable
+        :return: fn result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines: concurrent tasks of an event loop with the same key
+    await a single execution
+
+    The call runs in its own task, cancelling one of the callers (the first included)
+    does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        Await fn(*args, **kwargs) unless a call with the same key is in flight
+        :param key: Call identifier
+        :param fn: Coroutine function
+        :return: fn result
+        """
+        call_key = (id(asyncio.get_running_loop()), key)
+        task = self._calls.get(call_key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[call_key] = task
+            task.add_done_callback(lambda done: self._done(call_key, done))
+        return await asyncio.shield(task)
+
+    def _done(self, call_key, task):
+        if self._calls.get(call_key) is task:
+            del self._calls[call_key]
+        if not task.cancelled():
+            # retrieved here in case every caller was cancelled, do not report it as never retrieved
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
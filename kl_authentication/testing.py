@@ -0,0 +1,105 @@
+"""
+Test helpers
+"""
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import JSON_CONTENT_TYPE
+
+
+class _StubAuthHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without TCP_NODELAY keep-alive responses wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Type', '').startswith(JSON_CONTENT_TYPE):
+            payload = json.loads(body or b'{}')
+        else:
+            payload = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+        if stub.record_requests:
+            stub.requests.append((self.path, payload))
+        if stub.latency:
+            time.sleep(stub.latency if isinstance(stub.latency, (int, float)) else random.uniform(*stub.latency))
+        status, response = stub.respond(self.path, payload)
+        content = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', JSON_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StubAuthServer:
+    """
+    Local HTTP server impersonating the Kairnial auth server
+
+    Answers every POST with (status, response), requests are recorded as (path, payload).
+    latency is a delay in seconds or a (min, max) range, error_rate the fraction of requests
+    answered with error_status, responses overrides the response by grant type.
+    Usable as a context manager, point KAIRNIAL_AUTH_SERVER to url.
+    """
+
+    def __init__(self, response: dict = None, status: int = 200, latency=0, error_rate: float = 0,
+                 error_status: int = 500, responses: dict = None, record_requests: bool = True):
+        self.response = response if response is not None else {
+            'access_token': 'access', 'refresh_token': 'refresh', 'token_type': 'Bearer',
+            'expires_in': 3600, 'scope': 'openid profile',
+            'user': {'uuid': '2b7c5e8e-6a3e-4b8c-9a3e-0f8a1e3c5d7f', 'email': 'user@example.com',
+                     'first_name': 'First', 'last_name': 'Last', 'full_name': 'First Last'}
+        }
+        self.status = status
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.responses = responses or {}
+        self.record_requests = record_requests
+        self.requests = []
+        self._server = None
+        self._thread = None
+
+    def respond(self, path: str, payload: dict):
+        """
+        Response to a grant request, override for dynamic responses
+        :return: status, response body
+        """
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status, {'error': 'stub_error'}
+        return self.status, self.responses.get(payload.get('grant_type'), self.response)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._server = _StubHTTPServer(('127.0.0.1', 0), _StubAuthHandler)
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
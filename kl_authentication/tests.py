@@ -1,3 +1,1521 @@
 """
 Authentication class tests
 """
+import asyncio
+import importlib
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, override_settings
+from django.urls import Resolver404, include, path, resolve
+from drf_spectacular.extensions import OpenApiAuthenticationExtension
+from drf_spectacular.generators import SchemaGenerator
+from jwt.algorithms import RSAAlgorithm
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from . import async_urls, responses, urls
+from .authentication import KairnialCookieAuthentication, KairnialHeaderOrCookieAuthentication, \
+    KairnialTokenAuthentication, TokenAthentication
+from .breaker import STATE_CLOSED, STATE_OPEN, CircuitBreaker, CircuitOpenError, set_circuit_breaker
+from .cache import SharedTokenCache, TTLCache
+from .clients import ClientRegistry, set_client_registry
+from .credentials import ACCESS_TOKEN_COOKIE, REQUEST_ATTRIBUTE, SOURCE_COOKIE, SOURCE_HEADER, parse_credentials
+from .grants import DjangoGrantCacheBackend, GrantCache, LocalGrantCacheBackend, set_grant_cache
+from .introspection import TokenIntrospector, set_introspector
+from .keys import KeyRing, set_key_ring
+from .logutils import REDACTED, AggregatingLogger, LogPipeline, StructuredFormatter
+from .metrics import AUTH_FAILURES, REGISTRY, TOKEN_VERIFY_SECONDS, UPSTREAM_RESPONSES, UPSTREAM_SECONDS, \
+    Metric, MetricsRegistry
+from .middlewares import KairnialAuthMiddleware
+from .precheck import precheck_token
+from .permissions import HasAnyScope, HasScopes
+from .principal import PRINCIPAL_MODEL, KairnialUser, LazyKairnialUser
+from .refresher import TokenRefresher, set_refresher
+from .revocation import RevocationList, TokenRevokedError, jti_revocation_id, set_revocation_list, \
+    token_revocation_id, write_revocation_file
+from .scopes import SCOPES, ScopeRegistry
+from .serializers import AuthResponseSerializer, AuthServiceErrorSerializer, ClientlessPasswordAuthenticationSerializer
+from .services import KairnialAuthentication, KairnialAuthServiceError
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .testing import StubAuthServer
+from .timing import SERVER_TIMING_HEADER, TIMING_VERIFY, timed
+from .transport import InMemoryTransport, RequestsTransport, Transport, TransportError, set_transport
+from .views import AsyncClientlessAPIKeyAuthenticationView, AsyncClientlessAuthenticationView, \
+    AsyncClientlessPasswordAuthenticationView, AsyncClientlessRefreshTokenAuthenticationView, \
+    ClientlessAPIKeyAuthenticationView, ClientlessPasswordAuthenticationView, MetricsView, TokenIntrospectionView
+
+
+def generate_key_pair():
+    """
+    :return: RSA private key and PEM public key
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key, key.public_key().public_bytes(serialization.Encoding.PEM,
+                                              serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+
+PRIVATE_KEY, PUBLIC_KEY = generate_key_pair()
+OTHER_PRIVATE_KEY, OTHER_PUBLIC_KEY = generate_key_pair()
+QUIET_LOGGERS = ('authentication', 'services')
+_quiet_handler = logging.NullHandler()
+
+
+def setUpModule():
+    # failing paths are exercised on purpose, keep their records off stderr (logging.lastResort),
+    # they still propagate to the root logger and assertLogs still captures them
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).addHandler(_quiet_handler)
+
+
+def tearDownModule():
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).removeHandler(_quiet_handler)
+
+
+def make_token(private_key=PRIVATE_KEY, audience: str = 'client', expires_in: int = 3600, kid: str = None,
+               **claims) -> str:
+    payload = {'sub': 'user-uuid', 'email': 'user@example.com', 'name': 'Doe', 'aud': audience,
+               'exp': int(time.time()) + expires_in}
+    payload.update(claims)
+    return jwt.encode(payload, private_key, algorithm='RS256', headers={'kid': kid} if kid else None)
+
+
+def write_jwks(path: str, keys: dict):
+    """
+    :param path: JWKS file
+    :param keys: PEM public keys indexed by kid
+    """
+    jwks = {'keys': [dict(json.loads(RSAAlgorithm.to_jwk(KeyRing.parse_pem(pem))), kid=kid, use='sig')
+                     for kid, pem in keys.items()]}
+    with open(path, 'w') as fp:
+        json.dump(jwks, fp)
+    touch(path)
+
+
+_mtimes = itertools.count(1)
+
+
+def touch(path: str):
+    # successive writes get distinct modification times, whatever the file system resolution
+    mtime = time.time_ns() + next(_mtimes) * 10 ** 9
+    os.utime(path, ns=(mtime, mtime))
+
+
+class TokenTestCase(SimpleTestCase):
+    """
+    Tokens signed by PRIVATE_KEY, verified with empty caches
+    """
+
+    def setUp(self):
+        set_key_ring(KeyRing(default_key=PUBLIC_KEY))
+        TokenAthentication.token_cache.clear()
+        TokenAthentication.negative_cache.clear()
+
+    def tearDown(self):
+        set_key_ring(None)
+
+    @staticmethod
+    def authenticate(token: str, client_id: str = 'client', authentication=None, **headers):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}', **headers)
+        request.client_id = client_id
+        return (authentication or KairnialTokenAuthentication()).authenticate(request)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTestCase(TokenTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+
+    def test_lru_eviction(self):
+        cache = TTLCache(max_size=2, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        cache.set('a', 4)
+        cache.set('d', 5)
+        self.assertEqual(sorted(cache._data), ['a', 'd'])
+        self.assertEqual(cache.stats(), {'size': 2, 'max_size': 2, 'hits': 3, 'misses': 1, 'evictions': 2,
+                                         'expirations': 0})
+
+    def test_expiration(self):
+        cache = TTLCache(clock=self.clock)
+        cache.set('short', 1, expires_at=self.clock.now + 10)
+        cache.set('forever', 2)
+        self.clock.now += 10
+        self.assertIsNone(cache.get('short'))
+        self.assertEqual(cache.get('forever'), 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_disabled(self):
+        cache = TTLCache(max_size=0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_token_expiration(self):
+        token_cache = TTLCache(clock=self.clock)
+        with mock.patch.object(TokenAthentication, 'token_cache', token_cache), \
+                mock.patch.object(TokenAthentication, 'token_cache_max_ttl', 60), \
+                mock.patch('kl_authentication.authentication.jwt.decode', wraps=jwt.decode) as decode:
+            # cached for MAX_TTL
+            long_lived = make_token(expires_in=3600)
+            self.authenticate(long_lived)
+            self.clock.now += 59
+            self.authenticate(long_lived)
+            self.assertEqual(decode.call_count, 1)
+            self.clock.now += 2
+            self.authenticate(long_lived)
+            self.assertEqual(decode.call_count, 2)
+            # and never after exp
+            self.clock.now = time.time()
+            short_lived = make_token(expires_in=30)
+            self.authenticate(short_lived)
+            self.clock.now += 29
+            self.authenticate(short_lived)
+            self.assertEqual(decode.call_count, 3)
+            self.clock.now += 2
+            self.authenticate(short_lived)
+            self.assertEqual(decode.call_count, 4)
+        self.assertEqual(token_cache.stats()['hits'], 2)
+        self.assertEqual(token_cache.stats()['expirations'], 2)
+
+
+class KeyRingTestCase(TokenTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.jwks_file = os.path.join(tempfile.mkdtemp(), 'jwks.json')
+        write_jwks(self.jwks_file, {'current': PUBLIC_KEY})
+
+    def test_kid_selection(self):
+        key_ring = KeyRing(default_key=OTHER_PUBLIC_KEY, jwks_file=self.jwks_file)
+        self.assertIn('current', key_ring)
+        self.assertEqual(key_ring.get_key_by_id('current').public_numbers(),
+                         KeyRing.parse_pem(PUBLIC_KEY).public_numbers())
+        self.assertEqual(key_ring.get_key_by_id('unknown').public_numbers(),
+                         KeyRing.parse_pem(OTHER_PUBLIC_KEY).public_numbers())
+        with self.assertRaises(jwt.InvalidKeyError):
+            KeyRing(jwks_file=self.jwks_file).get_key_by_id('unknown')
+
+    def test_file_rotation(self):
+        key_ring = KeyRing(jwks_file=self.jwks_file)
+        write_jwks(self.jwks_file, {'current': PUBLIC_KEY, 'next': OTHER_PUBLIC_KEY})
+        self.assertTrue(key_ring.refresh())
+        self.assertEqual(sorted(key_ring.key_ids), ['current', 'next'])
+        self.assertFalse(key_ring.refresh())
+
+    def test_invalid_document_keeps_keys(self):
+        key_ring = KeyRing(jwks_file=self.jwks_file)
+        with open(self.jwks_file, 'w') as fp:
+            fp.write('[]')
+        touch(self.jwks_file)
+        self.assertFalse(key_ring.refresh())
+        self.assertEqual(key_ring.key_ids, ['current'])
+
+    def test_reload_thread_survives_errors(self):
+        key_ring = KeyRing(jwks_file=self.jwks_file, refresh_interval=0.02)
+        write_jwks(self.jwks_file, {'current': PUBLIC_KEY, 'next': OTHER_PUBLIC_KEY})
+        with mock.patch.object(KeyRing, 'parse_jwks', side_effect=KeyError('kty')), self.assertLogs('authentication'):
+            key_ring.get_key_by_id('current')
+            time.sleep(0.1)
+        time.sleep(0.1)
+        self.assertTrue(key_ring._thread.is_alive())
+        self.assertIn('next', key_ring)
+
+    def test_url_not_fetched_by_constructor(self):
+        with mock.patch.object(KeyRing, '_refresh_url') as refresh_url, \
+                mock.patch.object(KeyRing, '_ensure_thread') as ensure_thread:
+            KeyRing(jwks_url='http://127.0.0.1:1/jwks.json')
+        refresh_url.assert_not_called()
+        ensure_thread.assert_called_once()
+
+    def test_unknown_kid_not_remembered(self):
+        token = make_token(OTHER_PRIVATE_KEY, kid='next')
+        self.assertIsNone(self.authenticate(token))
+        set_key_ring(KeyRing(default_key=PUBLIC_KEY, keys={'next': OTHER_PUBLIC_KEY}))
+        user, _ = self.authenticate(token)
+        self.assertEqual(user.email, 'user@example.com')
+
+    def test_bad_signature_remembered(self):
+        token = make_token(OTHER_PRIVATE_KEY)
+        self.assertIsNone(self.authenticate(token))
+        self.assertEqual(len(TokenAthentication.negative_cache), 1)
+
+
+class PrecheckTestCase(SimpleTestCase):
+
+    def test_valid_token(self):
+        header, payload = precheck_token(make_token(kid='k1'), ['RS256'])
+        self.assertEqual(header['kid'], 'k1')
+        self.assertEqual(payload['aud'], 'client')
+
+    def test_rejected_tokens(self):
+        hs256_token = jwt.encode({'sub': 'user-uuid'}, 'secret', algorithm='HS256')
+        for token, error_class in [('a.b', jwt.DecodeError), ('!.b.c', jwt.DecodeError),
+                                   (hs256_token, jwt.InvalidAlgorithmError),
+                                   (make_token(expires_in=-10), jwt.ExpiredSignatureError)]:
+            with self.subTest(token=token), self.assertRaises(error_class):
+                precheck_token(token, ['RS256'])
+        with self.assertRaises(jwt.DecodeError):
+            precheck_token(make_token(), ['RS256'], max_length=100)
+
+    def test_leeway(self):
+        precheck_token(make_token(expires_in=-10), ['RS256'], leeway=30)
+
+
+class NegativeCacheTestCase(TokenTestCase):
+
+    def test_failure_remembered(self):
+        token = make_token(OTHER_PRIVATE_KEY)
+        with mock.patch('kl_authentication.authentication.jwt.decode', wraps=jwt.decode) as decode:
+            self.assertIsNone(self.authenticate(token))
+            self.assertIsNone(self.authenticate(token))
+        self.assertEqual(decode.call_count, 1)
+
+    def test_precheck_failure_skips_verification(self):
+        token = make_token(expires_in=-10)
+        with mock.patch('kl_authentication.authentication.jwt.decode') as decode:
+            self.assertIsNone(self.authenticate(token))
+        decode.assert_not_called()
+        self.assertEqual(len(TokenAthentication.negative_cache), 1)
+
+    def test_failure_expires(self):
+        token = make_token(OTHER_PRIVATE_KEY)
+        with mock.patch.object(TokenAthentication, 'negative_cache_ttl', 0.05), \
+                mock.patch('kl_authentication.authentication.jwt.decode', wraps=jwt.decode) as decode:
+            self.assertIsNone(self.authenticate(token))
+            time.sleep(0.1)
+            self.assertIsNone(self.authenticate(token))
+        self.assertEqual(decode.call_count, 2)
+
+    def test_disabled(self):
+        token = make_token(OTHER_PRIVATE_KEY)
+        with mock.patch.object(TokenAthentication, 'negative_cache_ttl', 0):
+            self.assertIsNone(self.authenticate(token))
+        self.assertEqual(len(TokenAthentication.negative_cache), 0)
+
+
+class SharedTokenCacheTestCase(TokenTestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.shared_token_cache = SharedTokenCache(cache_alias='default', retry_after=30)
+        patcher = mock.patch.object(TokenAthentication, 'shared_token_cache', self.shared_token_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claims_shared_between_workers(self):
+        token = make_token()
+        self.assertIsNotNone(self.authenticate(token))
+        # another worker: empty local cache, same Django cache
+        TokenAthentication.token_cache.clear()
+        with mock.patch('kl_authentication.authentication.jwt.decode') as decode:
+            user, _ = self.authenticate(token)
+        decode.assert_not_called()
+        self.assertEqual(user.uuid, 'user-uuid')
+        self.assertEqual(self.shared_token_cache.stats()['hits'], 1)
+
+    def test_expired_claims_ignored(self):
+        token = make_token()
+        payload = jwt.decode(token, PUBLIC_KEY, algorithms=['RS256'], audience='client')
+        payload['exp'] = time.time() - 1
+        self.shared_token_cache.set(TokenAthentication._cache_key(token, 'client'), payload,
+                                    expires_at=time.time() + 60)
+        with mock.patch('kl_authentication.authentication.jwt.decode', wraps=jwt.decode) as decode:
+            self.assertIsNotNone(self.authenticate(token))
+        self.assertEqual(decode.call_count, 1)
+
+    def test_cache_failure_falls_back_to_verification(self):
+        broken = mock.Mock(**{'get.side_effect': ConnectionError('down'), 'set.side_effect': ConnectionError('down')})
+        with mock.patch('kl_authentication.cache.caches', {'default': broken}):
+            with self.assertLogs('authentication', level='WARNING'):
+                user, _ = self.authenticate(make_token())
+            self.assertEqual(user.uuid, 'user-uuid')
+            self.assertFalse(self.shared_token_cache.available)
+            TokenAthentication.token_cache.clear()
+            self.assertIsNotNone(self.authenticate(make_token()))
+        self.assertEqual(broken.get.call_count, 1)
+
+
+class PrincipalTestCase(TokenTestCase):
+
+    def test_lightweight_principal_cached(self):
+        token = make_token(email=' user@example.com ', name='Last')
+        user, _ = self.authenticate(token)
+        self.assertIsInstance(user, KairnialUser)
+        self.assertEqual(user.email, 'user@example.com')
+        self.assertIs(self.authenticate(token)[0], user)
+
+    @override_settings(KAIRNIAL_AUTH_PRINCIPAL=PRINCIPAL_MODEL)
+    def test_model_principal_not_shared(self):
+        token = make_token(email='user@example.com')
+        user, _ = self.authenticate(token)
+        self.assertIsInstance(user, get_user_model())
+        user.email = 'changed@example.com'
+        other, _ = self.authenticate(token)
+        self.assertIsNot(other, user)
+        self.assertEqual(other.email, 'user@example.com')
+
+    def test_missing_email(self):
+        token = make_token(email=None)
+        self.assertEqual(self.authenticate(token)[0].email, '')
+        with override_settings(KAIRNIAL_AUTH_PRINCIPAL=PRINCIPAL_MODEL):
+            TokenAthentication.token_cache.clear()
+            self.assertEqual(self.authenticate(token)[0].email, '')
+        with override_settings(KAIRNIAL_AUTH_LAZY_USER=True):
+            TokenAthentication.token_cache.clear()
+            user, _ = self.authenticate(token)
+            self.assertIsInstance(user, LazyKairnialUser)
+            self.assertEqual(user.email, '')
+
+
+class CredentialSourcesTestCase(TokenTestCase):
+
+    def request(self, sources, token: str):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        request.COOKIES[ACCESS_TOKEN_COOKIE] = make_token(sub='cookie-uuid')
+        request.client_id = 'client'
+        # as attached by KairnialAuthMiddleware
+        setattr(request, REQUEST_ATTRIBUTE, parse_credentials(request, sources=sources))
+        return request
+
+    def test_source_orders(self):
+        token = make_token(sub='header-uuid')
+        for sources in [(SOURCE_HEADER, SOURCE_COOKIE), (SOURCE_COOKIE, SOURCE_HEADER)]:
+            with self.subTest(sources=sources):
+                request = self.request(sources, token)
+                self.assertEqual(KairnialTokenAuthentication().authenticate(request)[0].uuid, 'header-uuid')
+                self.assertEqual(KairnialCookieAuthentication().authenticate(request)[0].uuid, 'cookie-uuid')
+                user, _ = KairnialHeaderOrCookieAuthentication().authenticate(request)
+                self.assertEqual(request.auth_source, sources[0])
+                self.assertEqual(user.uuid, f'{sources[0]}-uuid')
+
+    def test_missing_source(self):
+        request = RequestFactory().get('/')
+        request.client_id = 'client'
+        request.COOKIES[ACCESS_TOKEN_COOKIE] = make_token()
+        setattr(request, REQUEST_ATTRIBUTE, parse_credentials(request, sources=(SOURCE_COOKIE, SOURCE_HEADER)))
+        self.assertIsNone(KairnialTokenAuthentication().authenticate(request))
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {make_token()}')
+        request.client_id = 'client'
+        self.assertIsNone(KairnialCookieAuthentication().authenticate(request))
+
+
+class IntrospectionTestCase(TokenTestCase):
+
+    def setUp(self):
+        super().setUp()
+        set_introspector(TokenIntrospector(max_workers=2))
+
+    def tearDown(self):
+        set_introspector(None)
+        super().tearDown()
+
+    @staticmethod
+    def introspect(tokens, user=None):
+        request = APIRequestFactory().post('/', {'tokens': tokens}, format='json')
+        if user is not None:
+            force_authenticate(request, user=user)
+        return TokenIntrospectionView.as_view()(request, client_id='client')
+
+    def test_batch(self):
+        token = make_token()
+        with mock.patch('kl_authentication.authentication.jwt.decode', wraps=jwt.decode) as decode:
+            response = self.introspect([{'token': token}, {'token': make_token(expires_in=-10)}, {'token': token},
+                                        {'token': token, 'audience': 'other'}], user=KairnialUser(uuid='gateway'))
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([result['active'] for result in results], [True, False, True, False])
+        self.assertEqual([result['reason'] for result in results], [None, 'expired', None, 'claims'])
+        self.assertEqual(results[0]['claims']['sub'], 'user-uuid')
+        self.assertEqual(decode.call_count, 2)
+
+    def test_shares_local_cache(self):
+        token, other = make_token(), make_token(sub='other-uuid')
+        self.authenticate(token)
+        with mock.patch('kl_authentication.authentication.jwt.decode') as decode:
+            response = self.introspect([{'token': token}], user=KairnialUser(uuid='gateway'))
+        self.assertTrue(response.data['results'][0]['active'])
+        decode.assert_not_called()
+        self.introspect([{'token': other}], user=KairnialUser(uuid='gateway'))
+        with mock.patch('kl_authentication.authentication.jwt.decode') as decode:
+            self.assertEqual(self.authenticate(other)[0].uuid, 'other-uuid')
+        decode.assert_not_called()
+
+    def test_anonymous_rejected(self):
+        response = self.introspect([{'token': make_token()}])
+        self.assertIn(response.status_code, (401, 403))
+
+    def test_schema(self):
+        schema = SchemaGenerator(patterns=[path('<str:client_id>/', include('kl_authentication.introspection_urls'))]
+                                 ).get_schema(request=None, public=True)
+        operation = schema['paths']['/{client_id}/introspect']['post']
+        self.assertEqual(operation['requestBody']['content']['application/json']['schema']['$ref'],
+                         '#/components/schemas/TokenIntrospection')
+        self.assertEqual(operation['responses']['200']['content']['application/json']['schema']['$ref'],
+                         '#/components/schemas/TokenIntrospectionResponse')
+
+    @override_settings(ROOT_URLCONF='kl_authentication.urls')
+    def test_not_routed_by_default(self):
+        with self.assertRaises(Resolver404):
+            resolve('/introspect')
+        self.assertEqual(resolve('/introspect', 'kl_authentication.introspection_urls').func.cls,
+                         TokenIntrospectionView)
+
+
+class RevocationTestCase(TokenTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'revocations')
+        self.revoked = make_token(jti='revoked-jti')
+        self.valid = make_token(jti='valid-jti')
+
+    def tearDown(self):
+        set_revocation_list(None)
+        super().tearDown()
+
+    def revocation_list(self, *revocation_ids):
+        write_revocation_file(self.path, revocation_ids)
+        revocation_list = RevocationList(self.path, reload_interval=0)
+        set_revocation_list(revocation_list)
+        return revocation_list
+
+    def test_revoked_tokens_rejected(self):
+        revocation_list = self.revocation_list(jti_revocation_id('revoked-jti'), token_revocation_id(self.valid))
+        self.assertEqual(len(revocation_list), 2)
+        self.assertIsNone(self.authenticate(self.valid))
+        self.assertIsNone(self.authenticate(self.revoked))
+        self.assertEqual(self.authenticate(make_token(jti='other-jti'))[0].uuid, 'user-uuid')
+        self.assertEqual(self.authenticate(make_token())[0].uuid, 'user-uuid')
+
+    def test_cached_token_revoked_on_reload(self):
+        revocation_list = self.revocation_list()
+        self.assertIsNotNone(self.authenticate(self.revoked))
+        write_revocation_file(self.path, [jti_revocation_id('revoked-jti')])
+        self.assertTrue(revocation_list.reload())
+        self.assertFalse(revocation_list.reload())
+        with mock.patch('kl_authentication.authentication.jwt.decode') as decode:
+            self.assertIsNone(self.authenticate(self.revoked))
+        decode.assert_not_called()
+        with self.assertRaises(TokenRevokedError) as error:
+            KairnialTokenAuthentication().get_verified_claims(self.revoked, 'client')
+        self.assertEqual(KairnialTokenAuthentication.failure_reason(error.exception), 'revoked')
+
+    def test_invalid_file_keeps_previous_list(self):
+        with self.assertLogs('authentication', level='ERROR'):
+            missing = RevocationList(self.path, reload_interval=0)
+        self.assertEqual(len(missing), 0)
+        set_revocation_list(missing)
+        self.assertIsNotNone(self.authenticate(self.revoked))
+
+        revocation_list = self.revocation_list(jti_revocation_id('revoked-jti'))
+        # replaced, not rewritten in place: the previous file is still mapped
+        corrupt = f'{self.path}.corrupt'
+        with open(corrupt, 'wb') as fp:
+            fp.write(b'KLRV truncated')
+        os.replace(corrupt, self.path)
+        with self.assertLogs('authentication', level='ERROR'):
+            self.assertFalse(revocation_list.reload())
+        self.assertEqual(len(revocation_list), 1)
+        TokenAthentication.token_cache.clear()
+        self.assertIsNone(self.authenticate(self.revoked))
+
+
+class ScopesTestCase(TokenTestCase):
+
+    def test_masks(self):
+        registry = ScopeRegistry(['read', 'write'])
+        self.assertEqual(registry.mask(['read', 'write']), 0b11)
+        mask = registry.parse('write admin')
+        self.assertEqual(registry.names(mask), ['write', 'admin'])
+        self.assertEqual(registry.parse(['admin', 'write']), mask)
+        self.assertEqual(registry.parse(None), 0)
+        self.assertEqual(registry.mask(['read']), 0b1)
+
+    def test_claims_interned(self):
+        registry = ScopeRegistry(max_interned=2)
+        with mock.patch.object(registry, 'mask', wraps=registry.mask) as parse:
+            registry.parse('read write')
+            registry.parse('read write')
+            self.assertEqual(parse.call_count, 1)
+            registry.parse('read')
+            registry.parse('write')
+            registry.parse('read write')
+            self.assertEqual(parse.call_count, 4)
+
+    def test_registry_full(self):
+        registry = ScopeRegistry(['read'], max_scopes=1)
+        with self.assertLogs('authentication', level='WARNING'):
+            self.assertEqual(registry.parse('read write'), registry.bit('read'))
+        with self.assertRaises(ImproperlyConfigured):
+            registry.mask(['write'], register=True)
+        self.assertEqual(len(registry), 1)
+
+    def test_permissions(self):
+        request = RequestFactory().get('/')
+        request.auth_scopes = SCOPES.mask(['documents:read', 'documents:write'], register=True)
+        self.assertTrue(HasScopes('documents:read', 'documents:write')().has_permission(request, None))
+        self.assertFalse(HasScopes('documents:read', 'documents:delete')().has_permission(request, None))
+        self.assertTrue(HasAnyScope('documents:delete', 'documents:read')().has_permission(request, None))
+        self.assertFalse(HasAnyScope('documents:delete')().has_permission(RequestFactory().get('/'), None))
+
+    def test_token_scopes(self):
+        token = make_token(scope='documents:read profile')
+        for _ in range(2):
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+            request.client_id = 'client'
+            self.assertIsNotNone(KairnialTokenAuthentication().authenticate(request))
+            self.assertCountEqual(SCOPES.names(request.auth_scopes), ['documents:read', 'profile'])
+            self.assertTrue(HasScopes('documents:read')().has_permission(request, None))
+            self.assertFalse(HasScopes('documents:write')().has_permission(request, None))
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {make_token()}')
+        request.client_id = 'client'
+        KairnialTokenAuthentication().authenticate(request)
+        self.assertEqual(request.auth_scopes, 0)
+
+
+class ClientRegistryTestCase(TokenTestCase):
+    clients = {
+        'portal': {'ISSUER': 'https://auth.example.com', 'AUDIENCES': ['portal', 'shared'], 'KEY_IDS': ['current'],
+                   'LEEWAY': 30},
+    }
+
+    def setUp(self):
+        super().setUp()
+        set_key_ring(KeyRing(default_key=PUBLIC_KEY, keys={'current': PUBLIC_KEY, 'other': OTHER_PUBLIC_KEY}))
+
+    def tearDown(self):
+        set_client_registry(None)
+        super().tearDown()
+
+    @staticmethod
+    def portal_token(private_key=PRIVATE_KEY, audience: str = 'portal', kid: str = 'current', **claims) -> str:
+        claims.setdefault('iss', 'https://auth.example.com')
+        return make_token(private_key, audience=audience, kid=kid, **claims)
+
+    def test_client_options(self):
+        set_client_registry(ClientRegistry(clients=self.clients))
+        self.assertIsNotNone(self.authenticate(self.portal_token(), 'portal'))
+        self.assertIsNotNone(self.authenticate(self.portal_token(audience='shared'), 'portal'))
+        self.assertIsNotNone(self.authenticate(self.portal_token(expires_in=-10), 'portal'))
+        self.assertIsNone(self.authenticate(self.portal_token(expires_in=-60), 'portal'))
+        self.assertIsNone(self.authenticate(self.portal_token(iss='https://other.example.com'), 'portal'))
+        self.assertIsNone(self.authenticate(self.portal_token(OTHER_PRIVATE_KEY, kid='other'), 'portal'))
+        self.assertIsNone(self.authenticate(self.portal_token(kid=None), 'portal'))
+        # other clients keep the default options
+        self.assertIsNotNone(self.authenticate(make_token(OTHER_PRIVATE_KEY, kid='other')))
+        self.assertIsNone(self.authenticate(make_token(audience='shared')))
+
+    def test_allowed_key_not_loaded(self):
+        clients = {'portal': dict(self.clients['portal'], KEY_IDS=['current', 'next'])}
+        set_client_registry(ClientRegistry(clients=clients))
+        # signed with the default key, which must not stand in for the missing 'next' key
+        token = self.portal_token(kid='next')
+        with self.assertRaises(jwt.InvalidKeyError):
+            KairnialTokenAuthentication().get_verified_claims(token, 'portal')
+        self.assertIsNone(self.authenticate(token, 'portal'))
+        set_key_ring(KeyRing(default_key=PUBLIC_KEY, keys={'current': PUBLIC_KEY, 'next': PUBLIC_KEY}))
+        self.assertIsNotNone(self.authenticate(token, 'portal'))
+
+    def test_strict(self):
+        set_client_registry(ClientRegistry(clients=self.clients, strict=True))
+        self.assertIsNotNone(self.authenticate(self.portal_token(), 'portal'))
+        self.assertIsNone(self.authenticate(make_token()))
+        with self.assertRaises(jwt.InvalidAudienceError):
+            KairnialTokenAuthentication().get_verified_claims(make_token(), 'client')
+
+    def test_file_reload(self):
+        path = os.path.join(tempfile.mkdtemp(), 'clients.json')
+        with open(path, 'w') as fp:
+            json.dump({}, fp)
+        touch(path)
+        client_registry = ClientRegistry(file=path, reload_interval=3600)
+        set_client_registry(client_registry)
+        token = make_token()
+        self.assertIsNotNone(self.authenticate(token))
+        version = client_registry.version
+
+        with open(path, 'w') as fp:
+            json.dump({'client': {'ISSUER': 'https://auth.example.com'}}, fp)
+        touch(path)
+        self.assertTrue(client_registry.reload())
+        self.assertNotEqual(client_registry.version, version)
+        # verified again with the new options, although the token is in the local cache
+        self.assertIsNone(self.authenticate(token))
+
+        version = client_registry.version
+        with open(path, 'w') as fp:
+            fp.write('{"client": ')
+        touch(path)
+        with self.assertLogs('authentication', level='ERROR'):
+            self.assertFalse(client_registry.reload())
+        self.assertEqual(client_registry.version, version)
+        self.assertEqual(client_registry.get('client').issuer, 'https://auth.example.com')
+
+
+class LogPipelineTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.parent = logging.getLogger('kl_tests')
+        self.logger = logging.getLogger('kl_tests.pipeline')
+        self.stream = io.StringIO()
+        self.parent.addHandler(logging.StreamHandler(self.stream))
+        self.parent.propagate = False
+        self.addCleanup(self.restore, self.parent, self.logger)
+
+    @staticmethod
+    def restore(*loggers):
+        for logger in loggers:
+            logger.handlers = []
+            logger.propagate = True
+
+    def test_propagated_handlers_kept(self):
+        pipeline = LogPipeline(logger_names=('kl_tests.pipeline',)).install()
+        self.assertFalse(self.logger.propagate)
+        self.logger.warning("Grant request %s", {'username': 'user', 'password': 'secret'})
+        pipeline.stop()
+        output = self.stream.getvalue()
+        self.assertIn(REDACTED, output)
+        self.assertNotIn('secret', output)
+        self.assertIn('user', output)
+
+    def test_stderr_without_handlers(self):
+        self.parent.handlers = []
+        pipeline = LogPipeline(logger_names=('kl_tests.pipeline',)).install()
+        self.addCleanup(pipeline.stop)
+        self.assertEqual(len(pipeline.listener.handlers), 1)
+        self.assertIsInstance(pipeline.listener.handlers[0].formatter, StructuredFormatter)
+
+    def test_aggregated_arguments(self):
+        failure_log = AggregatingLogger('kl_tests.pipeline', interval=60)
+        with self.assertLogs('kl_tests.pipeline', level='ERROR') as logs:
+            for i in range(3):
+                failure_log.log('invalid', "Unable to parse authentication %s", i)
+            failure_log._last_report['invalid'] -= 60
+            failure_log.log('invalid', "Unable to parse authentication %s", 'last')
+        self.assertEqual(logs.records[0].args, (0,))
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            "Unable to parse authentication 0",
+            "Unable to parse authentication last (3 occurrences in the last 60s)",
+        ])
+
+
+class StubServerTestCase(SimpleTestCase):
+    """
+    Views calling a local stub auth server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StubAuthServer().start()
+        cls.settings_override = override_settings(KAIRNIAL_AUTH_SERVER=cls.stub.url)
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.stub.stop()
+        set_transport(None)
+        super().tearDownClass()
+
+    def setUp(self):
+        set_transport(None)
+        self.stub.requests.clear()
+        self.stub.status = 200
+
+
+class TransportTestCase(StubServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub.error_rate = 1
+        self.stub.error_status = 503
+
+    def tearDown(self):
+        self.stub.error_rate = 0
+        super().tearDown()
+
+    def test_post_required(self):
+        class IncompleteTransport(Transport):
+            async def apost(self, url: str, headers: dict = None, data=None, retry_status: bool = True):
+                pass
+
+        with self.assertRaises(TypeError):
+            IncompleteTransport()
+        self.assertIsInstance(InMemoryTransport(), Transport)
+
+    def test_connect_failures_retried(self):
+        transport = RequestsTransport(retries=2, backoff=0)
+        with mock.patch.object(transport.session, 'post', wraps=transport.session.post) as post:
+            with self.assertRaises(TransportError):
+                transport.post('http://127.0.0.1:1/')
+        self.assertEqual(post.call_count, 3)
+
+    def test_statuses_not_retried_by_default(self):
+        response = RequestsTransport(retries=2, backoff=0).post(self.stub.url + '/api/oauth2/login', data='{}')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_refresh_grant_never_replayed(self):
+        set_transport(RequestsTransport(retries=2, backoff=0, retry_statuses=[503]))
+        with self.assertRaises(KairnialAuthServiceError):
+            KairnialAuthentication('client').secrets_authentication('key', 'secret')
+        self.assertEqual(len(self.stub.requests), 3)
+        self.stub.requests.clear()
+        with self.assertRaises(KairnialAuthServiceError):
+            KairnialAuthentication('client').refresh_authentication('refresh', None)
+        self.assertEqual(len(self.stub.requests), 1)
+
+
+class GrantCacheTestCase(StubServerTestCase):
+
+    def tearDown(self):
+        set_grant_cache(None)
+        super().tearDown()
+
+    def test_cached_grant(self):
+        set_grant_cache(GrantCache(LocalGrantCacheBackend(), margin=60))
+        first = KairnialAuthentication('client').secrets_authentication('key', 'secret')
+        second = KairnialAuthentication('client').secrets_authentication('key', 'secret')
+        self.assertEqual(second['access_token'], first['access_token'])
+        self.assertLessEqual(second['expires_in'], 3600)
+        self.assertEqual(len(self.stub.requests), 1)
+        KairnialAuthentication('client').secrets_authentication('key', 'other secret')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_secret_not_in_key(self):
+        key = GrantCache.make_key('client', 'key', 'secret', 'openid')
+        self.assertNotIn('secret', key)
+        self.assertNotEqual(key, GrantCache.make_key('client', 'key', 'other secret', 'openid'))
+
+    def test_margin(self):
+        grant_cache = GrantCache(LocalGrantCacheBackend(), margin=60)
+        grant_cache.set('short', {'access_token': 'access', 'expires_in': 30})
+        self.assertIsNone(grant_cache.get('short'))
+        grant_cache.set('long', {'access_token': 'access', 'expires_in': 3600})
+        with mock.patch('kl_authentication.grants.time.time', return_value=time.time() + 3560):
+            self.assertIsNone(grant_cache.get('long'))
+
+    def test_backend_failure_falls_through(self):
+        backend = DjangoGrantCacheBackend(retry_after=30)
+        broken = mock.Mock(**{'get.side_effect': ConnectionError('down'), 'set.side_effect': ConnectionError('down')})
+        set_grant_cache(GrantCache(backend))
+        with mock.patch.object(DjangoGrantCacheBackend, 'cache', new=broken):
+            with self.assertLogs('services', level='WARNING'):
+                resp = KairnialAuthentication('client').secrets_authentication('key', 'secret')
+            self.assertEqual(resp['access_token'], 'access')
+            self.assertFalse(backend.available)
+            KairnialAuthentication('client').secrets_authentication('key', 'secret')
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(broken.get.call_count, 1)
+
+
+class CircuitBreakerTestCase(StubServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = 0
+        self.breaker = CircuitBreaker(failure_threshold=2, cooldown=30, clock=lambda: self.now)
+        set_circuit_breaker(self.breaker)
+        self.url = KairnialAuthentication.circuit_endpoint(self.stub.url + '/api/oauth2/login', 'api_key')
+
+    def tearDown(self):
+        set_circuit_breaker(None)
+        super().tearDown()
+
+    def login(self):
+        request = RequestFactory().post('/', data={'api_key': 'key', 'api_secret': 'secret'},
+                                        content_type='application/json')
+        return ClientlessAPIKeyAuthenticationView.as_view()(request, client_id='client')
+
+    def test_opens_after_failures(self):
+        self.stub.status = 502
+        self.login()
+        self.login()
+        self.assertEqual(self.breaker.state(self.url), STATE_OPEN)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.now = 10
+        response = self.login()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '20')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_circuit_per_grant(self):
+        self.stub.status = 502
+        self.login()
+        self.login()
+        self.assertEqual(self.breaker.state(self.url), STATE_OPEN)
+        self.stub.status = 200
+        request = RequestFactory().post('/', data={'email': 'user@example.com', 'password': 'password'},
+                                        content_type='application/json')
+        self.assertEqual(ClientlessPasswordAuthenticationView.as_view()(request, client_id='client').status_code, 200)
+        self.assertEqual(self.login().status_code, 503)
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_client_errors_keep_circuit_closed(self):
+        self.stub.status = 401
+        for _ in range(3):
+            self.login()
+        self.assertEqual(self.breaker.state(self.url), STATE_CLOSED)
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_half_open_probe(self):
+        self.stub.status = 502
+        self.login()
+        self.login()
+        self.now = 31
+        self.login()
+        self.assertEqual(self.breaker.state(self.url), STATE_OPEN)
+        self.assertEqual(len(self.stub.requests), 3)
+        self.now = 62
+        self.stub.status = 200
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.breaker.state(self.url), STATE_CLOSED)
+        self.assertEqual(self.breaker.stats()['rejections'], 0)
+
+    def test_single_probe(self):
+        self.breaker.record_failure(self.url)
+        self.breaker.record_failure(self.url)
+        self.now = 31
+        self.breaker.before_call(self.url)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call(self.url)
+        self.breaker.release(self.url)
+        self.breaker.before_call(self.url)
+
+
+class SingleFlightTestCase(StubServerTestCase):
+
+    def tearDown(self):
+        self.stub.latency = 0
+        super().tearDown()
+
+    def refresh_concurrently(self, count: int = 8):
+        def refresh():
+            try:
+                return KairnialAuthentication('client').refresh_authentication('refresh', None)
+            except KairnialAuthServiceError as e:
+                return e
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            return list(executor.map(lambda _: refresh(), range(count)))
+
+    def test_concurrent_refresh_coalesced(self):
+        self.stub.latency = 0.2
+        results = self.refresh_concurrently()
+        self.assertTrue(all(result['access_token'] == 'access' for result in results))
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(KairnialAuthentication.refresh_flight.in_flight(), 0)
+
+    def test_error_shared(self):
+        self.stub.latency = 0.2
+        self.stub.status = 401
+        results = self.refresh_concurrently()
+        self.assertTrue(all(isinstance(result, KairnialAuthServiceError) for result in results))
+        self.assertEqual(len(self.stub.requests), 1)
+        # the failed call is not remembered
+        self.stub.latency = 0
+        self.stub.status = 200
+        self.assertEqual(KairnialAuthentication('client').refresh_authentication('refresh', None)['access_token'],
+                         'access')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_distinct_keys_not_coalesced(self):
+        flight = SingleFlight()
+        started = threading.Barrier(2)
+
+        def fetch(key):
+            # both calls must be in flight at the same time
+            started.wait(timeout=5)
+            return key
+
+        def call(key):
+            return flight.do(key, fetch, key)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(list(executor.map(call, ['a', 'b'])), ['a', 'b'])
+
+
+class RefresherTestCase(StubServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.refresher = TokenRefresher(lead_time=300, jitter=0, retry_interval=30)
+        # renewals are run by the tests
+        self.refresher._ensure_thread = lambda: None
+
+    def tearDown(self):
+        set_refresher(None)
+        set_grant_cache(None)
+        super().tearDown()
+
+    def renew_now(self, token):
+        self.refresher._schedule_renewal(token, time.time() - 1)
+        self.refresher.run_pending()
+
+    def test_renewed_before_expiry(self):
+        token = self.refresher.register_secrets('client', 'key', 'secret')
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertAlmostEqual(token.due, time.time() + 3300, delta=5)
+        self.assertEqual(token.access_token, 'access')
+        self.assertIsNotNone(self.refresher.run_pending())
+        self.assertEqual(len(self.stub.requests), 1)
+        self.renew_now(token)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(self.refresher.stats()['renewals'], 2)
+
+    def test_missing_expires_in(self):
+        self.stub.response = dict(self.stub.response, expires_in=None)
+        self.addCleanup(setattr, self.stub, 'response', StubAuthServer().response)
+        token = self.refresher.register_secrets('client', 'key', 'secret')
+        token.get()
+        token.get()
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertFalse(token.expired)
+        self.assertGreater(token.due, time.time())
+
+    def test_failed_renewal_retried(self):
+        token = self.refresher.register_secrets('client', 'key', 'secret')
+        self.stub.status = 503
+        self.renew_now(token)
+        self.assertEqual(self.refresher.stats()['failures'], 1)
+        self.assertAlmostEqual(token.due, time.time() + 30, delta=16)
+        self.assertEqual(token.access_token, 'access')
+
+    def test_idle_token_dropped(self):
+        token = self.refresher.register_secrets('client', 'key', 'secret')
+        token.last_used = time.time() - 7200
+        self.renew_now(token)
+        self.assertEqual(len(self.refresher), 0)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_cached_grants_registered(self):
+        set_refresher(self.refresher)
+        set_grant_cache(GrantCache(LocalGrantCacheBackend()))
+        KairnialAuthentication('client').secrets_authentication('key', 'secret')
+        # opt-in: secrets presented to the key endpoint are not kept by default
+        self.assertEqual(len(self.refresher), 0)
+        self.refresher.register_grants = True
+        KairnialAuthentication('client').secrets_authentication('key', 'other secret')
+        self.assertEqual(len(self.refresher), 1)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.stub.requests.clear()
+        self.renew_now(next(iter(self.refresher._tokens.values())))
+        self.assertEqual(len(self.stub.requests), 1)
+        # the renewed grant is served from the cache
+        KairnialAuthentication('client').secrets_authentication('key', 'other secret')
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_renewal_shared_between_workers(self):
+        set_grant_cache(GrantCache(LocalGrantCacheBackend()))
+        other_worker = TokenRefresher(lead_time=300, jitter=0)
+        other_worker._ensure_thread = lambda: None
+        response = self.stub.response
+        self.addCleanup(setattr, self.stub, 'response', response)
+        self.stub.response = dict(response, expires_in=400)
+        token = self.refresher.register_secrets('client', 'key', 'secret')
+        other_token = other_worker.register_secrets('client', 'key', 'secret', response=dict(token.response))
+        self.stub.response = response
+        # the first worker due renews the grant and stores it in the grant cache
+        self.renew_now(token)
+        self.assertEqual(len(self.stub.requests), 2)
+        other_worker._schedule_renewal(other_token, time.time() - 1)
+        other_worker.run_pending()
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertGreater(other_token.expires_at, time.time() + 3000)
+        self.assertGreater(other_token.due, time.time() + 2000)
+        # nobody renewed the cached grant: renewed upstream
+        other_token.expires_at = time.time() + 3700
+        other_worker._schedule_renewal(other_token, time.time() - 1)
+        other_worker.run_pending()
+        self.assertEqual(len(self.stub.requests), 3)
+
+
+class LoadgenTestCase(StubServerTestCase):
+
+    def loadgen(self, *args) -> str:
+        stdout = io.StringIO()
+        call_command('kl_auth_loadgen', '--server', self.stub.url, *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_thread_mode(self):
+        output = self.loadgen('--endpoint', 'key', '--requests', '25', '--concurrency', '4', '--unique-credentials')
+        self.assertEqual(len(self.stub.requests), 25)
+        self.assertEqual(len({request['api_key'] for _, request in self.stub.requests}), 25)
+        self.assertRegex(output, r'requests    25 in \d+\.\d\ds\n')
+        self.assertRegex(output, r'throughput  \d+\.\d req/s')
+        self.assertRegex(output, r'latency ms  mean [\d.]+  p50 [\d.]+  p90 [\d.]+  p99 [\d.]+  max [\d.]+')
+        self.assertIn('status 200          25', output)
+
+    def test_async_mode(self):
+        self.stub.status = 401
+        output = self.loadgen('--mode', 'async', '--requests', '10', '--concurrency', '20')
+        self.assertEqual(len(self.stub.requests), 10)
+        self.assertIn('requests    10 in', output)
+        self.assertIn('status 503          10', output)
+
+    def test_concurrency(self):
+        self.stub.latency = 0.1
+        self.addCleanup(setattr, self.stub, 'latency', 0)
+        for mode in ['thread', 'async']:
+            with self.subTest(mode=mode):
+                output = self.loadgen('--mode', mode, '--requests', '8', '--concurrency', '8', '--unique-credentials')
+                duration = float(re.search(r'requests    8 in (\S+)s', output).group(1))
+                self.assertLess(duration, 0.5)
+        output = self.loadgen('--requests', '4', '--concurrency', '1')
+        self.assertGreaterEqual(float(re.search(r'requests    4 in (\S+)s', output).group(1)), 0.4)
+
+    def test_arguments(self):
+        with self.assertRaisesMessage(CommandError, '--concurrency must be at least 1'):
+            self.loadgen('--concurrency', '0')
+        self.assertEqual(self.loadgen('--requests', '0'), "No request sent\n")
+        self.assertEqual(len(self.stub.requests), 0)
+
+
+class AsyncSingleFlightTestCase(SimpleTestCase):
+
+    def test_leader_cancelled(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(None)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do('key', fetch))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do('key', fetch))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower, leader.cancelled()
+
+        self.assertEqual(asyncio.run(run()), ('result', True))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_error_shared(self):
+        flight = AsyncSingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise ValueError('upstream')
+
+        async def run():
+            return await asyncio.gather(flight.do('key', fetch), flight.do('key', fetch), return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertIs(results[0], results[1])
+        self.assertEqual(flight.in_flight(), 0)
+
+
+class AsyncViewsTestCase(StubServerTestCase):
+
+    def post(self, view_class, data):
+        request = AsyncRequestFactory().post('/', data=json.dumps(data), content_type='application/json')
+        return asyncio.run(view_class.as_view()(request, client_id='client'))
+
+    def test_authenticate_required(self):
+        class IncompleteView(AsyncClientlessAuthenticationView):
+            serializer_class = ClientlessPasswordAuthenticationSerializer
+
+        with self.assertRaises(TypeError):
+            IncompleteView()
+
+    def test_sync_view(self):
+        request = RequestFactory().post('/', data={'email': 'user@example.com', 'password': 'secret'},
+                                        content_type='application/json')
+        response = ClientlessPasswordAuthenticationView.as_view()(request, client_id='client')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['access_token'], 'access')
+
+    def test_password(self):
+        response = self.post(AsyncClientlessPasswordAuthenticationView,
+                             {'email': 'user@example.com', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual(body['access_token'], 'access')
+        self.assertEqual(body['user']['email'], 'user@example.com')
+        path, payload = self.stub.requests[0]
+        self.assertEqual(payload['grant_type'], 'password')
+        self.assertEqual(payload['client_id'], 'client')
+
+    def test_api_key(self):
+        response = self.post(AsyncClientlessAPIKeyAuthenticationView, {'api_key': 'key', 'api_secret': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stub.requests[0][1]['api_key'], 'key')
+
+    def test_refresh(self):
+        response = self.post(AsyncClientlessRefreshTokenAuthenticationView, {'refresh_token': 'refresh'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stub.requests[0][1]['grant_type'], 'refresh_token')
+
+    def test_invalid_body(self):
+        request = AsyncRequestFactory().post('/', data='{', content_type='application/json')
+        response = asyncio.run(AsyncClientlessPasswordAuthenticationView.as_view()(request, client_id='client'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_secrets_refresh(self):
+        set_grant_cache(GrantCache(LocalGrantCacheBackend()))
+        self.addCleanup(set_grant_cache, None)
+        ka = KairnialAuthentication('client')
+        asyncio.run(ka.asecrets_authentication('key', 'secret'))
+        asyncio.run(ka.asecrets_authentication('key', 'secret'))
+        self.assertEqual(len(self.stub.requests), 1)
+        asyncio.run(ka.asecrets_authentication('key', 'secret', refresh=True))
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_schema(self):
+        schema = SchemaGenerator(patterns=[path('async/', include('kl_authentication.async_urls'))]).get_schema(
+            request=None, public=True)
+        for route in ['password', 'key', 'renew']:
+            operation = schema['paths'][f'/async/{route}']['post']
+            self.assertIn('200', operation['responses'])
+            self.assertIn('requestBody', operation)
+
+    def test_upstream_error(self):
+        self.stub.status = 401
+        response = self.post(AsyncClientlessAPIKeyAuthenticationView, {'api_key': 'bad', 'api_secret': 'bad'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.content)['service_status'], 401)
+
+
+class SettingsTestCase(SimpleTestCase):
+
+    STARTUP_PROBE = """
+import sys
+import django
+from django.conf import settings
+settings.configure(INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth', 'rest_framework',
+                                   'kl_authentication'], SECRET_KEY='test', KAIRNIAL_AUTH_OPENAPI_EAGER={eager})
+django.setup()
+import kl_authentication.authentication, kl_authentication.middlewares
+print('drf_spectacular' in sys.modules)
+"""
+
+    def startup_loads_drf_spectacular(self, eager: bool) -> bool:
+        output = subprocess.run([sys.executable, '-c', self.STARTUP_PROBE.format(eager=eager)], check=True,
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+        return output.strip() == 'True'
+
+    def test_openapi_extensions_lazy(self):
+        self.assertFalse(self.startup_loads_drf_spectacular(eager=False))
+        self.assertTrue(self.startup_loads_drf_spectacular(eager=True))
+
+    def test_openapi_extensions_registered(self):
+        extension = OpenApiAuthenticationExtension.get_match(KairnialHeaderOrCookieAuthentication())
+        self.assertEqual(type(extension).__name__, 'HeaderOrCookieTokenScheme')
+
+    def test_settings_read_on_use(self):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='Bearer header-token')
+        request.COOKIES[ACCESS_TOKEN_COOKIE] = 'cookie-token'
+        self.assertEqual(parse_credentials(request).token, 'header-token')
+        with override_settings(KAIRNIAL_AUTH_CREDENTIAL_SOURCES=(SOURCE_COOKIE, SOURCE_HEADER)):
+            self.assertEqual(parse_credentials(request).token, 'cookie-token')
+        self.assertEqual(parse_credentials(request).token, 'header-token')
+
+    def test_metrics_configured(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('seconds', "Durations")
+        fixed = registry.histogram('fixed_seconds', "Durations", buckets=(1, 2))
+        registry.configure(enabled=True, buckets=(0.1, 1))
+        self.assertTrue(histogram.enabled)
+        self.assertEqual(histogram.buckets, (0.1, 1, float('inf')))
+        self.assertEqual(fixed.buckets, (1, 2, float('inf')))
+
+
+class MetricsTestCase(StubServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        set_key_ring(KeyRing(default_key=PUBLIC_KEY))
+        TokenAthentication.token_cache.clear()
+        TokenAthentication.negative_cache.clear()
+        REGISTRY.configure(enabled=True)
+        REGISTRY.clear()
+        self.addCleanup(REGISTRY.clear)
+        self.addCleanup(REGISTRY.configure_from_settings)
+        self.addCleanup(set_key_ring, None)
+
+    def test_samples_required(self):
+        class Gauge(Metric):
+            type = 'gauge'
+
+        with self.assertRaises(TypeError):
+            Gauge('kl_test_gauge', 'Gauge')
+
+    def test_render(self):
+        registry = MetricsRegistry(enabled=True)
+        counter = registry.counter('kl_test_requests', 'Requests by "route"', labelnames=('route',))
+        histogram = registry.histogram('kl_test_seconds', "Durations", buckets=(0.1, 1))
+        counter.inc(route='key')
+        counter.inc(2, route='pass\\word')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP kl_test_requests Requests by \\"route\\"',
+            '# TYPE kl_test_requests counter',
+            'kl_test_requests_total{route="key"} 1.0',
+            'kl_test_requests_total{route="pass\\\\word"} 2.0',
+            '# HELP kl_test_seconds Durations',
+            '# TYPE kl_test_seconds histogram',
+            'kl_test_seconds_bucket{le="0.1"} 1.0',
+            'kl_test_seconds_bucket{le="1.0"} 2.0',
+            'kl_test_seconds_bucket{le="+Inf"} 3.0',
+            'kl_test_seconds_sum 5.55',
+            'kl_test_seconds_count 3.0',
+        ]) + '\n')
+
+    def test_disabled(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('kl_test_requests', "Requests")
+        counter.inc()
+        with registry.histogram('kl_test_seconds', "Durations").time() as timer:
+            self.assertIsNone(timer)
+        self.assertEqual(counter.value(), 0)
+        self.assertNotIn('kl_test_requests_total', registry.render())
+
+    def test_failure_reasons(self):
+        with self.assertLogs('authentication', level='ERROR'):
+            for token, client_id in [(make_token(expires_in=-10), 'client'), (make_token(), 'other'),
+                                     (make_token(OTHER_PRIVATE_KEY), 'client')]:
+                self.assertIsNone(TokenTestCase.authenticate(token, client_id))
+            # no client_id route parameter
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {make_token()}')
+            self.assertIsNone(KairnialTokenAuthentication().authenticate(request))
+        self.assertIsNotNone(TokenTestCase.authenticate(make_token()))
+        self.assertEqual({reason: AUTH_FAILURES.value(reason=reason)
+                          for reason in ['expired', 'claims', 'invalid', 'client_id', 'revoked']},
+                         {'expired': 1, 'claims': 1, 'invalid': 1, 'client_id': 1, 'revoked': 0})
+        self.assertEqual(TOKEN_VERIFY_SECONDS.count(), 4)
+
+    def test_upstream(self):
+        KairnialAuthentication('client').secrets_authentication('key', 'secret')
+        self.stub.status = 401
+        with self.assertRaises(KairnialAuthServiceError):
+            KairnialAuthentication('client').password_authentication('user', 'password')
+        set_transport(InMemoryTransport(mock.Mock(side_effect=TransportError('down'))))
+        with self.assertRaises(KairnialAuthServiceError):
+            KairnialAuthentication('client').secrets_authentication('key', 'secret')
+        self.assertEqual(UPSTREAM_RESPONSES.value(grant='api_key', status=200), 1)
+        self.assertEqual(UPSTREAM_RESPONSES.value(grant='password', status=401), 1)
+        self.assertEqual(UPSTREAM_RESPONSES.value(grant='api_key', status='unreachable'), 1)
+        self.assertEqual(UPSTREAM_SECONDS.count(grant='api_key'), 2)
+        self.assertEqual(UPSTREAM_SECONDS.count(grant='password'), 1)
+        self.assertIn('kl_auth_upstream_responses_total{grant="password",status="401"} 1.0', REGISTRY.render())
+
+    @staticmethod
+    def get_metrics(user=None):
+        request = APIRequestFactory().get('/metrics', HTTP_ACCEPT='text/plain')
+        if user is not None:
+            force_authenticate(request, user=user)
+        return MetricsView.as_view()(request)
+
+    def test_view(self):
+        AUTH_FAILURES.inc(reason='expired')
+        response = self.get_metrics(user=KairnialUser(uuid='prometheus'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn(b'kl_auth_failures_total{reason="expired"} 1.0', response.content)
+        self.assertIn(self.get_metrics().status_code, (401, 403))
+        with override_settings(KAIRNIAL_AUTH_METRICS={'ENABLED': True,
+                                                      'PERMISSION_CLASSES': ['rest_framework.permissions.AllowAny']}):
+            self.assertEqual(self.get_metrics().status_code, 200)
+        REGISTRY.configure(enabled=False)
+        self.assertEqual(self.get_metrics(user=KairnialUser(uuid='prometheus')).status_code, 404)
+
+    def test_route(self):
+        try:
+            for enabled in [True, False]:
+                REGISTRY.configure(enabled=enabled)
+                for module in [urls, async_urls]:
+                    routes = [str(pattern.pattern) for pattern in importlib.reload(module).urlpatterns]
+                    self.assertEqual('metrics' in routes, enabled)
+        finally:
+            REGISTRY.configure_from_settings()
+            importlib.reload(urls)
+            importlib.reload(async_urls)
+
+
+class AuthMiddlewareTestCase(SimpleTestCase):
+
+    def test_sync_chain(self):
+        middleware = KairnialAuthMiddleware(lambda request: request)
+        self.assertFalse(asyncio.iscoroutinefunction(middleware))
+        request = middleware(RequestFactory().get('/', HTTP_AUTHORIZATION='Bearer token'))
+        self.assertEqual(request.token, 'token')
+
+    def test_async_chain(self):
+        async def get_response(request):
+            return request
+
+        middleware = KairnialAuthMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = AsyncRequestFactory().get('/')
+        request.META['HTTP_AUTHORIZATION'] = 'Bearer token'
+        request = asyncio.run(middleware(request))
+        self.assertEqual(request.token, 'token')
+
+
+class ServerTimingTestCase(SimpleTestCase):
+
+    @staticmethod
+    def view(request):
+        if request.GET.get('verify'):
+            with timed(TIMING_VERIFY):
+                time.sleep(0.001)
+        response = HttpResponse()
+        if request.GET.get('upstream'):
+            response[SERVER_TIMING_HEADER] = 'db;dur=12.5'
+        return response
+
+    async def aview(self, request):
+        await asyncio.sleep(0.01)
+        return self.view(request)
+
+    @override_settings(KAIRNIAL_AUTH_SERVER_TIMING=True)
+    def test_header(self):
+        middleware = KairnialAuthMiddleware(self.view)
+        response = middleware(RequestFactory().get('/', {'verify': 1}, HTTP_AUTHORIZATION='Bearer token'))
+        self.assertRegex(response[SERVER_TIMING_HEADER],
+                         r'^auth-parse;dur=\d+\.\d{3};desc="Credentials parsing", '
+                         r'auth-verify;dur=\d+\.\d{3};desc="Token verification"$')
+        self.assertGreaterEqual(float(response[SERVER_TIMING_HEADER].split('auth-verify;dur=')[1].split(';')[0]), 1)
+
+    @override_settings(KAIRNIAL_AUTH_SERVER_TIMING=True)
+    def test_upstream_header_merged(self):
+        response = KairnialAuthMiddleware(self.view)(RequestFactory().get('/', {'upstream': 1}))
+        self.assertRegex(response[SERVER_TIMING_HEADER], r'^db;dur=12\.5, auth-parse;dur=')
+
+    @override_settings(KAIRNIAL_AUTH_SERVER_TIMING=True)
+    def test_timings_not_shared(self):
+        middleware = KairnialAuthMiddleware(self.view)
+        self.assertIn(TIMING_VERIFY, middleware(RequestFactory().get('/', {'verify': 1}))[SERVER_TIMING_HEADER])
+        self.assertNotIn(TIMING_VERIFY, middleware(RequestFactory().get('/'))[SERVER_TIMING_HEADER])
+        # outside of a request nothing is collected
+        with timed(TIMING_VERIFY) as timer:
+            self.assertIsNone(timer)
+
+        async def requests():
+            middleware = KairnialAuthMiddleware(self.aview)
+            return await asyncio.gather(middleware(AsyncRequestFactory().get('/', {'verify': 1})),
+                                        middleware(AsyncRequestFactory().get('/')))
+
+        timed_response, other = asyncio.run(requests())
+        self.assertIn(TIMING_VERIFY, timed_response[SERVER_TIMING_HEADER])
+        self.assertNotIn(TIMING_VERIFY, other[SERVER_TIMING_HEADER])
+
+    def test_disabled(self):
+        self.assertNotIn(SERVER_TIMING_HEADER, KairnialAuthMiddleware(self.view)(RequestFactory().get('/')))
+
+    def profiles(self, sample_rate: int, requests: int) -> list:
+        directory = tempfile.mkdtemp()
+        with override_settings(KAIRNIAL_AUTH_PROFILE={'SAMPLE_RATE': sample_rate, 'DIR': directory}):
+            middleware = KairnialAuthMiddleware(self.view)
+        for _ in range(requests):
+            middleware(RequestFactory().get('/auth/check', HTTP_AUTHORIZATION='Bearer token'))
+            # requests without credentials are not sampled
+            middleware(RequestFactory().get('/'))
+        return os.listdir(directory)
+
+    def test_sampled_profiles(self):
+        profiles = self.profiles(sample_rate=3, requests=7)
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(name.startswith(f'kl_auth-{os.getpid()}-') and name.endswith('-GET_auth_check.prof')
+                            for name in profiles))
+        self.assertEqual(self.profiles(sample_rate=0, requests=7), [])
+
+
+class FastResponsesTestCase(StubServerTestCase):
+    """
+    The fast path must produce the serializers output
+    """
+    auth_response = StubAuthServer().response
+
+    def assertSameOutput(self, serializer_class, instance):
+        expected = serializer_class(instance).data
+        projected = responses.project(serializer_class, instance)
+        self.assertEqual(projected, expected)
+        self.assertEqual(list(projected), list(expected))
+        self.assertEqual(json.loads(responses.render_json(projected)), json.loads(JSONRenderer().render(expected)))
+
+    def test_auth_response(self):
+        self.assertSameOutput(AuthResponseSerializer, self.auth_response)
+
+    def test_auth_response_variants(self):
+        without_refresh = {k: v for k, v in self.auth_response.items() if k != 'refresh_token'}
+        self.assertSameOutput(AuthResponseSerializer, without_refresh)
+        self.assertSameOutput(AuthResponseSerializer, dict(self.auth_response, user=None, expires_in='3600'))
+        self.assertSameOutput(AuthResponseSerializer, dict(self.auth_response, scope=['openid', 'é']))
+
+    def test_missing_required_field(self):
+        incomplete = {k: v for k, v in self.auth_response.items() if k != 'scope'}
+        with self.assertRaises(KeyError):
+            AuthResponseSerializer(incomplete).data
+        with self.assertRaises(KeyError):
+            responses.project(AuthResponseSerializer, incomplete)
+
+    def test_error(self):
+        self.assertSameOutput(AuthServiceErrorSerializer, {'service_status': 401, 'service_message': 'Failed'})
+        error = KairnialAuthServiceError(message='Failed', status=401)
+        with override_settings(KAIRNIAL_AUTH_FAST_RESPONSES=True):
+            fast_error = error.error
+        self.assertEqual(fast_error, error.error)
+
+    def test_views(self):
+        data = json.dumps({'api_key': 'key', 'api_secret': 'secret'})
+        factory = RequestFactory()
+        view = ClientlessAPIKeyAuthenticationView.as_view()
+        async_view = AsyncClientlessAPIKeyAuthenticationView.as_view()
+        contents = []
+        for fast in (False, True):
+            with override_settings(KAIRNIAL_AUTH_FAST_RESPONSES=fast):
+                response = view(factory.post('/', data=data, content_type='application/json'), client_id='client')
+                response = response.render() if hasattr(response, 'render') else response
+                async_response = asyncio.run(async_view(
+                    AsyncRequestFactory().post('/', data=data, content_type='application/json'), client_id='client'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            contents.append(json.loads(response.content))
+            contents.append(json.loads(async_response.content))
+        self.assertTrue(all(content == contents[0] for content in contents))
@@ -0,0 +1,183 @@
+"""
+Per request timing (Server-Timing header) and sampled profiling
+"""
+import contextlib
+import contextvars
+import itertools
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+TIMING_PARSE = 'auth-parse'
+TIMING_VERIFY = 'auth-verify'
+TIMING_UPSTREAM = 'auth-upstream'
+TIMING_DESCRIPTIONS = {
+    TIMING_PARSE: 'Credentials parsing',
+    TIMING_VERIFY: 'Token verification',
+    TIMING_UPSTREAM: 'Auth server',
+}
+SERVER_TIMING_HEADER = 'Server-Timing'
+
+_timings = contextvars.ContextVar('kl_auth_timings', default=None)
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings: dict, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timings[self.name] = self.timings.get(self.name, 0) + time.perf_counter() - self.start
+
+
+def start_timings():
+    """
+    Start collecting timings in the current context
+    :return: token for stop_timings
+    """
+    return _timings.set({})
+
+
+def stop_timings(token) -> dict:
+    """
+    Stop collecting timings
+    :param token: start_timings result
+    :return: seconds spent by timing name
+    """
+    timings = _timings.get()
+    _timings.reset(token)
+    return timings or {}
+
+
+def timed(name: str):
+    """
+    Context manager adding the duration of its block to the collected timings,
+    does nothing when timings are not collected
+    :param name: Timing name
+    """
+    timings = _timings.get()
+    if timings is None:
+        return _NULL_CONTEXT
+    return _Timer(timings, name)
+
+
+def format_server_timing(timings: dict) -> str:
+    """
+    Server-Timing header value, durations in milliseconds
+    :param timings: seconds spent by timing name
+    :return:
+    """
+    return ', '.join(
+        f'{name};dur={duration * 1000:.3f};desc="{TIMING_DESCRIPTIONS.get(name, name)}"'
+        for name, duration in timings.items()
+    )
+
+
+def add_server_timing(response, timings: dict):
+    """
+    Add timings to the response Server-Timing header, keeping existing metrics
+    """
+    if not timings:
+        return
+    value = format_server_timing(timings)
+    existing = response.get(SERVER_TIMING_HEADER)
+    response[SERVER_TIMING_HEADER] = f'{existing}, {value}' if existing else value
+
+
+class SamplingProfiler:
+    """
+    Profile one request out of sample_rate (none when 0) and write the stats to directory,
+    kl_auth_profiles in the system temporary directory by default
+
+    profiler_class follows the cProfile.Profile interface: enable(), disable()
+    and dump_stats(path). A request is skipped when another profiler is already active.
+    """
+
+    def __init__(self, sample_rate: int = 100, directory: str = None, profiler_class=None):
+        if directory is None:
+            import tempfile
+            directory = os.path.join(tempfile.gettempdir(), 'kl_auth_profiles')
+        self.sample_rate = sample_rate
+        self.directory = directory
+        if profiler_class is None:
+            import cProfile
+            profiler_class = cProfile.Profile
+        self.profiler_class = profiler_class
+        self._counter = itertools.count(1)
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build profiler from the KAIRNIAL_AUTH_PROFILE setting
+        :return: None if profiling is not configured
+        """
+        config = getattr(settings, 'KAIRNIAL_AUTH_PROFILE', None)
+        if not config:
+            return None
+        profiler_class = config.get('PROFILER')
+        return cls(
+            sample_rate=config.get('SAMPLE_RATE', 100),
+            directory=config.get('DIR'),
+            profiler_class=import_string(profiler_class) if profiler_class else None
+        )
+
+    def sample(self) -> bool:
+        """
+        Whether the current request should be profiled
+        """
+        return self.sample_rate > 0 and next(self._counter) % self.sample_rate == 0
+
+    def _start(self):
+        profiler = self.profiler_class()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active (concurrent sampled request)
+            return None
+        return profiler
+
+    def _stop(self, profiler, request):
+        profiler.disable()
+        path = os.path.join(
+            self.directory,
+            f"kl_auth-{os.getpid()}-{time.time_ns()}-{request.method}{request.path.replace('/', '_')}.prof"
+        )
+        try:
+            profiler.dump_stats(path)
+        except OSError as e:
+            logging.getLogger('authentication').warning("Unable to write profile %s: %s", path, e)
+
+    def profile(self, get_response, request):
+        """
+        Call get_response(request) under the profiler
+        """
+        profiler = self._start()
+        if profiler is None:
+            return get_response(request)
+        try:
+            return get_response(request)
+        finally:
+            self._stop(profiler, request)
+
+    async def aprofile(self, get_response, request):
+        """
+        Await get_response(request) under the profiler, other tasks of the event loop
+        running meanwhile are profiled as well
+        """
+        profiler = self._start()
+        if profiler is None:
+            return await get_response(request)
+        try:
+            return await get_response(request)
+        finally:
+            self._stop(profiler, request)
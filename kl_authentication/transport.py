@@ -0,0 +1,303 @@
+"""
+HTTP transports used to reach the Kairnial auth server
+"""
+import abc
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_TRANSPORT = 'kl_authentication.transport.RequestsTransport'
+
+
+class TransportError(Exception):
+    """
+    Auth server could not be reached
+    """
+
+
+class TransportResponse:
+    """
+    Response returned by transports
+    """
+
+    def __init__(self, status_code: int, content: bytes = b'', headers: dict = None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class Transport(abc.ABC):
+    """
+    Base transport, subclasses send a POST request and return a TransportResponse
+
+    Grant requests are not idempotent: only failures to connect, where the request was
+    never sent, are retried. Responses with a status in retry_statuses (none by default)
+    are retried only when the caller allows it.
+    """
+    retries = 0
+    backoff = 0.1
+    max_backoff = 2
+    retry_statuses = ()
+
+    @abc.abstractmethod
+    def post(self, url: str, headers: dict = None, data=None, retry_status: bool = True) -> TransportResponse:
+        """
+        Send POST request
+        :param url: Target URL
+        :param headers: Request headers
+        :param data: Body, either a dict to be form encoded or a string
+        :param retry_status: Retry responses with a status in retry_statuses, False when replaying
+            the request after the server processed it is unsafe
+        :return:
+        """
+
+    async def apost(self, url: str, headers: dict = None, data=None, retry_status: bool = True) -> TransportResponse:
+        """
+        Send POST request from async code
+        Unless overridden, post() runs in a worker thread that is not shared with other requests
+        :param url: Target URL
+        :param headers: Request headers
+        :param data: Body, either a dict to be form encoded or a string
+        :param retry_status: Retry responses with a status in retry_statuses
+        :return:
+        """
+        return await sync_to_async(self.post, thread_sensitive=False)(url, headers=headers, data=data,
+                                                                      retry_status=retry_status)
+
+    def should_retry_status(self, status_code: int, retry_status: bool, attempt: int) -> bool:
+        return retry_status and status_code in self.retry_statuses and attempt < self.retries
+
+    def close(self):
+        pass
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter
+        :param attempt: Number of failed attempts - 1
+        :return: seconds to wait
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class RequestsTransport(Transport):
+    """
+    Keep-alive transport sharing a pooled requests Session between threads
+
+    Connection failures are retried with exponential backoff and full jitter.
+    """
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 3.05, read_timeout: float = 10,
+                 retries: int = 2, backoff: float = 0.1, max_backoff: float = 2, retry_statuses=()):
+        import requests
+        import urllib3
+        self._requests = requests
+        self._urllib3 = urllib3
+        self.retry_statuses = tuple(retry_statuses)
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        Session of the current process, rebuilt after a fork
+        """
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    session = self._requests.Session()
+                    adapter = self._requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                                  pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._pid = pid
+        return self._session
+
+    def _connect_failed(self, error) -> bool:
+        """
+        The connection could not be established, the request was not sent
+        Aborted connections and read timeouts are not retried, the server may have processed the request
+        """
+        if isinstance(error, self._requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, self._requests.ConnectionError) and \
+            isinstance(reason, self._urllib3.exceptions.NewConnectionError)
+
+    def post(self, url: str, headers: dict = None, data=None, retry_status: bool = True) -> TransportResponse:
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, headers=headers, data=data, timeout=self.timeout)
+            except self._requests.RequestException as e:
+                if not self._connect_failed(e) or attempt >= self.retries:
+                    raise TransportError(str(e)) from e
+            else:
+                if not self.should_retry_status(response.status_code, retry_status, attempt):
+                    return TransportResponse(response.status_code, response.content, response.headers)
+            time.sleep(self.backoff_delay(attempt))
+            attempt += 1
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+
+class HttpxTransport(Transport):
+    """
+    Keep-alive transport based on httpx (optional dependency), with a native async client
+    per event loop so that async views never hop to a thread
+    """
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 3.05, read_timeout: float = 10,
+                 retries: int = 2, backoff: float = 0.1, max_backoff: float = 2, retry_statuses=()):
+        import httpx
+        self._httpx = httpx
+        self.retry_statuses = tuple(retry_statuses)
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._client = None
+        self._pid = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = self._httpx.Client(limits=self.limits, timeout=self.timeout)
+                    self._pid = pid
+        return self._client
+
+    @property
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            self._async_clients[loop] = client
+        return client
+
+    @staticmethod
+    def _request_kwargs(headers: dict, data) -> dict:
+        if isinstance(data, dict):
+            return {'headers': headers, 'data': data}
+        return {'headers': headers, 'content': data}
+
+    def post(self, url: str, headers: dict = None, data=None, retry_status: bool = True) -> TransportResponse:
+        attempt = 0
+        while True:
+            try:
+                response = self.client.post(url, **self._request_kwargs(headers, data))
+            except (self._httpx.ConnectError, self._httpx.ConnectTimeout) as e:
+                if attempt >= self.retries:
+                    raise TransportError(str(e)) from e
+            except self._httpx.HTTPError as e:
+                raise TransportError(str(e)) from e
+            else:
+                if not self.should_retry_status(response.status_code, retry_status, attempt):
+                    return TransportResponse(response.status_code, response.content, response.headers)
+            time.sleep(self.backoff_delay(attempt))
+            attempt += 1
+
+    async def apost(self, url: str, headers: dict = None, data=None, retry_status: bool = True) -> TransportResponse:
+        attempt = 0
+        while True:
+            try:
+                response = await self.async_client.post(url, **self._request_kwargs(headers, data))
+            except (self._httpx.ConnectError, self._httpx.ConnectTimeout) as e:
+                if attempt >= self.retries:
+                    raise TransportError(str(e)) from e
+            except self._httpx.HTTPError as e:
+                raise TransportError(str(e)) from e
+            else:
+                if not self.should_retry_status(response.status_code, retry_status, attempt):
+                    return TransportResponse(response.status_code, response.content, response.headers)
+            await asyncio.sleep(self.backoff_delay(attempt))
+            attempt += 1
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            self._client = None
+
+
+class InMemoryTransport(Transport):
+    """
+    Transport answering from a handler instead of the network, for tests
+
+    The handler receives (url, headers, data) and returns a TransportResponse,
+    a dict sent back as a 200 JSON response, or raises TransportError.
+    """
+
+    def __init__(self, handler=None):
+        self.handler = handler or (lambda url, headers, data: TransportResponse(404))
+        self.requests = []
+
+    def post(self, url: str, headers: dict = None, data=None, retry_status: bool = True) -> TransportResponse:
+        self.requests.append((url, headers, data))
+        response = self.handler(url, headers, data)
+        if isinstance(response, dict):
+            return TransportResponse(200, json.dumps(response).encode('utf-8'))
+        return response
+
+    async def apost(self, url: str, headers: dict = None, data=None, retry_status: bool = True) -> TransportResponse:
+        return self.post(url, headers=headers, data=data, retry_status=retry_status)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    """
+    Process wide transport, built from the KAIRNIAL_AUTH_TRANSPORT setting on first use
+    :return:
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                config = dict(getattr(settings, 'KAIRNIAL_AUTH_TRANSPORT', {}))
+                transport_class = import_string(config.pop('CLASS', DEFAULT_TRANSPORT))
+                _transport = transport_class(**{k.lower(): v for k, v in config.items()})
+    return _transport
+
+
+def set_transport(transport: Transport = None):
+    """
+    Replace the process wide transport, None rebuilds it from settings on next use
+    :param transport:
+    :return:
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is not None and _transport is not transport:
+            _transport.close()
+        _transport = transport
@@ -1,8 +1,9 @@
 from django.urls import path
 
+from .metrics import REGISTRY
 from .views import ClientlessPasswordAuthenticationView, \
     ClientlessAPIKeyAuthenticationView, \
-    ClientlessRefreshTokenAuthenticationView
+    ClientlessRefreshTokenAuthenticationView, MetricsView
 
 # The API URLs are now determined automatically by the router.
 urlpatterns = [
@@ -10,3 +11,7 @@ urlpatterns = [
     path('key', ClientlessAPIKeyAuthenticationView.as_view()),
     path('renew', ClientlessRefreshTokenAuthenticationView.as_view()),
 ]
+
+if REGISTRY.enabled:
+    # KAIRNIAL_AUTH_METRICS is applied by AuthenticationConfig.ready(), before URLs are loaded
+    urlpatterns.append(path('metrics', MetricsView.as_view()))
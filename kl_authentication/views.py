@@ -1,20 +1,34 @@
 """
 Authentication views
 """
+import abc
+import json
 import os
 
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.module_loading import import_string
 from django.utils.translation import gettext as _
+from django.views import View
 from drf_spectacular.utils import extend_schema, OpenApiTypes, OpenApiParameter, OpenApiExample
 from rest_framework import status
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from . import JSON_CONTENT_TYPE
+from . import openapi  # noqa: F401 registers the authentication extensions along with the views schema
 from .decorators import handle_auth_ws_error
+from .conf import LazySetting
+from .introspection import get_introspector, introspection_settings
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, metrics_settings
+from .responses import api_response, json_response, serialize
 from .serializers import AuthServiceErrorSerializer
 from .serializers import ClientlessPasswordAuthenticationSerializer, \
     AuthResponseSerializer, ClientlessAPIKeyAuthenticationSerializer, \
-    ClientlessRefreshTokenAuthenticationSerializer
+    ClientlessRefreshTokenAuthenticationSerializer, TokenIntrospectionSerializer, \
+    TokenIntrospectionResponseSerializer
 from .services import KairnialAuthentication
 
 default_client_example = OpenApiExample(
@@ -60,8 +74,7 @@ class ClientlessPasswordAuthenticationView(APIView):
             auth_response = ka.password_authentication(
                 username=serializer.validated_data.get('username'),
                 password=serializer.validated_data.get('password'))
-            resp_serializer = AuthResponseSerializer(auth_response)
-            return Response(resp_serializer.data, status=status.HTTP_200_OK)
+            return api_response(serialize(AuthResponseSerializer, auth_response), status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, content_type=JSON_CONTENT_TYPE,
                             status=status.HTTP_400_BAD_REQUEST)
@@ -90,8 +103,7 @@ class ClientlessAPIKeyAuthenticationView(APIView):
                 api_key=serializer.validated_data.get('api_key'),
                 api_secret=serializer.validated_data.get('api_secret')
             )
-            resp_serializer = AuthResponseSerializer(auth_response)
-            return Response(resp_serializer.data, status=status.HTTP_200_OK)
+            return api_response(serialize(AuthResponseSerializer, auth_response), status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, content_type=JSON_CONTENT_TYPE,
                             status=status.HTTP_400_BAD_REQUEST)
@@ -120,8 +132,189 @@ class ClientlessRefreshTokenAuthenticationView(APIView):
                 refresh_token=serializer.validated_data.get('refresh_token'),
                 provider_uuid=serializer.validated_data.get('provider_uuid'),
             )
-            resp_serializer = AuthResponseSerializer(auth_response)
-            return Response(resp_serializer.data, status=status.HTTP_200_OK)
+            return api_response(serialize(AuthResponseSerializer, auth_response), status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, content_type=JSON_CONTENT_TYPE,
                             status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncClientlessAuthenticationView(View, abc.ABC):
+    """
+    Base of the ASGI native token views, served without DRF (whose views are sync only)
+    and calling the auth server through the async transport
+    """
+    http_method_names = ['post']
+    serializer_class = None
+    schema_view = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        if cls.schema_view is not None:
+            # schema generators only list DRF views, document the route as its sync counterpart
+            view.cls = cls.schema_view
+            view.initkwargs = {}
+        return view
+
+    @staticmethod
+    def get_data(request):
+        """
+        Request body, JSON or form encoded
+        """
+        if request.content_type == JSON_CONTENT_TYPE:
+            try:
+                return json.loads(request.body or b'{}')
+            except ValueError:
+                return None
+        return request.POST
+
+    @abc.abstractmethod
+    async def authenticate(self, ka: KairnialAuthentication, validated_data: dict) -> dict:
+        """
+        Request the token from the auth server
+        :param ka: Auth server service of the route client_id
+        :param validated_data: serializer_class validated data
+        :return: auth server response
+        """
+
+    @handle_auth_ws_error
+    async def post(self, request, client_id):
+        data = self.get_data(request)
+        if data is None:
+            return JsonResponse({'detail': _('JSON parse error')}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.serializer_class(data=data)
+        if serializer.is_valid():
+            ka = KairnialAuthentication(client_id=client_id)
+            auth_response = await self.authenticate(ka, serializer.validated_data)
+            return json_response(serialize(AuthResponseSerializer, auth_response), status=status.HTTP_200_OK)
+        else:
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncClientlessPasswordAuthenticationView(AsyncClientlessAuthenticationView):
+    """
+    Create an authentication token from user/password
+    """
+    serializer_class = ClientlessPasswordAuthenticationSerializer
+    schema_view = ClientlessPasswordAuthenticationView
+
+    async def authenticate(self, ka: KairnialAuthentication, validated_data: dict) -> dict:
+        return await ka.apassword_authentication(
+            username=validated_data.get('username'),
+            password=validated_data.get('password'))
+
+
+class AsyncClientlessAPIKeyAuthenticationView(AsyncClientlessAuthenticationView):
+    """
+    Create an authentication token from API key / secret
+    """
+    serializer_class = ClientlessAPIKeyAuthenticationSerializer
+    schema_view = ClientlessAPIKeyAuthenticationView
+
+    async def authenticate(self, ka: KairnialAuthentication, validated_data: dict) -> dict:
+        return await ka.asecrets_authentication(
+            api_key=validated_data.get('api_key'),
+            api_secret=validated_data.get('api_secret')
+        )
+
+
+class AsyncClientlessRefreshTokenAuthenticationView(AsyncClientlessAuthenticationView):
+    """
+    Obtain a bearer token using a refresh token
+    """
+    serializer_class = ClientlessRefreshTokenAuthenticationSerializer
+    schema_view = ClientlessRefreshTokenAuthenticationView
+
+    async def authenticate(self, ka: KairnialAuthentication, validated_data: dict) -> dict:
+        return await ka.arefresh_authentication(
+            refresh_token=validated_data.get('refresh_token'),
+            provider_uuid=validated_data.get('provider_uuid'),
+        )
+
+
+class FirstRendererNegotiation(BaseContentNegotiation):
+    """
+    Ignore the Accept header: errors are rendered by the first renderer, successful
+    responses are built by the view
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class MetricsView(APIView):
+    """
+    Authentication metrics in the Prometheus text format, 404 unless KAIRNIAL_AUTH_METRICS is enabled
+
+    Callers must be authenticated (DEFAULT_AUTHENTICATION_CLASSES) and pass the
+    KAIRNIAL_AUTH_METRICS PERMISSION_CLASSES, IsAuthenticated by default.
+    """
+    http_method_names = ['get']
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer]
+    content_negotiation_class = FirstRendererNegotiation
+
+    def get_permissions(self):
+        permission_classes = metrics_settings().get('PERMISSION_CLASSES')
+        if permission_classes is None:
+            return super().get_permissions()
+        return [import_string(permission_class)() for permission_class in permission_classes]
+
+    @extend_schema(exclude=True)
+    def get(self, request, *args, **kwargs):
+        if not REGISTRY.enabled:
+            raise Http404
+        return HttpResponse(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+class TokenIntrospectionView(APIView):
+    """
+    Verify a batch of tokens
+
+    Callers must be authenticated (DEFAULT_AUTHENTICATION_CLASSES) and pass the
+    KAIRNIAL_AUTH_INTROSPECTION PERMISSION_CLASSES, IsAuthenticated by default.
+    """
+    permission_classes = [IsAuthenticated]
+    max_batch = LazySetting(lambda: introspection_settings().get('MAX_BATCH', 1000))
+    stream_threshold = LazySetting(lambda: introspection_settings().get('STREAM_THRESHOLD', 100))
+
+    def get_permissions(self):
+        permission_classes = introspection_settings().get('PERMISSION_CLASSES')
+        if permission_classes is None:
+            return super().get_permissions()
+        return [import_string(permission_class)() for permission_class in permission_classes]
+
+    @extend_schema(
+        summary=_("Verify tokens"),
+        description=_("Verify a batch of tokens and return a verdict and the claims of each token, "
+                      "in the order of the request"),
+        parameters=client_parameters[:1],
+        request=TokenIntrospectionSerializer,
+        responses={200: TokenIntrospectionResponseSerializer, 400: OpenApiTypes.OBJECT},
+        methods=["POST"]
+    )
+    def post(self, request, client_id):
+        serializer = TokenIntrospectionSerializer(data=request.data, context={'max_batch': self.max_batch})
+        if not serializer.is_valid():
+            return Response(serializer.errors, content_type=JSON_CONTENT_TYPE,
+                            status=status.HTTP_400_BAD_REQUEST)
+        items = [(item['token'], item.get('audience') or client_id)
+                 for item in serializer.validated_data['tokens']]
+        results = get_introspector().introspect(items)
+        if len(items) > self.stream_threshold:
+            return StreamingHttpResponse(self.stream_results(results), content_type=JSON_CONTENT_TYPE)
+        return Response({'results': list(results)}, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def stream_results(results):
+        """
+        Encode results as they are verified
+        """
+        yield '{"results": ['
+        for index, result in enumerate(results):
+            yield (',' if index else '') + json.dumps(result)
+        yield ']}'